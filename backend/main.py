@@ -1,24 +1,61 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import Query, FastAPI, HTTPException, UploadFile
+from fastapi import Query, FastAPI, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import functools
 import json
+import multiprocessing
+import numpy as np
 import os
 from pathlib import Path
 import pickle
+import queue
+import shutil
+import tempfile
+import threading
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import BaseModel
-from typing import Union, List
+from typing import Union, List, Optional
 import uuid
 
-from timeline_generation.entry_point_for_dashboard import create_timeline_for_dashboard
+from timeline_generation.entry_point_for_dashboard import (return_anchor_point_detection, anchor_point_detection_cache_key,
+                                                           detect_anchor_points, create_timeline_from_anchor_points,
+                                                           return_cp_probability_detection, detect_cp_probabilities,
+                                                           create_timeline_from_cp_probabilities, ANCHOR_POINT_CACHE)
+from timeline_generation.ingest_posts import ingest_posts, return_posts_json
+from timeline_generation.anchor_points.postprocessing import to_date_strings
 from timeline_summary import ModelHandler
+from summary_jobs import SummaryJobQueue
+from summary_cache import SummaryCache, summary_cache_key
 
 class TimelineGenerationRequest(BaseModel):
+    session_id: str
+    method: str
+    alpha: Union[float, List[float]]
+    beta: Union[float, List[float]]
+    hazard: float
+    span_radius: int
+    max_gap_days: Union[int, None] = None
+    features: Union[List[str], None] = None
+    feature_priors: Union[dict, None] = None
+    distribution: str = 'pg'
+    prefilter: Union[str, None] = None
+
+class CpProbabilityRequest(BaseModel):
     session_id: str
     method: str
     alpha: float
     beta: float
     hazard: float
+    features: Union[List[str], None] = None
+    feature_priors: Union[dict, None] = None
+    lag: int = 7
+
+class RethresholdRequest(BaseModel):
+    session_id: str
+    cutoff: float
     span_radius: int
 
 class SaveDataRequest(BaseModel):
@@ -29,6 +66,13 @@ class GenerationRequest(BaseModel):
     posts_ids: List[str]
     model_name: str
 
+class SummaryJobRequest(BaseModel):
+    user_id: str
+    posts_ids: List[str]
+    model_name: str
+    # Jobs with a lower priority run first
+    priority: int = 0
+
 class SummaryRequest(BaseModel):
     user_id: str
     timeline_id: str
@@ -39,19 +83,50 @@ class Settings(BaseSettings):
     hf_token: str
     cache_dir: str
     data_dir: str
+    # Memory for the summarisation models kept loaded at the same time, in GB. Without a budget,
+    # only one model is kept loaded
+    model_memory_budget_gb: Union[float, None] = None
+    # Number of worker processes for the anchor point detection of timeline creation
+    timeline_workers: int = 2
+    # Persistent cache of the generated summaries, in data_dir/summary_cache unless set, and its size in MB
+    summary_cache_dir: Union[str, None] = None
+    summary_cache_max_mb: float = 256
     model_config = SettingsConfigDict(env_file=str(Path(__file__).resolve().parent / ".env"), env_file_encoding='utf-8')
 
 settings = Settings()
 
 # Save currently processing data for timeline creation in dictionary
-# keys are session_ids and values are dicts with keys 'posts' and 'timelines'
+# keys are session_ids and values are dicts with keys 'posts' and 'timelines' (and 'cp_probabilities'),
+# and 'user_data' holds the ingested post columns (see timeline_generation.ingest_posts)
 currently_processing_data = {}
 
+# Locks of the timeline json files of the users. The summaries are written to them by the summary worker and by
+# the request threads (cached summaries, deleting summaries, saving), so each read-modify-write holds the lock
+timelines_locks = {}
+timelines_locks_lock = threading.Lock()
+
+def timelines_lock(user_id: str) -> threading.Lock:
+    with timelines_locks_lock:
+        return timelines_locks.setdefault(user_id, threading.Lock())
+
 # Handle app startup and shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.summariser = ModelHandler(settings.cache_dir)
+    app.state.summariser = ModelHandler(
+        settings.cache_dir,
+        memory_budget_bytes=(int(settings.model_memory_budget_gb * 1024**3)
+                             if settings.model_memory_budget_gb is not None else None))
+    # The workers are spawned rather than forked, since by the time they are started this process runs the
+    # summary worker and model loader threads and may hold a model on the GPU
+    app.state.timeline_executor = ProcessPoolExecutor(max_workers=settings.timeline_workers,
+                                                      mp_context=multiprocessing.get_context("spawn"))
+    app.state.summary_cache = SummaryCache(
+        settings.summary_cache_dir or os.path.join(settings.data_dir, "summary_cache"),
+        max_bytes=int(settings.summary_cache_max_mb * 1024**2))
+    app.state.summary_jobs = SummaryJobQueue(run_summary_job)
     yield
+    app.state.summary_jobs.shutdown()
+    app.state.timeline_executor.shutdown(cancel_futures=True)
     app.state.summariser.cleanup()
     print("App shutdown complete.")
 
@@ -84,25 +159,32 @@ async def upload_user_data(file: UploadFile):
     try:
         contents = await file.read()
         user_data = pickle.loads(contents)
-        # process data and save as json
         patient_name = user_data[0]["author"]
-        og_posts = {}
-        for post in user_data:
-            og_posts[post["id"]] = {
-                "title": post["title"],
-                "body": post.get("selftext", ""),
-                "created_utc": post["created_utc"],
-                "label": ["0"]
-        }
+        # Only keep the fields used by the dashboard, as columns, and drop the raw posts
+        post_columns = ingest_posts(user_data)
+        del user_data, contents
+        # process data and save as json
+        og_posts = return_posts_json(post_columns)
         # Don't save the data yet, but keep in memory until user confirms in frontend
         # Generate a session id
         session_id = str(uuid.uuid4())
-        currently_processing_data[session_id] = {"patient_id": patient_name, "posts": og_posts, "user_data": user_data}
+        currently_processing_data[session_id] = {"patient_id": patient_name, "posts": og_posts, "user_data": post_columns}
         return {"session_id": session_id, "posts": og_posts}
     except Exception as e:
         print("Error reading pickle file:", e)
         raise HTTPException(status_code=400, detail="Error reading pickle file.")
 
+# The detector checkpoint of a session is kept apart from the saved one of the user (data_dir/{patient_id}_detector.npz)
+# until the user confirms the data with /api/save-user-data
+def session_checkpoint_path(session_id: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"timeline_session_{session_id}_detector.npz")
+
+def remove_session_checkpoint(session_id: str):
+    try:
+        os.remove(session_checkpoint_path(session_id))
+    except OSError:
+        pass
+
 # Create timelines for new user data
 @app.post("/api/create-timelines")
 async def create_timelines_for_user(req: TimelineGenerationRequest):
@@ -112,20 +194,74 @@ async def create_timelines_for_user(req: TimelineGenerationRequest):
     beta = req.beta
     hazard = req.hazard
     span_radius = req.span_radius
+    max_gap_days = req.max_gap_days
+    features = req.features
+    feature_priors = req.feature_priors
+    distribution = req.distribution
+    prefilter = req.prefilter
 
     if session_id not in currently_processing_data:
         raise HTTPException(status_code=400, detail="Invalid session ID.")
     
     try:
         user_data = currently_processing_data[session_id]["user_data"]
+        patient_id = currently_processing_data[session_id]["patient_id"]
 
-        timelines = create_timeline_for_dashboard(
-            unpickled_posts=user_data,
+        # If the user was processed before, only the new days are run through the detector
+        # and the unchanged timelines keep their summaries. The detector checkpoint is
+        # only kept for the whole series with a single prior, i.e. if it is not split at
+        # inactivity gaps or screened, and no mixture of priors is used. The saved checkpoint
+        # of the user is resumed from, and the updated one is kept with the session
+        previous_timelines = None
+        timelines_path = os.path.join(settings.data_dir, f"{patient_id}_timelines.json")
+        if os.path.exists(timelines_path):
+            with open(timelines_path) as f:
+                previous_timelines = json.load(f)
+
+        use_checkpoint = max_gap_days is None and prefilter is None and distribution == 'pg'
+
+        # The daily series is built in a thread, and only the compact series is sent to the worker
+        # processes for the detection, so that the event loop keeps serving other requests.
+        # The detection of a request runs in a single worker (max_workers=1 for the gap segments)
+        detection = await asyncio.to_thread(
+            return_anchor_point_detection,
+            user_data,
             method=method,
             alpha=alpha,
             beta=beta,
             hazard=hazard,
-            span_radius=span_radius
+            checkpoint_path=(os.path.join(settings.data_dir, f"{patient_id}_detector.npz")
+                             if use_checkpoint else None),
+            checkpoint_save_path=session_checkpoint_path(session_id) if use_checkpoint else None,
+            max_gap_days=max_gap_days,
+            max_workers=1,
+            features=features,
+            feature_priors=feature_priors,
+            distribution=distribution,
+            prefilter=prefilter
+        )
+        # Anchor points detected before with the same series and parameters (e.g. when only
+        # span_radius changed) are taken from the cache. With a checkpoint, that is only done if
+        # the session checkpoint was written by the same detection, otherwise the detection runs
+        # (resuming from the saved checkpoint) so that the session checkpoint is written
+        cache_key = anchor_point_detection_cache_key(detection)
+        anchor_points = None
+        if not use_checkpoint or currently_processing_data[session_id].get("checkpoint_key") == cache_key:
+            anchor_points = ANCHOR_POINT_CACHE.get(cache_key)
+        if anchor_points is None:
+            loop = asyncio.get_running_loop()
+            anchor_points = await loop.run_in_executor(app.state.timeline_executor,
+                                                       functools.partial(detect_anchor_points, **detection))
+            ANCHOR_POINT_CACHE.put(cache_key, anchor_points)
+            if use_checkpoint:
+                currently_processing_data[session_id]["checkpoint_key"] = cache_key
+
+        timelines = await asyncio.to_thread(
+            create_timeline_from_anchor_points,
+            user_data,
+            anchor_points,
+            span_radius=span_radius,
+            previous_timelines=previous_timelines
         )
         # Save complete timeline data to session
         currently_processing_data[session_id]["timelines"] = timelines
@@ -136,6 +272,97 @@ async def create_timelines_for_user(req: TimelineGenerationRequest):
         print("Error creating timelines:", e)
         raise HTTPException(status_code=500, detail="Error creating timelines.")
 
+# Helper function to convert the per-day change point probabilities to json for plotting
+def cp_probabilities_to_json(cp_probabilities) -> dict:
+    return {
+        "dates": to_date_strings(cp_probabilities.index.values),
+        "probabilities": np.round(cp_probabilities.to_numpy(dtype=float), 6).tolist()
+    }
+
+# Compute the change point probability of each day for new user data
+@app.post("/api/cp-probabilities")
+async def create_cp_probabilities_for_user(req: CpProbabilityRequest):
+    session_id = req.session_id
+    if session_id not in currently_processing_data:
+        raise HTTPException(status_code=400, detail="Invalid session ID.")
+
+    try:
+        user_data = currently_processing_data[session_id]["user_data"]
+        # As for create-timelines, the daily series is built in a thread and the model runs in a worker process
+        detection = await asyncio.to_thread(
+            return_cp_probability_detection,
+            user_data,
+            method=req.method,
+            alpha=req.alpha,
+            beta=req.beta,
+            hazard=req.hazard,
+            features=req.features,
+            feature_priors=req.feature_priors,
+            cp_probability_lag=req.lag
+        )
+        loop = asyncio.get_running_loop()
+        cp_probabilities = await loop.run_in_executor(app.state.timeline_executor,
+                                                      functools.partial(detect_cp_probabilities, **detection))
+        # Keep in the session, so that the timelines can be re-thresholded without running the model again
+        currently_processing_data[session_id]["cp_probabilities"] = cp_probabilities
+
+        return cp_probabilities_to_json(cp_probabilities)
+    except Exception as e:
+        print("Error computing change point probabilities:", e)
+        raise HTTPException(status_code=500, detail="Error computing change point probabilities.")
+
+# Create timelines for new user data from the change point probabilities at a cut-off
+@app.post("/api/rethreshold-timelines")
+async def rethreshold_timelines_for_user(req: RethresholdRequest):
+    session_id = req.session_id
+    if session_id not in currently_processing_data:
+        raise HTTPException(status_code=400, detail="Invalid session ID.")
+    if "cp_probabilities" not in currently_processing_data[session_id]:
+        raise HTTPException(status_code=400, detail="No change point probabilities computed for this session.")
+
+    try:
+        user_data = currently_processing_data[session_id]["user_data"]
+        patient_id = currently_processing_data[session_id]["patient_id"]
+
+        previous_timelines = None
+        timelines_path = os.path.join(settings.data_dir, f"{patient_id}_timelines.json")
+        if os.path.exists(timelines_path):
+            with open(timelines_path) as f:
+                previous_timelines = json.load(f)
+
+        timelines = await asyncio.to_thread(
+            create_timeline_from_cp_probabilities,
+            unpickled_posts=user_data,
+            cp_probabilities=currently_processing_data[session_id]["cp_probabilities"],
+            cutoff=req.cutoff,
+            span_radius=req.span_radius,
+            previous_timelines=previous_timelines
+        )
+        currently_processing_data[session_id]["timelines"] = timelines
+
+        return extract_timelines_of_interest(timelines)
+    except Exception as e:
+        print("Error creating timelines:", e)
+        raise HTTPException(status_code=500, detail="Error creating timelines.")
+
+# Loaded summarisation models, their memory footprints and hit/miss counts
+@app.get("/api/models")
+async def get_models():
+    return app.state.summariser.stats()
+
+# Entries, size and hit/miss counts of the summary cache
+@app.get("/api/summary-cache")
+async def get_summary_cache():
+    return app.state.summary_cache.stats()
+
+# Load a summarisation model in the background, e.g. when it is selected, so that the next summary does not wait for it
+@app.post("/api/models/prefetch")
+async def prefetch_model(model_name: str = Query(...)):
+    if model_name not in app.state.summariser.gen_paras:
+        raise HTTPException(status_code=404, detail=f"Model {model_name} not found.")
+    app.state.summariser.prefetch(model_name)
+    return app.state.summariser.stats()
+
 # Get user IDs
 @app.get("/api/user_ids")
 async def get_user_ids() -> List[str]:
@@ -160,6 +387,17 @@ async def get_posts(user_id: str):
         print("Error loading posts:", e)
         raise HTTPException(status_code=404, detail=f"Post data for user {user_id} not found.")
 
+# Get change point probabilities for user
+@app.get("/api/cp-probabilities/{user_id}")
+async def get_cp_probabilities(user_id: str):
+    try:
+        with open(os.path.join(settings.data_dir, f"{user_id}_cp_probabilities.json")) as f:
+            cp_probabilities = json.load(f)
+        return cp_probabilities
+    except Exception as e:
+        print("Error loading change point probabilities:", e)
+        raise HTTPException(status_code=404, detail=f"Change point probabilities for user {user_id} not found.")
+
 # Get timelines of interest for user
 @app.get("/api/timelines-of-interest/{user_id}")
 async def get_timelines_of_interest(user_id: str):
@@ -191,8 +429,22 @@ async def save_user_data(req: SaveDataRequest):
             json.dump(posts, f, indent=4)
         
         # Save timelines to json
-        with open(os.path.join(settings.data_dir, f"{patient_id}_timelines.json"), "w") as f:
-            json.dump(timelines, f, indent=4)
+        with timelines_lock(patient_id):
+            with open(os.path.join(settings.data_dir, f"{patient_id}_timelines.json"), "w") as f:
+                json.dump(timelines, f, indent=4)
+
+        # Save the detector checkpoint of the session, if the detection ran. It is copied next to the
+        # timelines first and then moved into place, so that the saved checkpoint is never partial
+        if os.path.exists(session_checkpoint_path(session_id)):
+            checkpoint_path = os.path.join(settings.data_dir, f"{patient_id}_detector.npz")
+            shutil.copyfile(session_checkpoint_path(session_id), checkpoint_path + ".tmp")
+            os.replace(checkpoint_path + ".tmp", checkpoint_path)
+            remove_session_checkpoint(session_id)
+
+        # Save change point probabilities to json, if they were computed
+        if "cp_probabilities" in currently_processing_data[session_id]:
+            with open(os.path.join(settings.data_dir, f"{patient_id}_cp_probabilities.json"), "w") as f:
+                json.dump(cp_probabilities_to_json(currently_processing_data[session_id]["cp_probabilities"]), f)
         
         # Update user_ids.json
         with open(os.path.join(settings.data_dir, "user_ids.json")) as f:
@@ -217,6 +469,7 @@ async def delete_session(req: SaveDataRequest):
     session_id = req.session_id
     if session_id in currently_processing_data:
         del currently_processing_data[session_id]
+        remove_session_checkpoint(session_id)
         print(f"Deleted session data for session {session_id} without saving.")
         return {"message": "Session data deleted successfully"}
     else:
@@ -249,69 +502,196 @@ async def get_summary(
 
 # Delete timeline summary for user
 @app.delete("/api/summary")
-async def delete_summary(
+def delete_summary(
         user_id:str = Query(...),
         timeline_id:str = Query(...),
         model_name:str = Query(...)
     ):
     print(f"Deleting summary for user: {user_id}, timeline: {timeline_id}, model: {model_name}")
     try:
-        with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json")) as f:
-            timelines = json.load(f)
-        
-        if timeline_id not in timelines:
-            raise HTTPException(status_code=404, detail=f"Timeline {timeline_id} not found for user {user_id}.")
-        
-        timeline = timelines[timeline_id]
-        summary_key = f"summary_{model_name}"
-        if summary_key in timeline:
-            del timeline[summary_key]
-            with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json"), "w") as f:
-                json.dump(timelines, f, indent=4)
-            return {"message": "Summary deleted successfully"}
-        else:
-            raise HTTPException(status_code=404, detail=f"Summary for model {model_name} not found in timeline {timeline_id}.")
+        with timelines_lock(user_id):
+            with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json")) as f:
+                timelines = json.load(f)
+            
+            if timeline_id not in timelines:
+                raise HTTPException(status_code=404, detail=f"Timeline {timeline_id} not found for user {user_id}.")
+            
+            timeline = timelines[timeline_id]
+            summary_key = f"summary_{model_name}"
+            if summary_key in timeline:
+                del timeline[summary_key]
+                with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json"), "w") as f:
+                    json.dump(timelines, f, indent=4)
+                return {"message": "Summary deleted successfully"}
+            else:
+                raise HTTPException(status_code=404, detail=f"Summary for model {model_name} not found in timeline {timeline_id}.")
     except Exception as e:
         print("Error deleting summary:", e)
         raise HTTPException(status_code=404, detail=f"Timeline data for user {user_id} not found.")
 
-# Generate a summary
-@app.put("/api/generate-summary")
-def generate_summary(req: GenerationRequest):
-    user_id = req.user_id
-    posts_ids = req.posts_ids
-    model_name = req.model_name
-
+# Create the summary of the posts of a timeline and store it in the timeline json of the user.
+# Summaries of the same posts with the same model and prompts are taken from the summary cache.
+# Runs in the worker of the summary job queue. With cached_only, only cached summaries are stored and
+# None is returned otherwise, so that it can run outside of the queue
+def summarise_timeline(user_id: str, posts_ids: List[str], model_name: str, on_text=None,
+                       cached_only: bool = False) -> Optional[str]:
     # load json with posts for user
     with open(os.path.join(settings.data_dir, f"{user_id}_posts.json")) as f:
         posts = json.load(f)
     
-    with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json")) as f:
-        timelines = json.load(f)
-    
     filtered_posts = [f"{posts[id]['title']} {posts[id]['body']}" for id in posts_ids]
 
-    # create summary
-    summary = app.state.summariser.run_summary(
-            model_name=model_name,
-            posts=filtered_posts,
-        )
+    if model_name not in app.state.summariser.gen_paras:
+        raise ValueError(f"Unknown model {model_name}.")
+    cache_key = summary_cache_key(model_name, app.state.summariser.gen_paras[model_name], filtered_posts)
+    summary = app.state.summary_cache.get(cache_key)
+    if summary is None:
+        if cached_only:
+            return None
+        # create summary
+        summary = app.state.summariser.run_summary(
+                model_name=model_name,
+                posts=filtered_posts,
+                on_text=on_text,
+            )
+        app.state.summary_cache.put(cache_key, summary, model_name=model_name)
+    elif on_text is not None:
+        on_text(0, summary)
     
     # create timeline id from post_ids
     timeline_id = f"{posts_ids[0]}-{posts_ids[-1]}"
 
-    # check if timeline_id is in the timelines
-    if timeline_id not in timelines:
-        timelines[timeline_id] = {
-            "timeline_of_interest": False,
-            "posts": posts_ids,
-            f"summary_{app.state.summariser.model_name}": summary
-        }
-    else:
-        timelines[timeline_id][f"summary_{app.state.summariser.model_name}"] = summary
+    # Load the timelines after the summary was created, so that changes made in the meantime are kept
+    with timelines_lock(user_id):
+        with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json")) as f:
+            timelines = json.load(f)
 
-    # save timeline json for user
-    with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json"), "w") as f:
-        json.dump(timelines, f, indent=4)
+        # check if timeline_id is in the timelines
+        if timeline_id not in timelines:
+            timelines[timeline_id] = {
+                "timeline_of_interest": False,
+                "posts": posts_ids,
+                f"summary_{model_name}": summary
+            }
+        else:
+            timelines[timeline_id][f"summary_{model_name}"] = summary
+
+        # save timeline json for user
+        with open(os.path.join(settings.data_dir, f"{user_id}_timelines.json"), "w") as f:
+            json.dump(timelines, f, indent=4)
     
-    return {"message": "Summary generated successfully"}
\ No newline at end of file
+    return summary
+
+# Run a job of the summary job queue, streaming the generated text of streamed jobs
+def run_summary_job(job) -> str:
+    on_text = None
+    if job.events is not None:
+        on_text = lambda step, text: job.emit("text", (step, text))
+    return summarise_timeline(job.user_id, job.posts_ids, job.model_name, on_text=on_text)
+
+# Generate a summary and wait for it. The summary goes through the job queue as well,
+# so that only one summary runs on the GPU at a time. The request awaits the job without
+# holding a thread of the threadpool, so that waiting requests do not block other endpoints
+@app.put("/api/generate-summary")
+async def generate_summary(req: GenerationRequest):
+    try:
+        # cached summaries do not need to wait for the queue
+        summary = await asyncio.to_thread(summarise_timeline, req.user_id, req.posts_ids, req.model_name,
+                                          cached_only=True)
+        if summary is not None:
+            return {"message": "Summary generated successfully"}
+        job = app.state.summary_jobs.submit(req.user_id, req.posts_ids, req.model_name)
+        await asyncio.wrap_future(job.future)
+    except Exception as e:
+        print("Error generating summary:", e)
+        raise HTTPException(status_code=500, detail="Error generating summary.")
+    
+    return {"message": "Summary generated successfully"}
+
+# Queue a summary, returns the job id immediately
+@app.post("/api/summary-jobs")
+async def submit_summary_job(req: SummaryJobRequest):
+    try:
+        job = app.state.summary_jobs.submit(req.user_id, req.posts_ids, req.model_name, priority=req.priority)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return app.state.summary_jobs.get(job.job_id)
+
+# Format a server-sent event
+def server_sent_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Generate a summary and stream it as server-sent events while it is generated:
+# "queued" (job id and position), "running", "token" (text of a generation step, where the steps are
+# the generation calls of the prompt stages, e.g. post-level then timeline-level), and finally "done"
+# (the complete summary), "error" or "cancelled". The summary is stored in the timeline json when it is
+# complete, also if the client disconnects before, but the stream stops following it then. A cached summary is sent as one "token" and "done"
+# right away, without a job.
+@app.post("/api/summary-stream")
+def stream_summary(req: SummaryJobRequest, request: Request):
+    try:
+        summary = summarise_timeline(req.user_id, req.posts_ids, req.model_name, cached_only=True)
+    except Exception as e:
+        print("Error generating summary:", e)
+        raise HTTPException(status_code=500, detail="Error generating summary.")
+    if summary is not None:
+        def cached_events():
+            yield server_sent_event("token", {"step": 0, "text": summary})
+            yield server_sent_event("done", {"job_id": None, "summary": summary, "cached": True})
+        return StreamingResponse(cached_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    try:
+        job = app.state.summary_jobs.submit(req.user_id, req.posts_ids, req.model_name, priority=req.priority,
+                                            stream=True)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    # The events are awaited in a thread with a timeout, so that a thread is only held for a second at a
+    # time instead of until the job finishes, and the stream ends soon after the client disconnects
+    async def events():
+        queued = app.state.summary_jobs.get(job.job_id)
+        yield server_sent_event("queued", {"job_id": job.job_id, "position": queued["position"] if queued else None})
+        while True:
+            if await request.is_disconnected():
+                print(f"Client disconnected from the stream of summary job {job.job_id}.")
+                break
+            try:
+                event, data = await asyncio.to_thread(job.events.get, timeout=1)
+            except queue.Empty:
+                continue
+            if event == "text":
+                step, text = data
+                yield server_sent_event("token", {"step": step, "text": text})
+            elif event == "running":
+                yield server_sent_event("running", {"job_id": job.job_id})
+            else:
+                payload = {"job_id": job.job_id}
+                if event == "done":
+                    payload["summary"] = data
+                elif event == "error":
+                    payload["error"] = data
+                yield server_sent_event(event, payload)
+                break
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Status of a summary job: "queued" (with its position in the queue, 0 runs next), "running",
+# "done" (with the summary), "failed" (with the error) or "cancelled"
+@app.get("/api/summary-jobs/{job_id}")
+async def get_summary_job(job_id: str):
+    job = app.state.summary_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Summary job {job_id} not found.")
+    return job
+
+# Summary jobs, optionally only those of a user
+@app.get("/api/summary-jobs")
+async def list_summary_jobs(user_id: Union[str, None] = Query(None)):
+    return app.state.summary_jobs.list_jobs(user_id)
+
+# Cancel a queued summary job
+@app.delete("/api/summary-jobs/{job_id}")
+async def cancel_summary_job(job_id: str):
+    if not app.state.summary_jobs.cancel(job_id):
+        raise HTTPException(status_code=400, detail=f"Summary job {job_id} is not queued.")
+    return {"message": "Summary job cancelled"}
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+
+# Digest of the generation parameters of a model: the prompts loaded from its yaml files, max_tokens and
+# temperatures (see timeline_summary.prepare_generation_parameters). Changing a prompt changes the digest,
+# so the summaries created with the old prompts are no longer found
+def generation_parameters_digest(generation_parameters) -> str:
+    serialized = json.dumps(generation_parameters, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+# Content address of a summary: the model, its generation parameters and the "title body" texts of the posts
+def summary_cache_key(model_name: str, generation_parameters, texts: List[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps([model_name, generation_parameters_digest(generation_parameters)]).encode())
+    for text in texts:
+        # length prefixed, so that the texts cannot run into each other
+        encoded = text.encode()
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+# Persistent cache of summaries, one json file per summary in cache_dir, so that the same posts are not
+# summarised again with the same model and prompts, e.g. for timelines with the same posts or after a summary
+# was deleted and is generated again. The least recently used summaries are evicted once the files take up
+# more than max_bytes. The modification times of the files keep the order of use across restarts.
+class SummaryCache():
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024**2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # sizes of the cached files by key, least recently used first
+        self.sizes = {}
+        self.total_bytes = 0
+        entries = []
+        for file_name in os.listdir(cache_dir):
+            if not file_name.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            entries.append((stat.st_mtime, file_name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.sizes[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key not in self.sizes:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key)) as f:
+                    summary = json.load(f)["summary"]
+                os.utime(self._path(key))
+            except (OSError, ValueError, KeyError):
+                # the file was removed or is corrupt, treat it as a miss
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.sizes[key] = self.sizes.pop(key)
+            self.hits += 1
+            return summary
+
+    def put(self, key: str, summary: str, model_name: Optional[str] = None):
+        entry = json.dumps({"model_name": model_name, "created_at": time.time(), "summary": summary})
+        with self.lock:
+            # write to a temporary file first, so that a crash does not leave a partial summary behind
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(entry)
+            os.replace(tmp_path, self._path(key))
+            self.total_bytes -= self.sizes.pop(key, 0)
+            self.sizes[key] = os.path.getsize(self._path(key))
+            self.total_bytes += self.sizes[key]
+            self._evict()
+
+    def _remove(self, key: str):
+        self.total_bytes -= self.sizes.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.sizes and self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.sizes)))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.sizes),
+                "used_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.sizes):
+                self._remove(key)
@@ -0,0 +1,165 @@
+from concurrent.futures import Future
+import heapq
+import itertools
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+# Statuses of a summary job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class SummaryJob():
+    def __init__(self, job_id: str, user_id: str, posts_ids: list, model_name: str, priority: int,
+                 stream: bool = False):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.posts_ids = posts_ids
+        self.model_name = model_name
+        self.priority = priority
+        self.status = QUEUED
+        self.summary = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.sequence = None
+        # Resolved with the summary once the job is done, e.g. to wait for it
+        self.future = Future()
+        # For streamed jobs, the (event, data) tuples of the job: ("running", None) when it starts,
+        # ("text", (step, text)) while the summary is generated, then ("done", summary), ("error", message) or ("cancelled", None)
+        self.events = queue.Queue() if stream else None
+
+    def emit(self, event: str, data=None):
+        if self.events is not None:
+            self.events.put((event, data))
+
+    def to_dict(self, position: Optional[int] = None) -> dict:
+        job = {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "timeline_id": f"{self.posts_ids[0]}-{self.posts_ids[-1]}" if self.posts_ids else None,
+            "model_name": self.model_name,
+            "priority": self.priority,
+            "status": self.status,
+            "position": position,
+        }
+        if self.status == DONE:
+            job["summary"] = self.summary
+        if self.status == FAILED:
+            job["error"] = self.error
+        return job
+
+
+# Queue of summary jobs, drained by a single worker thread, since all jobs share one model on the GPU.
+# Jobs with a lower priority value run first, jobs of the same priority in the order they were submitted.
+class SummaryJobQueue():
+    def __init__(self, run_job: Callable[[SummaryJob], str], max_finished_jobs: int = 1000):
+        # run_job(job) creates and stores the summary of a job and returns it
+        self.run_job = run_job
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.finished = []
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.worker = threading.Thread(target=self._work, name="summary-worker", daemon=True)
+        self.worker.start()
+
+    def submit(self, user_id: str, posts_ids: list, model_name: str, priority: int = 0,
+               stream: bool = False) -> SummaryJob:
+        job = SummaryJob(str(uuid.uuid4()), user_id, posts_ids, model_name, priority, stream=stream)
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("The summary job queue has been shut down.")
+            self.jobs[job.job_id] = job
+            job.sequence = next(self.counter)
+            heapq.heappush(self.queue, (priority, job.sequence, job.job_id))
+            self.condition.notify()
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return job.to_dict(self._position(job))
+
+    def list_jobs(self, user_id: Optional[str] = None) -> list:
+        with self.condition:
+            return [job.to_dict(self._position(job)) for job in self.jobs.values()
+                    if user_id is None or job.user_id == user_id]
+
+    def cancel(self, job_id: str) -> bool:
+        # Only queued jobs can be cancelled, a running job finishes
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != QUEUED:
+                return False
+            self.queue = [entry for entry in self.queue if entry[2] != job_id]
+            heapq.heapify(self.queue)
+            job.status = CANCELLED
+            job.future.cancel()
+            job.emit("cancelled")
+            self._finish(job)
+            return True
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            for _, _, job_id in self.queue:
+                self.jobs[job_id].status = CANCELLED
+                self.jobs[job_id].future.cancel()
+                self.jobs[job_id].emit("cancelled")
+            self.queue = []
+            self.condition.notify_all()
+        self.worker.join()
+
+    # Position in the queue, 0 for the job that runs next (None if not queued)
+    def _position(self, job: SummaryJob) -> Optional[int]:
+        if job.status != QUEUED:
+            return None
+        return sum(1 for priority, sequence, _ in self.queue if (priority, sequence) < (job.priority, job.sequence))
+
+    # Keep the finished jobs for polling, evicting the oldest ones
+    def _finish(self, job: SummaryJob):
+        job.finished_at = time.time()
+        self.finished.append(job.job_id)
+        while len(self.finished) > self.max_finished_jobs:
+            self.jobs.pop(self.finished.pop(0), None)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                _, _, job_id = heapq.heappop(self.queue)
+                job = self.jobs[job_id]
+                job.status = RUNNING
+            job.emit("running")
+
+            try:
+                summary = self.run_job(job)
+            except Exception as e:
+                print(f"Error running summary job {job.job_id}:", e)
+                with self.condition:
+                    job.status = FAILED
+                    job.error = str(e)
+                    self._finish(job)
+                job.future.set_exception(e)
+                job.emit("error", str(e))
+            else:
+                with self.condition:
+                    job.status = DONE
+                    job.summary = summary
+                    self._finish(job)
+                job.future.set_result(summary)
+                job.emit("done", summary)
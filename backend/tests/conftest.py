@@ -0,0 +1,163 @@
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+# The backend modules are imported from the backend directory, as when running main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def main_module(tmp_path, monkeypatch):
+    """
+    main.py with its data_dir in tmp_path and no sessions. main.py imports the summarisation models
+    (timeline_summary.py), so the tests using it are skipped where those are not installed.
+    """
+    monkeypatch.setenv("HF_TOKEN", "test")
+    monkeypatch.setenv("CACHE_DIR", str(tmp_path / "hf_cache"))
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    main = pytest.importorskip("main")
+
+    monkeypatch.setattr(main.settings, "data_dir", str(tmp_path))
+    monkeypatch.setattr(main.settings, "summary_cache_dir", None)
+    monkeypatch.setattr(main.settings, "timeline_workers", 1)
+    monkeypatch.setattr(main, "currently_processing_data", {})
+    monkeypatch.setattr(main, "timelines_locks", {})
+    main.ANCHOR_POINT_CACHE.clear()
+    with open(tmp_path / "user_ids.json", "w") as f:
+        json.dump({"ids": []}, f)
+    yield main
+    main.ANCHOR_POINT_CACHE.clear()
+
+
+@pytest.fixture
+def client(main_module):
+    """TestClient of the app of main.py, running its lifespan (timeline workers, summary job queue)"""
+    from fastapi.testclient import TestClient
+
+    with TestClient(main_module.app) as client:
+        yield client
+
+
+@pytest.fixture
+def example_posts():
+    """Returns the posts of a user over about 300 days, whose posting rate changes halfway"""
+    def example_posts(author="user_a", n_posts=150, seed=0):
+        rng = np.random.default_rng(seed)
+        days = np.sort(np.concatenate([rng.choice(150, n_posts // 6),
+                                       150 + rng.choice(150, n_posts - n_posts // 6)]))
+        return [{"author": author, "id": f"{author}_{i}", "created_utc": 1577836800 + int(day) * 86400 + i,
+                 "title": f"title {i}", "selftext": f"body {i}"}
+                for i, day in enumerate(days)]
+
+    return example_posts
+
+
+@pytest.fixture
+def upload_posts(client):
+    """Uploads posts as a pickle and returns the session id"""
+    def upload_posts(posts) -> str:
+        response = client.post("/api/upload-user-data", files={"file": ("posts.p", pickle.dumps(posts))})
+        assert response.status_code == 200
+        return response.json()["session_id"]
+
+    return upload_posts
+
+
+class StubSummariser:
+    """
+    Stands in for the ModelHandler of main.py: the summary of posts is their texts joined with "|", streamed as
+    one text per post. If release is given (a threading.Event), each summary waits for it first.
+    """
+    def __init__(self, release=None):
+        self.gen_paras = {"stub-model": [("prompt", 100, 0.1)]}
+        self.release = release
+        self.calls = []
+
+    def run_summary(self, model_name, posts, on_text=None):
+        self.calls.append(list(posts))
+        if self.release is not None:
+            assert self.release.wait(timeout=30)
+        if on_text is not None:
+            for step, post in enumerate(posts):
+                on_text(step, post)
+        return "|".join(posts)
+
+    def stats(self):
+        return {}
+
+    def cleanup(self, model_name=None):
+        pass
+
+
+@pytest.fixture
+def summariser(client):
+    """A StubSummariser in place of the app's ModelHandler"""
+    summariser = StubSummariser()
+    client.app.state.summariser = summariser
+    return summariser
+
+
+@pytest.fixture
+def saved_user(main_module):
+    """Saves the posts and the timelines json of the user "user_a" with 6 posts, and returns the user id"""
+    posts = {f"p{i}": {"title": f"title {i}", "body": f"body {i}", "created_utc": 1577836800 + i * 86400,
+                       "label": ["0"]}
+             for i in range(6)}
+    timelines = {"p0-p2": {"timeline_of_interest": True, "posts": ["p0", "p1", "p2"]},
+                 "p3-p5": {"timeline_of_interest": True, "posts": ["p3", "p4", "p5"]}}
+    with open(os.path.join(main_module.settings.data_dir, "user_a_posts.json"), "w") as f:
+        json.dump(posts, f)
+    with open(os.path.join(main_module.settings.data_dir, "user_a_timelines.json"), "w") as f:
+        json.dump(timelines, f)
+    return "user_a"
+
+
+class StubRunJob:
+    """
+    Stands in for run_summary_job of main.py: streams the texts, then returns their concatenation or raises
+    error. If release is set (a threading.Event), each job waits for it after it started running.
+    """
+    def __init__(self, texts=("first", "second"), error=None):
+        self.texts = texts
+        self.error = error
+        self.release = None
+        self.jobs = []
+
+    def __call__(self, job):
+        self.jobs.append(job)
+        if self.release is not None:
+            assert self.release.wait(timeout=30)
+        for step, text in enumerate(self.texts):
+            job.emit("text", (step, text))
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return "".join(self.texts)
+
+
+@pytest.fixture
+def run_job(client, summariser):
+    """A StubRunJob running the jobs of a new summary job queue of the app"""
+    from summary_jobs import SummaryJobQueue
+
+    run_job = StubRunJob()
+    client.app.state.summary_jobs.shutdown()
+    client.app.state.summary_jobs = SummaryJobQueue(run_job)
+    return run_job
+
+
+def server_sent_events(body: str) -> list:
+    """Returns the (event, data) pairs of a text/event-stream body"""
+    events = []
+    for message in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+@pytest.fixture
+def parse_events():
+    return server_sent_events
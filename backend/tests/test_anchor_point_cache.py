@@ -0,0 +1,65 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from timeline_generation.anchor_point_cache import AnchorPointCache, anchor_point_cache_key, fingerprint_daily_series
+from timeline_generation.entry_point_for_dashboard import create_timeline_for_dashboard
+
+
+def daily_series(counts, first_day="2020-01-01"):
+    return pd.DataFrame({"posts": counts}, index=pd.date_range(first_day, periods=len(counts), freq="D"))
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnchorPointCache(max_entries=2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a").tolist() == [1]
+    cache.put("c", [3])
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a").tolist() == [1]
+    assert cache.get("c").tolist() == [3]
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cached_anchor_points_are_copies():
+    cache = AnchorPointCache()
+    anchor_points = np.array([1, 2])
+    cache.put("a", anchor_points)
+    anchor_points[0] = 5
+    cache.get("a")[1] = 7
+    assert cache.get("a").tolist() == [1, 2]
+
+
+def test_fingerprint_changes_with_the_series():
+    counts = [0, 3, 1, 0, 2]
+    fingerprint = fingerprint_daily_series(daily_series(counts))
+    assert fingerprint_daily_series(daily_series(list(counts))) == fingerprint
+
+    assert fingerprint_daily_series(daily_series([0, 3, 1, 0, 3])) != fingerprint
+    assert fingerprint_daily_series(daily_series(counts + [0])) != fingerprint
+    assert fingerprint_daily_series(daily_series(counts, first_day="2020-01-02")) != fingerprint
+    assert fingerprint_daily_series(daily_series(counts).rename(columns={"posts": "words"})) != fingerprint
+
+    key = anchor_point_cache_key(daily_series(counts), method="bocpd", hazard=100)
+    assert anchor_point_cache_key(daily_series(counts), hazard=100, method="bocpd") == key
+    assert anchor_point_cache_key(daily_series(counts), method="bocpd", hazard=1000) != key
+
+
+def test_checkpoint_is_written_when_the_anchor_points_are_cached(tmp_path):
+    rng = np.random.default_rng(0)
+    days = np.sort(rng.choice(200, 150)) + np.repeat([0, 100], 75)
+    posts = [{"id": str(i), "created_utc": 1577836800 + int(day) * 86400, "title": "", "selftext": ""}
+             for i, day in enumerate(days)]
+    cache = AnchorPointCache()
+    with contextlib.redirect_stdout(io.StringIO()):
+        timelines = create_timeline_for_dashboard(posts, hazard=100, anchor_point_cache=cache)
+        checkpoint_path = str(tmp_path / "detector.npz")
+        assert create_timeline_for_dashboard(posts, hazard=100, anchor_point_cache=cache,
+                                             checkpoint_path=checkpoint_path) == timelines
+    assert os.path.exists(checkpoint_path)
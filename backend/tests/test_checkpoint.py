@@ -0,0 +1,69 @@
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timeline_generation.anchor_points.bocpd.poisson_gamma.checkpoint import CheckpointError, load_detector_state
+from timeline_generation.anchor_points.bocpd.poisson_gamma.extract_change_points import (
+    return_cps_from_bocpd_poisson_gamma_checkpoint, return_cps_from_bocpd_poisson_gamma_user_feature_data)
+
+
+def feature_series(T=120, seed=0):
+    rng = np.random.default_rng(seed)
+    rates = np.repeat([0.2, 4, 1], [T // 3, T // 3, T - 2 * (T // 3)])
+    return pd.Series(rng.poisson(rates), index=pd.date_range("2020-01-01", periods=T, freq="D"))
+
+
+def test_checkpoint_resumes_from_a_prefix(tmp_path):
+    path = str(tmp_path / "detector.npz")
+    series = feature_series()
+    return_cps_from_bocpd_poisson_gamma_checkpoint(series[:80], path, 100, 1, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        cps = return_cps_from_bocpd_poisson_gamma_checkpoint(series, path, 100, 1, 1)
+    assert list(cps) == list(return_cps_from_bocpd_poisson_gamma_user_feature_data(series, 100, 1, 1))
+    assert load_detector_state(path)[0].t == len(series)
+
+
+def test_corrupt_checkpoint_is_reported_and_replaced(tmp_path):
+    path = str(tmp_path / "detector.npz")
+    series = feature_series()
+    return_cps_from_bocpd_poisson_gamma_checkpoint(series[:80], path, 100, 1, 1)
+    with open(path, "rb") as f:
+        content = f.read()
+    with open(path, "wb") as f:
+        f.write(content[:len(content) // 2])
+
+    with pytest.raises(CheckpointError):
+        load_detector_state(path)
+    with pytest.warns(RuntimeWarning, match="Ignoring detector checkpoint"):
+        cps = return_cps_from_bocpd_poisson_gamma_checkpoint(series, path, 100, 1, 1)
+    assert list(cps) == list(return_cps_from_bocpd_poisson_gamma_user_feature_data(series, 100, 1, 1))
+    assert load_detector_state(path)[0].t == len(series)
+
+
+def test_checkpoint_of_another_version_is_rejected(tmp_path):
+    path = str(tmp_path / "detector.npz")
+    return_cps_from_bocpd_poisson_gamma_checkpoint(feature_series(), path, 100, 1, 1)
+    with np.load(path) as checkpoint:
+        arrays = dict(checkpoint)
+    config = json.loads(str(arrays["config"]))
+    config["version"] = -1
+    arrays["config"] = np.array(json.dumps(config))
+    np.savez_compressed(path, **arrays)
+
+    with pytest.raises(CheckpointError, match="version"):
+        load_detector_state(path)
+
+
+def test_mismatched_checkpoint_is_run_again(tmp_path):
+    path = str(tmp_path / "detector.npz")
+    series = feature_series()
+    # other priors and another history: the checkpoint loads, but is not used
+    return_cps_from_bocpd_poisson_gamma_checkpoint(feature_series(seed=1), path, 10, 0.5, 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        cps = return_cps_from_bocpd_poisson_gamma_checkpoint(series, path, 100, 1, 1)
+    assert list(cps) == list(return_cps_from_bocpd_poisson_gamma_user_feature_data(series, 100, 1, 1))
@@ -0,0 +1,46 @@
+import contextlib
+import io
+import os
+
+from timeline_generation.entry_point_for_dashboard import (create_timeline_from_cp_probabilities,
+                                                           return_cp_probabilities_for_dashboard)
+from timeline_generation.ingest_posts import ingest_posts
+
+CP_PROBABILITY_REQUEST = {"method": "bocpd", "alpha": 1, "beta": 1, "hazard": 100, "lag": 7}
+
+
+def test_cp_probabilities_and_rethresholding(main_module, client, example_posts, upload_posts):
+    posts = example_posts()
+    session_id = upload_posts(posts)
+    executor = client.app.state.timeline_executor
+    assert executor._mp_context.get_start_method() == "spawn"
+
+    response = client.post("/api/cp-probabilities", json={"session_id": session_id, **CP_PROBABILITY_REQUEST})
+    assert response.status_code == 200
+    # the model ran in a spawned worker process
+    assert executor._processes
+    assert all(pid != os.getpid() for pid in executor._processes)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cp_probabilities = return_cp_probabilities_for_dashboard(ingest_posts(posts), alpha=1, beta=1, hazard=100,
+                                                                 cp_probability_lag=7)
+    assert response.json() == main_module.cp_probabilities_to_json(cp_probabilities)
+
+    for cutoff, span_radius in ((0.5, 7), (0.05, 3)):
+        response = client.post("/api/rethreshold-timelines",
+                               json={"session_id": session_id, "cutoff": cutoff, "span_radius": span_radius})
+        assert response.status_code == 200
+        timelines = create_timeline_from_cp_probabilities(ingest_posts(posts), cp_probabilities, cutoff=cutoff,
+                                                          span_radius=span_radius)
+        assert response.json() == main_module.extract_timelines_of_interest(timelines)
+        assert main_module.currently_processing_data[session_id]["timelines"] == timelines
+    assert response.json()
+
+
+def test_rethresholding_needs_cp_probabilities(client, example_posts, upload_posts):
+    session_id = upload_posts(example_posts())
+    response = client.post("/api/rethreshold-timelines", json={"session_id": session_id, "cutoff": 0.5, "span_radius": 7})
+    assert response.status_code == 400
+
+    response = client.post("/api/cp-probabilities", json={"session_id": "unknown", **CP_PROBABILITY_REQUEST})
+    assert response.status_code == 400
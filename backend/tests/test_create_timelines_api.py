@@ -0,0 +1,30 @@
+import os
+
+TIMELINE_REQUEST = {"method": "bocpd", "alpha": 1, "beta": 1, "hazard": 100, "span_radius": 7}
+
+
+def test_cached_anchor_points_keep_the_session_checkpoint(main_module, client, example_posts, upload_posts):
+    posts = example_posts()
+    session_id = upload_posts(posts)
+    first = client.post("/api/create-timelines", json={"session_id": session_id, **TIMELINE_REQUEST})
+    assert first.status_code == 200
+    assert os.path.exists(main_module.session_checkpoint_path(session_id))
+
+    # only span_radius changed: the anchor points come from the cache
+    hits = main_module.ANCHOR_POINT_CACHE.hits
+    response = client.post("/api/create-timelines",
+                           json={"session_id": session_id, **TIMELINE_REQUEST, "span_radius": 3})
+    assert response.status_code == 200
+    assert main_module.ANCHOR_POINT_CACHE.hits == hits + 1
+
+    # the same posts in a new session: the cached anchor points were not detected for its
+    # checkpoint, so the detection runs and writes it
+    other_session_id = upload_posts(posts)
+    response = client.post("/api/create-timelines", json={"session_id": other_session_id, **TIMELINE_REQUEST})
+    assert response.json() == first.json()
+    assert os.path.exists(main_module.session_checkpoint_path(other_session_id))
+
+    assert client.post("/api/save-user-data", json={"session_id": other_session_id}).status_code == 200
+    assert os.path.exists(os.path.join(main_module.settings.data_dir, "user_a_detector.npz"))
+    assert not os.path.exists(main_module.session_checkpoint_path(other_session_id))
+    client.request("DELETE", "/api/delete-session", json={"session_id": session_id})
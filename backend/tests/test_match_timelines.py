@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from timeline_generation.entry_point_for_dashboard import match_timelines_to_posts, return_posts_by_day
+
+
+def baseline_timeline_posts(unpickled_posts, timelines):
+    # the matching before return_posts_by_day: a list column of post ids on the resampled days
+    posts = pd.DataFrame(unpickled_posts)
+    posts['created_utc'] = pd.to_datetime(posts['created_utc'], unit='s')
+    posts.set_index('created_utc', inplace=True)
+    posts = posts.resample('D').agg({'id': list})
+    return [posts.loc[start:end]["id"].explode().dropna().tolist() for start, end in timelines]
+
+
+def random_posts(rng, n_posts=300, n_days=120):
+    # several posts on most days, in no particular order, and days without posts
+    days = rng.choice(np.arange(n_days) ** 1.2, n_posts).astype(int)
+    created_utc = 1577836800 + days * 86400 + rng.choice(86400, n_posts, replace=False)
+    return [{"id": f"p{i}", "created_utc": int(created)} for i, created in enumerate(rng.permutation(created_utc))]
+
+
+def test_posts_of_a_day_are_in_chronological_order():
+    posts = [{"id": "late", "created_utc": 1577836800 + 80000},
+             {"id": "early", "created_utc": 1577836800 + 10},
+             {"id": "previous_day", "created_utc": 1577836800 - 10}]
+    post_days, post_ids = return_posts_by_day(posts)
+    assert post_ids.tolist() == ["previous_day", "early", "late"]
+    assert post_days.tolist() == [np.datetime64("2019-12-31"), np.datetime64("2020-01-01"), np.datetime64("2020-01-01")]
+
+
+def test_matching_equals_the_resampled_daily_posts():
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        posts = random_posts(rng)
+        first = pd.Timestamp(min(post["created_utc"] for post in posts), unit='s').normalize()
+        last = pd.Timestamp(max(post["created_utc"] for post in posts), unit='s').normalize()
+        starts = rng.integers(-5, (last - first).days + 5, 40)
+        # spans of a single day, spans over empty days and spans beyond the first and last post
+        timelines = [(first + pd.Timedelta(days=int(start)), first + pd.Timedelta(days=int(start + length)))
+                     for start, length in zip(starts, rng.choice([0, 1, 7, 30], 40))]
+        timelines += [(first, first), (last, last), (first - pd.Timedelta(days=3), first),
+                      (last, last + pd.Timedelta(days=3))]
+
+        expected = {}
+        for matched_posts in baseline_timeline_posts(posts, timelines):
+            if matched_posts:
+                expected[f"{matched_posts[0]}-{matched_posts[-1]}"] = {"timeline_of_interest": True,
+                                                                      "posts": matched_posts}
+
+        post_days, post_ids = return_posts_by_day(posts)
+        assert match_timelines_to_posts(post_days, post_ids, timelines) == expected
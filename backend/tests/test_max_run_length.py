@@ -0,0 +1,24 @@
+import numpy as np
+
+from timeline_generation.anchor_points.bocpd.poisson_gamma.extract_change_points import run_poisson_bocpd_detector
+
+
+def test_folded_map_segmentation_matches_unfolded_on_long_segments():
+    # all segments are longer than the window, so their runs end up in the absorbing slot
+    y = np.repeat([0, 5, 1, 12, 3], [70, 60, 80, 50, 45]).reshape(-1, 1)
+    exact = run_poisson_bocpd_detector(y, 100, 1, 1)
+    for max_run_length in (10, 20, 40):
+        folded = run_poisson_bocpd_detector(y, 100, 1, 1, max_run_length=max_run_length)
+        np.testing.assert_array_equal(folded.MAP_traceback(), exact.MAP_traceback())
+
+
+def test_absorbing_slot_keeps_the_true_run_length():
+    y = np.full((100, 1), 3)
+    detector = run_poisson_bocpd_detector(y, 100, 1, 1, max_run_length=10)
+    run_lengths = detector.model_universe[0].retained_run_lengths
+    # r=0,...,9 and the slot, which holds the run that started with the first observation
+    assert run_lengths.shape[0] == 11
+    np.testing.assert_array_equal(run_lengths[:10], np.arange(10))
+    assert run_lengths[-1] == 99
+    # no spurious CPs every max_run_length time points
+    assert detector.MAP_traceback().shape[1] == 1
@@ -0,0 +1,29 @@
+import numpy as np
+
+from timeline_generation.anchor_points.bocpd.poisson_gamma.cp_probability_model import CpModel
+from timeline_generation.anchor_points.bocpd.poisson_gamma.detector import Detector
+from timeline_generation.anchor_points.bocpd.poisson_gamma.mixture_detector import MixturePGDetector
+from timeline_generation.anchor_points.bocpd.poisson_gamma.poisson_gamma_model import PGModel
+
+
+def test_mixture_detector_matches_detector_with_model_universe():
+    rng = np.random.default_rng(2)
+    for _ in range(10):
+        S = int(rng.integers(1, 3))
+        T = int(rng.integers(3, 200))
+        rates = np.repeat(rng.choice([0.1, 1, 5], 6), 40)[:T]
+        y = rng.poisson(rates[:, np.newaxis] * np.ones(S)).astype(float)
+        Q = int(rng.integers(1, 5))
+        alphas = rng.choice([0.01, 0.5, 1, 5], Q)
+        betas = rng.choice([0.1, 1, 0.05], Q)
+
+        models = [PGModel(a * np.ones(S), b * np.ones(S), np.zeros(S), S, 1, capacity=T + 1)
+                  for a, b in zip(alphas, betas)]
+        detector = Detector(y, np.array(models), np.ones(Q) / Q, CpModel(50), S, 1, T, mode='cps_only')
+        for t in range(T):
+            detector.next_run(y[t], t + 1)
+        mixture = MixturePGDetector(y, CpModel(50), alphas, betas)
+        mixture.run()
+
+        np.testing.assert_array_equal(detector.MAP_traceback(), mixture.MAP_traceback())
+        np.testing.assert_array_equal(detector.storage_log_evidence, mixture.storage_log_evidence)
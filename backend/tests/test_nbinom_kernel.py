@@ -0,0 +1,37 @@
+import numpy as np
+from scipy import stats
+from scipy.special import gammaln, log1p
+
+from timeline_generation.anchor_points.bocpd.poisson_gamma.cp_probability_model import CpModel
+from timeline_generation.anchor_points.bocpd.poisson_gamma.poisson_gamma_model import PGModel, nbinom_log_pmf
+
+
+def test_nbinom_log_pmf_matches_scipy():
+    rng = np.random.default_rng(0)
+    size = rng.uniform(1e-3, 50, size=2000)
+    prob = rng.uniform(1e-3, 1 - 1e-3, size=2000)
+    # counts including zeros and large counts
+    y = np.concatenate([np.zeros(500), rng.integers(1, 20, size=1000), rng.integers(1000, 10**6, size=500)])
+
+    log_pmf = nbinom_log_pmf(y, size, np.log(prob), log1p(-prob), gammaln(y + 1))
+
+    np.testing.assert_allclose(log_pmf, stats.nbinom.logpmf(y, size, prob), rtol=1e-9, atol=1e-9)
+
+
+def test_predictive_log_distribution_matches_scipy():
+    rng = np.random.default_rng(1)
+    for prior_alpha, prior_beta in [(0.01, 0.1), (1.0, 1.0), (0.5, 2.0), (20.0, 0.05)]:
+        model = PGModel(np.array([prior_alpha]), np.array([prior_beta]), np.array([0.0]), 1, 1)
+        observations = np.concatenate([[0, 0, 3], rng.poisson(4, size=30), [0, 0, 0, 250, 5000]]).astype(float)
+        model.initialization(observations[0], CpModel(100), 1)
+
+        for t, y in enumerate(observations[1:], start=1):
+            log_densities = model.evaluate_predictive_log_distribution(np.array([y]), t)
+
+            # Predictive of run-length r: NB(y | alpha + (r+1) * mean_r, 1 - 1 / (beta + r + 2))
+            factors = model.retained_run_lengths + 1
+            size = prior_alpha + factors * model.means[:, 0, 0]
+            prob = 1 - 1 / (prior_beta + factors + 1)
+            np.testing.assert_allclose(log_densities, stats.nbinom.logpmf(y, size, prob), rtol=1e-9, atol=1e-9)
+
+            model.update_predictive_distributions(np.array([y]), t)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from timeline_generation.anchor_points.cusum.poisson_cusum import poisson_cusum_windows
+from timeline_generation.generate_anchor_points import prefilter_recall_report
+
+
+def test_flat_series_has_no_windows():
+    assert poisson_cusum_windows(np.full(200, 2)) == []
+    assert poisson_cusum_windows(np.zeros(200)) == []
+    assert poisson_cusum_windows(np.full((200, 2), 3)) == []
+
+
+def test_overlapping_windows_are_merged():
+    counts = np.ones(200)
+    counts[50:53] = 8
+    counts[120:123] = 8
+    separate = poisson_cusum_windows(counts, margin=0, baseline=1)
+    assert len(separate) == 2
+    assert separate[0][0] <= 50 and separate[1][0] <= 120
+
+    # with the margins, the windows of both bursts overlap
+    merged = poisson_cusum_windows(counts, margin=30, baseline=1)
+    assert merged == [(separate[0][0] - 30, separate[1][1] + 30)]
+
+
+def test_margins_are_clipped_to_the_series():
+    counts = np.ones(200)
+    counts[10:13] = 8
+    counts[-3:] = 8
+    windows = poisson_cusum_windows(counts, margin=20, baseline=1)
+    assert windows[0][0] == 0
+    assert windows[-1][1] == 200
+    assert all(0 <= start < stop <= 200 for start, stop in windows)
+
+
+def test_prefilter_recall_report():
+    rng = np.random.default_rng(0)
+    index = pd.date_range("2020-01-01", periods=300, freq="D")
+    users_data = {
+        "flat": pd.DataFrame({"posts": np.full(300, 2)}, index=index),
+        "change": pd.DataFrame({"posts": rng.poisson(np.repeat([0.5, 6], 150))}, index=index),
+    }
+    report = prefilter_recall_report(users_data)
+
+    # the flat user is not run through the model at all
+    assert report["users"]["flat"]["screened_fraction"] == 0.0
+    assert len(report["users"]["flat"]["prefiltered"]) == 0
+    assert report["users"]["flat"]["recall"] == 1.0
+
+    change = report["users"]["change"]
+    assert len(change["full"]) > 0
+    assert np.min(np.abs(change["full"] - 150)) <= 3
+    assert change["recall"] == 1.0
+    assert report["recall"] == 1.0
+    assert report["screened_fraction"] == change["screened_fraction"] / 2
@@ -0,0 +1,63 @@
+import numpy as np
+
+from timeline_generation.anchor_points.bocpd.poisson_gamma.run_length_buffer import RunLengthBuffer
+
+
+def test_prepend_grows_and_keeps_order():
+    buffer = RunLengthBuffer(capacity=4)
+    buffer.assign([1.0, 2.0])
+    expected = [1.0, 2.0]
+    for value in range(3, 40):
+        buffer.prepend(value)
+        expected.insert(0, value)
+        np.testing.assert_array_equal(buffer.view(), expected)
+    assert len(buffer) == len(expected)
+
+
+def test_prepend_shifts_when_half_empty():
+    buffer = RunLengthBuffer(capacity=16)
+    buffer.assign(np.arange(16.0))
+    buffer.truncate(3)
+    data = buffer.data
+    buffer.prepend(-1)
+    # the entries were shifted to the end of the same block instead of growing it
+    assert buffer.data is data
+    np.testing.assert_array_equal(buffer.view(), [-1, 0, 1, 2])
+
+
+def test_view_modifies_buffer_in_place():
+    buffer = RunLengthBuffer()
+    buffer.assign(np.zeros((3, 2, 1)))
+    view = buffer.view()
+    view += 1
+    np.testing.assert_array_equal(buffer.view(), np.ones((3, 2, 1)))
+
+
+def test_keep_and_truncate():
+    buffer = RunLengthBuffer(dtype=int)
+    buffer.assign(np.arange(10))
+    buffer.keep(np.arange(10) % 3 == 0)
+    np.testing.assert_array_equal(buffer.view(), [0, 3, 6, 9])
+    buffer.truncate(2)
+    np.testing.assert_array_equal(buffer.view(), [0, 3])
+    buffer.truncate(5)
+    np.testing.assert_array_equal(buffer.view(), [0, 3])
+    buffer.prepend(-1)
+    np.testing.assert_array_equal(buffer.view(), [-1, 0, 3])
+
+
+def test_prepend_block():
+    buffer = RunLengthBuffer(capacity=2)
+    buffer.assign([5.0])
+    buffer.prepend_block([1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_array_equal(buffer.view(), [1, 2, 3, 4, 5])
+    buffer.prepend_block(np.arange(40.0))
+    np.testing.assert_array_equal(buffer.view(), np.r_[np.arange(40.0), 1, 2, 3, 4, 5])
+
+
+def test_assign_none_empties():
+    buffer = RunLengthBuffer()
+    assert buffer.view() is None
+    buffer.assign([1.0])
+    buffer.assign(None)
+    assert buffer.view() is None and len(buffer) == 0
@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+
+import anyio
+
+GENERATION_REQUEST = {"user_id": "user_a", "posts_ids": ["p0", "p1", "p2"], "model_name": "stub-model"}
+
+
+def saved_timelines(main_module):
+    with open(os.path.join(main_module.settings.data_dir, "user_a_timelines.json")) as f:
+        return json.load(f)
+
+
+def test_generate_summary_stores_and_caches_the_summary(main_module, client, summariser, saved_user):
+    response = client.put("/api/generate-summary", json=GENERATION_REQUEST)
+    assert response.status_code == 200
+    assert saved_timelines(main_module)["p0-p2"]["summary_stub-model"] == "title 0 body 0|title 1 body 1|title 2 body 2"
+
+    # the second request is answered from the summary cache, without running the model
+    client.delete("/api/summary", params={"user_id": "user_a", "timeline_id": "p0-p2", "model_name": "stub-model"})
+    assert "summary_stub-model" not in saved_timelines(main_module)["p0-p2"]
+    assert client.put("/api/generate-summary", json=GENERATION_REQUEST).status_code == 200
+    assert len(summariser.calls) == 1
+    assert saved_timelines(main_module)["p0-p2"]["summary_stub-model"] == "title 0 body 0|title 1 body 1|title 2 body 2"
+
+
+def test_generate_summary_errors(client, summariser, saved_user):
+    response = client.put("/api/generate-summary", json={**GENERATION_REQUEST, "model_name": "unknown"})
+    assert response.status_code == 500
+
+
+def test_waiting_requests_do_not_hold_threads(client, summariser, saved_user):
+    # two threads for the sync endpoints, fewer than the waiting requests
+    def limit_threads():
+        anyio.to_thread.current_default_thread_limiter().total_tokens = 2
+    client.portal.call(limit_threads)
+
+    release = threading.Event()
+    summariser.release = release
+    responses = []
+    requests = [threading.Thread(target=lambda: responses.append(client.put("/api/generate-summary",
+                                                                            json=GENERATION_REQUEST)))
+                for _ in range(3)]
+    for request in requests:
+        request.start()
+
+    # while the requests wait for the summary job, a sync endpoint still gets a thread
+    deletion = threading.Thread(target=lambda: responses.append(client.delete(
+        "/api/summary", params={"user_id": "user_a", "timeline_id": "p3-p5", "model_name": "stub-model"})))
+    deletion.start()
+    deletion.join(timeout=10)
+    assert not deletion.is_alive()
+    assert all(request.is_alive() for request in requests)
+
+    release.set()
+    for request in requests:
+        request.join(timeout=30)
+    assert sorted(response.status_code for response in responses) == [200, 200, 200, 404]
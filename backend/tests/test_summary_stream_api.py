@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+
+import anyio
+
+STREAM_REQUEST = {"user_id": "user_a", "posts_ids": ["p0", "p1", "p2"], "model_name": "stub-model"}
+
+
+def test_stream_events_in_order(client, run_job, saved_user, parse_events):
+    response = client.post("/api/summary-stream", json=STREAM_REQUEST)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_events(response.text)
+    assert [event for event, _ in events] == ["queued", "running", "token", "token", "done"]
+    job_id = events[0][1]["job_id"]
+    assert events[0][1]["position"] in (0, None)
+    assert [data for _, data in events[2:4]] == [{"step": 0, "text": "first"}, {"step": 1, "text": "second"}]
+    assert events[-1][1] == {"job_id": job_id, "summary": "firstsecond"}
+    assert client.get(f"/api/summary-jobs/{job_id}").json()["status"] == "done"
+
+
+def test_stream_reports_errors(client, run_job, saved_user, parse_events):
+    run_job.error = "out of memory"
+    events = parse_events(client.post("/api/summary-stream", json=STREAM_REQUEST).text)
+    assert [event for event, _ in events] == ["queued", "running", "token", "token", "error"]
+    assert events[-1][1]["error"] == "out of memory"
+
+
+def test_stream_of_a_cancelled_job(client, run_job, saved_user, parse_events):
+    # a first job keeps the worker busy, so that the streamed one stays queued
+    run_job.release = threading.Event()
+    client.post("/api/summary-jobs", json=STREAM_REQUEST)
+    responses = []
+    stream = threading.Thread(target=lambda: responses.append(client.post("/api/summary-stream",
+                                                                          json=STREAM_REQUEST)))
+    stream.start()
+    for _ in range(100):
+        queued = [job for job in client.get("/api/summary-jobs").json() if job["status"] == "queued"]
+        if queued:
+            break
+        time.sleep(0.05)
+    assert client.delete(f"/api/summary-jobs/{queued[0]['job_id']}").status_code == 200
+    stream.join(timeout=10)
+    run_job.release.set()
+
+    events = parse_events(responses[0].text)
+    assert [event for event, _ in events] == ["queued", "cancelled"]
+    assert events[0][1]["position"] == 0
+    assert len(run_job.jobs) == 1
+
+
+def test_stream_of_a_cached_summary(main_module, client, summariser, saved_user, parse_events):
+    assert client.put("/api/generate-summary", json=STREAM_REQUEST).status_code == 200
+    events = parse_events(client.post("/api/summary-stream", json=STREAM_REQUEST).text)
+    summary = "title 0 body 0|title 1 body 1|title 2 body 2"
+    assert events == [("token", {"step": 0, "text": summary}),
+                      ("done", {"job_id": None, "summary": summary, "cached": True})]
+    assert len(summariser.calls) == 1
+
+
+def test_stream_stops_when_the_client_disconnects(client, run_job, saved_user):
+    # the TestClient only returns complete responses, so the app is called with an ASGI receive that
+    # reports the disconnect once the job is running
+    run_job.release = threading.Event()
+    body = json.dumps(STREAM_REQUEST).encode()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": "/api/summary-stream", "raw_path": b"/api/summary-stream", "root_path": "", "query_string": b"",
+             "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+             "client": ("testclient", 50000), "server": ("testserver", 80)}
+
+    async def stream_until_disconnect():
+        sent = []
+        running = anyio.Event()
+        request_received = False
+
+        async def receive():
+            nonlocal request_received
+            if not request_received:
+                request_received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await running.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if b"event: running" in message.get("body", b""):
+                running.set()
+
+        with anyio.fail_after(10):
+            await client.app(scope, receive, send)
+        return b"".join(message.get("body", b"") for message in sent)
+
+    sent_body = client.portal.call(stream_until_disconnect)
+    assert b"event: queued" in sent_body and b"event: running" in sent_body
+    assert b"event: done" not in sent_body
+
+    # the stream ended while the job was still running, the job itself completes
+    job = run_job.jobs[0]
+    assert not job.future.done()
+    run_job.release.set()
+    assert job.future.result(timeout=10) == "firstsecond"
+    assert client.get(f"/api/summary-jobs/{job.job_id}").json()["status"] == "done"
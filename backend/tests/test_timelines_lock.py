@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+
+def saved_timelines(main_module, user_id):
+    with open(os.path.join(main_module.settings.data_dir, f"{user_id}_timelines.json")) as f:
+        return json.load(f)
+
+
+def test_concurrent_updates_of_a_user_are_not_lost(main_module, client, summariser, saved_user, monkeypatch):
+    # a slow read of the timelines, so that unserialized read-modify-writes would overwrite each other
+    load = json.load
+
+    def slow_load(f, *args, **kwargs):
+        timelines = load(f, *args, **kwargs)
+        time.sleep(0.2)
+        return timelines
+    monkeypatch.setattr(json, "load", slow_load)
+
+    updates = [threading.Thread(target=main_module.summarise_timeline, args=("user_a", posts_ids, "stub-model"))
+               for posts_ids in (["p0", "p1", "p2"], ["p3", "p4", "p5"])]
+    for update in updates:
+        update.start()
+    for update in updates:
+        update.join(timeout=10)
+
+    timelines = saved_timelines(main_module, "user_a")
+    assert timelines["p0-p2"]["summary_stub-model"] == "title 0 body 0|title 1 body 1|title 2 body 2"
+    assert timelines["p3-p5"]["summary_stub-model"] == "title 3 body 3|title 4 body 4|title 5 body 5"
+
+
+def test_locks_of_different_users_do_not_block_each_other(main_module, client, summariser, saved_user):
+    for name in ("posts", "timelines"):
+        shutil.copyfile(os.path.join(main_module.settings.data_dir, f"user_a_{name}.json"),
+                        os.path.join(main_module.settings.data_dir, f"user_b_{name}.json"))
+    assert main_module.timelines_lock("user_a") is main_module.timelines_lock("user_a")
+    assert main_module.timelines_lock("user_a") is not main_module.timelines_lock("user_b")
+
+    with main_module.timelines_lock("user_a"):
+        update = threading.Thread(target=main_module.summarise_timeline, args=("user_b", ["p0", "p1"], "stub-model"))
+        update.start()
+        update.join(timeout=10)
+        assert not update.is_alive()
+        assert "summary_stub-model" in saved_timelines(main_module, "user_b")["p0-p1"]
+
+        # an update of the locked user waits for the lock
+        update = threading.Thread(target=main_module.summarise_timeline, args=("user_a", ["p0", "p1"], "stub-model"))
+        update.start()
+        update.join(timeout=0.5)
+        assert update.is_alive()
+    update.join(timeout=10)
+    assert "summary_stub-model" in saved_timelines(main_module, "user_a")["p0-p1"]
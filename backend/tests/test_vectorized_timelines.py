@@ -0,0 +1,127 @@
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+
+from timeline_generation.create_timelines import merge_overlapping_spans, return_anchor_points_for_user
+from timeline_generation.entry_point_for_dashboard import (create_timeline_from_anchor_points, return_daily_posts)
+from timeline_generation.ingest_posts import ingest_posts, return_posts_json
+
+
+# The loops the vectorized code replaced
+
+def baseline_spans(anchor_points, span_radius):
+    return [[anchor_point - datetime.timedelta(span_radius), anchor_point + datetime.timedelta(span_radius)]
+            for anchor_point in anchor_points]
+
+
+def baseline_merge(spans):
+    if len(spans) <= 1:
+        return spans
+    spans.sort(key=lambda interval: interval[0])
+    merged = [spans[0]]
+    for current in spans:
+        previous = merged[-1]
+        if current[0] <= previous[1]:
+            previous[1] = max(previous[1], current[1])
+        else:
+            merged.append(current)
+    return merged
+
+
+def baseline_timelines(unpickled_posts, anchor_points, span_radius):
+    posts = pd.DataFrame(unpickled_posts)
+    posts['created_utc'] = pd.to_datetime(posts['created_utc'], unit='s')
+    posts.set_index('created_utc', inplace=True)
+    posts = posts.resample('D').agg({'id': list})
+
+    timeline_dict = {}
+    for start, end in baseline_merge(baseline_spans(anchor_points, span_radius)):
+        matched_posts = posts.loc[start:end]["id"].explode().dropna().tolist()
+        if len(matched_posts) == 0:
+            continue
+        timeline_dict[f"{matched_posts[0]}-{matched_posts[-1]}"] = {"timeline_of_interest": True,
+                                                                    "posts": matched_posts}
+    return timeline_dict
+
+
+def baseline_posts_json(unpickled_posts):
+    og_posts = {}
+    for post in unpickled_posts:
+        og_posts[post["id"]] = {
+            "title": post["title"],
+            "body": post.get("selftext", ""),
+            "created_utc": post["created_utc"],
+            "label": ["0"]
+        }
+    return og_posts
+
+
+def raw_posts(rng, n_posts=400, n_days=200):
+    # bursts of posts on the same day, days without posts and the fields of the raw uploads, some missing
+    days = np.concatenate([rng.choice(n_days, n_posts - 40), np.full(40, n_days // 2)])
+    created_utc = 1577836800 + days * 86400 + rng.choice(86400, n_posts, replace=False)
+    posts = []
+    for i, created in enumerate(rng.permutation(created_utc)):
+        post = {"id": f"p{i}", "author": "user_a", "created_utc": int(created), "score": int(rng.integers(100)),
+                "title": " ".join(["word"] * int(rng.integers(1, 6)))}
+        if rng.random() < 0.8:
+            post["selftext"] = " ".join(["text"] * int(rng.integers(0, 20)))
+        if rng.random() < 0.8:
+            post["num_comments"] = int(rng.integers(0, 50))
+        if rng.random() < 0.8:
+            post["subreddit"] = str(rng.choice(["a", "b", "c"]))
+        posts.append(post)
+    return posts
+
+
+def test_spans_and_merge_equal_the_loops():
+    rng = np.random.default_rng(0)
+    for span_radius in (0, 1, 3, 7, 30):
+        days = np.unique(rng.choice(365, 25))
+        anchor_points = [pd.Timestamp("2020-01-01") + pd.Timedelta(days=int(day)) for day in days]
+        expected_spans = baseline_spans(anchor_points, span_radius)
+
+        spans = return_anchor_points_for_user(np.array(anchor_points, dtype='datetime64[D]'), span_radius=span_radius)
+        assert spans.tolist() == np.array(expected_spans, dtype='datetime64[D]').tolist()
+        # merging does not depend on the order of the spans
+        merged = merge_overlapping_spans(spans[rng.permutation(len(spans))])
+        assert merged.tolist() == np.array(baseline_merge(expected_spans), dtype='datetime64[D]').tolist()
+
+    # spans that end on the day the next one starts are merged, as in the loop
+    spans = np.array([["2020-01-01", "2020-01-05"], ["2020-01-05", "2020-01-07"], ["2020-01-08", "2020-01-09"]],
+                     dtype='datetime64[D]')
+    assert merge_overlapping_spans(spans).tolist() == np.array(
+        [["2020-01-01", "2020-01-07"], ["2020-01-08", "2020-01-09"]], dtype='datetime64[D]').tolist()
+    assert len(merge_overlapping_spans(np.empty((0, 2), dtype='datetime64[D]'))) == 0
+
+
+def test_timelines_equal_the_loops():
+    rng = np.random.default_rng(1)
+    for _ in range(5):
+        posts = raw_posts(rng)
+        daily_posts = return_daily_posts(posts)
+        days = daily_posts.index.values.astype('datetime64[D]')
+        # anchor points on the first and last day, on empty days and on the day of the burst
+        anchor_points = np.unique(np.concatenate([days[[0, -1]], rng.choice(days, 10),
+                                                  days[daily_posts['posts'].to_numpy() == 0][:3],
+                                                  days[[len(days) // 2]]]))
+        for span_radius in (0, 2, 7):
+            expected = baseline_timelines(posts, [pd.Timestamp(day) for day in anchor_points], span_radius)
+            assert create_timeline_from_anchor_points(ingest_posts(posts), anchor_points,
+                                                      span_radius=span_radius) == expected
+
+
+def test_ingested_posts_equal_the_raw_posts():
+    rng = np.random.default_rng(2)
+    posts = raw_posts(rng)
+    post_columns = ingest_posts(posts)
+
+    assert json.dumps(return_posts_json(post_columns)) == json.dumps(baseline_posts_json(posts))
+
+    # the daily series of the ingested columns and of a data frame of all raw fields
+    raw_frame = pd.DataFrame(posts)
+    features = ['posts', 'words', 'comments', 'subreddits']
+    expected = return_daily_posts({column: raw_frame[column] for column in raw_frame.columns}, features=features)
+    pd.testing.assert_frame_equal(return_daily_posts(post_columns, features=features), expected)
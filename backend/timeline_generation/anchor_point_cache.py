@@ -0,0 +1,82 @@
+"""
+Cache of detected anchor points.
+
+The anchor points only depend on the daily series of the user and the parameters of the detection, not on the
+span_radius used to turn them into timelines. The dashboard caches them under a fingerprint of the daily series
+and the detection parameters, so that creating the timelines again with another span_radius only rebuilds the
+spans and matches the posts. The least recently used entries are evicted once the cache is full.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+
+class AnchorPointCache:
+    """
+    Least recently used cache of anchor point arrays.
+
+    Attributes:
+        max_entries: int;
+            the number of anchor point arrays kept, the least recently used one is evicted beyond that
+        hits, misses: int;
+            counts of the lookups that found / did not find an entry
+    """
+
+    def __init__(self, max_entries:int=128):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns a copy of the anchor points cached under key, or None"""
+        with self._lock:
+            anchor_points = self._entries.get(key)
+            if anchor_points is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return np.array(anchor_points)
+
+    def put(self, key, anchor_points):
+        """Caches a copy of anchor_points under key, evicting the least recently used entries if full"""
+        with self._lock:
+            self._entries[key] = np.array(anchor_points)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def fingerprint_daily_series(user_data:pd.DataFrame) -> str:
+    """
+    Returns a digest of a daily series data frame (see entry_point_for_dashboard.return_daily_posts), covering its
+    first day, its columns and all of its counts.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    first_day = str(user_data.index[0]) if len(user_data) > 0 else ''
+    digest.update(json.dumps([first_day, list(map(str, user_data.columns)), list(user_data.shape)]).encode())
+    digest.update(np.ascontiguousarray(user_data.to_numpy(dtype=float)).tobytes())
+
+    return digest.hexdigest()
+
+
+def anchor_point_cache_key(user_data:pd.DataFrame, **parameters) -> tuple:
+    """
+    Returns the cache key of the anchor points detected on user_data with the given detection parameters
+    (method, alpha, beta, hazard, ...). The parameters are serialized to JSON, so lists and dicts can be passed.
+    """
+    return fingerprint_daily_series(user_data), json.dumps(parameters, sort_keys=True, default=str)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Implements the BatchedPGDetector, which runs the Poisson-Gamma
+BOCPD of the Detector and PGModel classes for N univariate count series
+(e.g. the daily posts of N users) at once. The series are given as a padded
+2-dimensional array together with their lengths, and the run-length
+recursions of all series are advanced together with vectorized numpy
+operations, so that the interpreter overhead per time step is paid once per
+batch instead of once per series.
+
+Since the hazard only enters the split into growth and CP probabilities,
+the detector can also be given several CP models (e.g. a sweep over hazard
+values). The predictive probabilities, which only depend on the data and
+the Gamma prior, are then computed once and shared by the run-length
+recursions of all hazards.
+
+The steps of the recursion are those of run_length_recursion.py and
+poisson_gamma_model.py, shared with the Detector, so the batched detector
+performs the same floating point operations as the Detector with a single
+PGModel (no pruning, prior mean 0, no automatic prior updates), and the
+change points are exactly the same as those of 'poisson_bocpd' run on each
+series separately.
+"""
+
+import numpy as np
+import scipy
+from scipy.special import gammaln
+
+from .poisson_gamma_model import (nbinom_log_pmf, nbinom_log_prob_tables,
+                                  update_posterior_means)
+from .run_length_recursion import (initial_log_probabilities,
+                                   grow_joint_log_probabilities,
+                                   map_candidates, map_traceback)
+
+
+class BatchedPGDetector:
+    """Poisson-Gamma BOCPD for a batch of univariate count series.
+
+    Since no run-lengths are pruned, all series retain the run-lengths
+    r=0,1,...,t at time t, so the run-length indexed quantities of all
+    series can be stored as rows of preallocated (N x (T+1)) arrays, filled
+    from the right (the newest run-length r=0 is added at the front). The
+    quantities of the run-length recursion have an additional axis for the
+    H CP models.
+
+    Attributes:
+        data: float numpy array;
+            the N x T padded count series, sorted by decreasing length
+        lengths: int numpy array;
+            the number of observations of each (sorted) series
+        order: int numpy array;
+            the permutation sorting the input series by decreasing length,
+            i.e. row i of *data* is series order[i] of the input
+        cp_models: list of CpModel objects;
+            the H CP models, each of which is run on all series
+        prior_alpha, prior_beta: float;
+            the Gamma prior shared by all series
+        means: float numpy array; N x (T+1)
+            at time t, the entries [:, T-t:] hold the posterior means for
+            r=0,1,...,t. They do not depend on the CP model.
+        joint_log_probabilities: float numpy array; N x H x (T+1)
+            at time t, the entries [:, :, T-t:] hold the joint log
+            probabilities (y_{1:t}, r_t) for r=0,1,...,t
+        model_log_evidence: float numpy array; N x H
+            the log evidence at the current time point
+        storage_log_evidence: float numpy array; N x H x T
+            the log evidence at each time point
+        MAP_back_pointers: int numpy array; N x H x (T+1)
+            the back-pointers of the MAP recursion, see Detector
+    """
+
+    def __init__(self, data, lengths, cp_models, prior_alpha, prior_beta):
+        """Construct the batched detector for the N x T array *data*, where
+        row i holds the first *lengths*[i] observations of series i and is
+        padded arbitrarily afterwards. *cp_models* is a CpModel object or a
+        list of them"""
+
+        """STEP 1: Sort the series by decreasing length, so that at each
+        time point the series that are still running form the first rows"""
+        data = np.asarray(data)
+        lengths = np.asarray(lengths, dtype=int)
+        self.order = np.argsort(-lengths, kind="stable")
+        self.data = data[self.order]
+        self.lengths = lengths[self.order]
+        self.N, self.T = self.data.shape
+        if not isinstance(cp_models, (list, tuple, np.ndarray)):
+            cp_models = [cp_models]
+        self.cp_models = list(cp_models)
+        self.H = len(self.cp_models)
+        self.prior_alpha = float(prior_alpha)
+        self.prior_beta = float(prior_beta)
+        self.t = 0
+
+        """STEP 2: Allocate the run-length indexed quantities once. With the
+        r>t-1 entry of the first time point, there are at most T+1"""
+        self.means = np.zeros(shape=(self.N, self.T + 1))
+        self.joint_log_probabilities = -np.inf * np.ones(
+            shape=(self.N, self.H, self.T + 1))
+        self.retained_run_lengths = np.arange(self.T + 1)
+        self.model_log_evidence = -np.inf * np.ones(shape=(self.N, self.H))
+
+        """The hazard log-terms of each CP model, as a column over H"""
+        log_hazards = np.array([cp_model.log_hazard_vector(1, 2)
+                                for cp_model in self.cp_models])
+        self.log_hazard = log_hazards[:, 0:1]
+        self.log_one_minus_hazard = log_hazards[:, 1:2]
+
+        """STEP 3: The negative binomial log(p), log(1-p) for each factor
+        r+1, exactly as in PGModel.log_probability_tables"""
+        factors = np.arange(self.T + 2)
+        self.log_prob_table, self.log_one_minus_prob_table = (
+            nbinom_log_prob_tables(self.prior_beta, factors))
+
+        """STEP 4: Storage for the evidence and the MAP recursion"""
+        self.storage_log_evidence = -np.inf * np.ones(
+            shape=(self.N, self.H, self.T))
+        self.log_MAP_storage = np.zeros(shape=(self.N, self.H, self.T + 2))
+        self.MAP_back_pointers = np.zeros(shape=(self.N, self.H, self.T + 1),
+                                          dtype=int)
+
+
+    def run(self):
+        """Run the detector over all time points of the longest series"""
+        for t in range(self.t + 1, self.T + 1):
+            self.next_run(t)
+
+
+    def next_run(self, t):
+        """Process the observations at time *t* of all series that have at
+        least t observations"""
+        active = np.count_nonzero(self.lengths >= t)
+        y = self.data[:active, t-1][:, np.newaxis]
+        if t == 1:
+            self.initialization(y, active)
+        else:
+            self.update_joint_log_probabilities(y, t, active)
+            self.update_predictive_distributions(y, t, active)
+        self.storage_log_evidence[:active, :, t-1] = (
+            self.model_log_evidence[:active])
+        self.MAP_estimate(t, active)
+        self.t = t
+
+
+    def initialization(self, y, active):
+        """Same as PGModel.initialization for the first observation *y* of
+        each series, with a CP at t=0 with probability one"""
+        size = self.prior_alpha + 0.0
+        self.model_log_evidence[:active] = (np.log(1) +
+            nbinom_log_pmf(y, size, self.log_prob_table[0],
+                           self.log_one_minus_prob_table[0],
+                           gammaln(y + 1)))
+
+        """Only the last two columns are in use at t=1"""
+        for h, cp_model in enumerate(self.cp_models):
+            log_cp, log_no_cp = initial_log_probabilities(cp_model)
+            self.joint_log_probabilities[:active, h, -2] = (
+                self.model_log_evidence[:active, h] + log_cp)
+            self.joint_log_probabilities[:active, h, -1] = (
+                self.model_log_evidence[:active, h] + log_no_cp)
+        self.means[:active, -2:] = y
+
+
+    def update_joint_log_probabilities(self, y, t, active):
+        """Same as ProbabilityModel.update_joint_log_probabilities, for the
+        first *active* series. At time t, the run-lengths r=0,...,t-1 of the
+        previous time point are in the columns T-t+1,...,T"""
+        start = self.T - t + 1
+        retained = self.retained_run_lengths[:t]
+        factors = retained + 1
+
+        """STEP 1: Predictive log probabilities for all run-lengths, computed
+        once and shared by all CP models"""
+        size = self.prior_alpha + factors * self.means[:active, start:]
+        predictive_log_probs = nbinom_log_pmf(
+            y, size, self.log_prob_table[factors],
+            self.log_one_minus_prob_table[factors], gammaln(y + 1))
+
+        """STEP 2-3: Growth and CP probabilities for each CP model"""
+        self.joint_log_probabilities[:active, :, start-1] = (
+            grow_joint_log_probabilities(
+                self.joint_log_probabilities[:active, :, start:],
+                predictive_log_probs[:, np.newaxis, :],
+                self.log_hazard, self.log_one_minus_hazard))
+
+        """STEP 4: Evidence"""
+        self.model_log_evidence[:active] = scipy.special.logsumexp(
+            self.joint_log_probabilities[:active, :, start-1:], axis=2)
+
+
+    def update_predictive_distributions(self, y, t, active):
+        """Same as PGModel.update_predictive_distributions, for the first
+        *active* series"""
+        start = self.T - t + 1
+        update_posterior_means(self.means[:active, start:],
+                               self.retained_run_lengths[:t], y)
+        self.means[:active, start-1] = y[:, 0]
+
+
+    def MAP_estimate(self, t, active):
+        """Same as Detector.MAP_estimate with a single model. After the
+        first time point, the retained run-lengths are r=0,1,...,t, so the
+        position of the maximizing candidate is its run-length"""
+        start = self.T - t
+        log_densities = (self.joint_log_probabilities[:active, :, start:] -
+                         self.model_log_evidence[:active, :, np.newaxis])
+        if t > 1:
+            candidates = map_candidates(log_densities,
+                self.log_MAP_storage[:active, :, :t+1])
+            r_max = np.argmax(candidates, axis=2)
+            self.log_MAP_storage[:active, :, t+1] = np.take_along_axis(
+                candidates, r_max[:, :, np.newaxis], axis=2)[:, :, 0]
+            self.MAP_back_pointers[:active, :, t] = t - r_max - 1
+        else:
+            """At t=1, the candidates are the run-lengths r=0 and r>0, and
+            the one of r=0 is always the larger one by construction of the
+            initialization. This also displaces the position of r>t-1, as
+            in Detector.MAP_estimate"""
+            self.log_MAP_storage[:active, :, 0:2] = 0
+            self.log_MAP_storage[:active, :, 2] = log_densities[:, :, 0]
+            self.MAP_back_pointers[:active, :, 1] = -1
+
+
+    def MAP_traceback(self, i, h=0):
+        """Reconstruct the MAP segmentation of input series *i* under CP
+        model *h* at its last observation, in the same format as
+        Detector.MAP_traceback (all segments have model index 0)"""
+        row = np.flatnonzero(self.order == i)[0]
+        t = min(self.lengths[row], self.t)
+        return map_traceback(self.MAP_back_pointers[row, h],
+                             np.zeros(self.T + 1, dtype=int), 1, t)
+
+
+    def final_log_evidence(self, i):
+        """The log evidence of input series *i* at its last observation
+        under each CP model, as a vector of length H"""
+        row = np.flatnonzero(self.order == i)[0]
+        t = min(self.lengths[row], self.t)
+        if t == 0:
+            return np.zeros(self.H)
+        return self.storage_log_evidence[row, :, t-1]
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Saves and restores the state of a Poisson-Gamma Detector, so
+that a detector that has processed the first t observations of a stream can
+be continued with 'Detector.extend' and 'Detector.next_run' when new
+observations arrive, instead of being re-run from the first observation.
+
+The state is written as a single compressed .npz file, through a temporary
+file that replaces *path* once complete, so that a crash or a concurrent
+writer never leaves a partial checkpoint behind. The numpy arrays
+(data, run-length log probabilities, means, retained run-lengths, MAP
+recursion) are stored as they are, and the scalar configuration is stored as
+JSON in the 'config' entry, together with CHECKPOINT_FORMAT_VERSION. Loading
+a checkpoint of a different version, or one that is corrupt or inconsistent,
+raises a CheckpointError.
+
+Since the run-length quantities of a model are its complete state, the
+restored detector continues bit-identically to one that was never saved.
+"""
+
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from .cp_probability_model import CpModel
+from .detector import Detector
+from .poisson_gamma_model import PGModel
+
+
+CHECKPOINT_FORMAT_VERSION = 1
+
+"""The per-time-point storage of a Detector, only present in mode 'full'"""
+FULL_MODE_STORAGE = ("storage_run_length_distr", "storage_mean", "storage_var")
+
+
+class CheckpointError(ValueError):
+    """Raised by 'load_detector_state' if the checkpoint cannot be restored:
+    it is truncated or corrupt, has an unsupported version, or its entries
+    do not fit together"""
+
+
+def save_detector_state(detector, path, metadata=None):
+    """Write the state of *detector* (a Detector whose model universe
+    consists of PGModel objects) to the .npz file at *path*. *metadata* is
+    an optional JSON-serializable dict stored alongside, e.g. to record which
+    data the detector was run on."""
+    t = int(detector.t)
+    config = {
+        "version": CHECKPOINT_FORMAT_VERSION,
+        "t": t,
+        "T": int(detector.T),
+        "S1": detector.S1,
+        "S2": detector.S2,
+        "mode": detector.mode,
+        "cp_probability_lag": detector.cp_probability_lag,
+        "threshold": detector.threshold,
+        "max_run_length": detector.max_run_length,
+        "retention": detector.retention,
+        "max_particles": detector.max_particles,
+        "intensity": float(detector.cp_model.intensity),
+        "rng_state": detector.rng.bit_generator.state,
+        "log_evidence": float(getattr(detector, "log_evidence", -np.inf)),
+        "log_MAP_length": int(detector.log_MAP_length),
+        "MAP_first_cp": int(detector.MAP_first_cp),
+        "models": [{"auto_prior_update": bool(model.auto_prior_update),
+                    "capacity": model.capacity,
+                    "model_log_evidence": float(model.model_log_evidence)}
+                   for model in detector.model_universe],
+        "metadata": metadata,
+    }
+
+    """Only the first t time points of the storage have been filled in. The
+    MAP recursion is stored up to its current length"""
+    arrays = {
+        "data": detector.data[:t],
+        "model_prior": np.asarray(detector.model_prior),
+        "storage_log_evidence": detector.storage_log_evidence[:t],
+        "storage_folded_log_mass": detector.storage_folded_log_mass[:t],
+        "log_MAP_storage": detector.log_MAP_storage[:detector.log_MAP_length],
+        "MAP_back_pointers": detector.MAP_back_pointers[:t+1],
+        "MAP_models": detector.MAP_models[:t+1],
+    }
+    if detector.storage_cp_probability is not None:
+        arrays["storage_cp_probability"] = detector.storage_cp_probability[:t]
+    if detector.mode == "full":
+        arrays["storage_run_length_distr"] = (
+            detector.storage_run_length_distr[:t+1, :t+1])
+        arrays["storage_mean"] = detector.storage_mean[:t]
+        arrays["storage_var"] = detector.storage_var[:t]
+    for q, model in enumerate(detector.model_universe):
+        prefix = "model_%d_" % q
+        arrays[prefix + "prior_alpha"] = model.prior_alpha
+        arrays[prefix + "prior_beta"] = model.prior_beta
+        arrays[prefix + "prior_mean"] = model.prior_mean
+        if t > 0:
+            arrays[prefix + "joint_log_probabilities"] = (
+                model.joint_log_probabilities)
+            arrays[prefix + "means"] = model.means
+            arrays[prefix + "retained_run_lengths"] = (
+                model.retained_run_lengths)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, config=np.array(json.dumps(config)), **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_detector_state(path):
+    """Restore the Detector saved by 'save_detector_state' at *path*.
+    Returns the detector and the stored metadata. The detector holds the
+    first t observations, so new ones are added with 'Detector.extend'
+    before calling 'Detector.next_run' for t+1, t+2, ..."""
+    try:
+        with np.load(path, allow_pickle=False) as checkpoint:
+            config = json.loads(str(checkpoint["config"]))
+            arrays = {key: checkpoint[key] for key in checkpoint.files
+                      if key != "config"}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        raise CheckpointError("Cannot read detector checkpoint %s: %s"
+                              % (path, e)) from e
+    if config.get("version") != CHECKPOINT_FORMAT_VERSION:
+        raise CheckpointError("Unsupported detector checkpoint version %s."
+                              % config.get("version"))
+    try:
+        return _restore_detector(config, arrays)
+    except (ValueError, KeyError, TypeError) as e:
+        raise CheckpointError("Inconsistent detector checkpoint %s: %s"
+                              % (path, e)) from e
+
+
+def _restore_detector(config, arrays):
+    """Rebuild the Detector and its metadata from the *config* and the
+    *arrays* of a checkpoint, see 'load_detector_state'"""
+    t, S1, S2 = config["t"], config["S1"], config["S2"]
+
+    """STEP 1: Rebuild the models and the detector for the t stored
+    observations"""
+    model_universe = []
+    for q, model_config in enumerate(config["models"]):
+        prefix = "model_%d_" % q
+        model = PGModel(arrays[prefix + "prior_alpha"],
+                        arrays[prefix + "prior_beta"],
+                        arrays[prefix + "prior_mean"],
+                        S1, S2,
+                        auto_prior_update=model_config["auto_prior_update"],
+                        capacity=model_config["capacity"])
+        if t > 0:
+            model.joint_log_probabilities = (
+                arrays[prefix + "joint_log_probabilities"])
+            model.means = arrays[prefix + "means"]
+            model.retained_run_lengths = arrays[prefix + "retained_run_lengths"]
+        model.model_log_evidence = model_config["model_log_evidence"]
+        model_universe.append(model)
+
+    detector = Detector(arrays["data"].reshape(t, S1, S2),
+                        np.array(model_universe),
+                        arrays["model_prior"],
+                        CpModel(config["intensity"]),
+                        S1, S2, t,
+                        threshold=config["threshold"],
+                        max_run_length=config["max_run_length"],
+                        retention=config["retention"],
+                        max_particles=config["max_particles"],
+                        mode=config["mode"],
+                        cp_probability_lag=config.get("cp_probability_lag"))
+
+    """STEP 2: Restore the state of the detector"""
+    detector.rng.bit_generator.state = config["rng_state"]
+    detector.t = t
+    detector.log_evidence = config["log_evidence"]
+    detector.storage_log_evidence[:] = arrays["storage_log_evidence"]
+    detector.storage_folded_log_mass[:] = arrays["storage_folded_log_mass"]
+    detector.log_MAP_length = config["log_MAP_length"]
+    detector.log_MAP_storage[:detector.log_MAP_length] = (
+        arrays["log_MAP_storage"])
+    detector.MAP_back_pointers[:] = arrays["MAP_back_pointers"]
+    detector.MAP_models[:] = arrays["MAP_models"]
+    detector.MAP_first_cp = config["MAP_first_cp"]
+    if detector.storage_cp_probability is not None:
+        detector.storage_cp_probability[:] = arrays["storage_cp_probability"]
+    if detector.mode == "full":
+        for name in FULL_MODE_STORAGE:
+            getattr(detector, name)[:] = arrays[name]
+
+    return detector, config["metadata"]
@@ -13,6 +13,7 @@ Traditionally, both are contained in a single prior run-length
 distribution that implicitly specifies them, see Adams & MacKay (2007)
 """
 
+import numpy as np
 from scipy import stats
 
 
@@ -33,6 +34,9 @@ class CpModel:
         g_0: generic pmf corresponding to boundary condition
         EPS: (static), with which precision we want to calculate the 
             resulting cdfs G and G_0 from g, g_0
+        log_hazard, log_one_minus_hazard: float;
+            the log-terms of the hazard used in every update of the joint
+            probabilities, precomputed once
     """
     
     def __init__(self, intensity):
@@ -41,6 +45,8 @@ class CpModel:
         
         self.intensity = intensity
         self.cp_pmf = self.create_distribution()
+        self.log_hazard = np.log(self.hazard(1))
+        self.log_one_minus_hazard = np.log(1 - self.hazard(1))
 
 
     def create_distribution(self):
@@ -95,6 +101,12 @@ class CpModel:
         Once g and g_0 are allowed as input, this function handles the more
         general case, too."""
         return 1.0/self.intensity     #memorylessness of geometric distribution
+
+    def log_hazard_vector(self, k, m):
+        """Returns the log of 'hazard_vector' and of one minus it for
+        l = k, k+1, ... m. In the geometric case, both are precomputed
+        scalars."""
+        return self.log_hazard, self.log_one_minus_hazard
     
 
 
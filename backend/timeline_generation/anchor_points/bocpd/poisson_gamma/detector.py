@@ -14,6 +14,8 @@ and a model prior probability over each of the models in the collection.
 import numpy as np
 import scipy
 
+from .run_length_recursion import map_candidates, map_traceback
+
 class Detector:
     """key object in the Spatial BOCD
     software. This object takes in the Data & its dimensions, a set of
@@ -55,10 +57,57 @@ class Detector:
         run_length_distr: float numpy array;
             stores the run-length distribution for r=0,1,...,t at each time
             point t.
+        max_run_length: int;
+            if not None, each model keeps at most max_run_length+1
+            run-lengths: r=0,1,...,max_run_length-1 and one absorbing slot
+            for r >= max_run_length, which holds the mass of all longer
+            run-lengths and the statistics of the most probable of them
+            (see 'fold_run_length_log_distribution'). The per-step cost of
+            the models is then constant in t.
+        retention: string;
+            how each model decides which run-lengths to retain at each time
+            point. 'threshold' (default) deletes the run-lengths with log
+            probability below *threshold*, 'sor' keeps at most
+            *max_particles* run-lengths using the stratified optimal
+            resampling of Fearnhead & Liu (2007).
+        MAP_back_pointers, MAP_models: int numpy arrays;
+            for each time point t>1, the time point t-r-1 preceding the
+            last CP of the MAP segmentation at t (its MAP segmentation is
+            the prefix of the one at t) and the model of the last segment.
+            The MAP segmentation is reconstructed from these by
+            'MAP_traceback'.
+        mode: string;
+            'full' (default) computes and stores the prediction, the
+            predictive variance and the run-length distribution at each
+            time point. 'cps_only' skips these and only keeps what is
+            needed for the MAP segmentation and the evidence, so that the
+            memory is O(T) instead of O(T^2).
+        storage_folded_log_mass: float numpy array;
+            stores at each time point the log of the run-length probability
+            mass that was folded because of *max_run_length*. Gives an
+            indication of the approximation error against the exact run.
+        cp_probability_lag: int;
+            if not None, the posterior probability that a segment started
+            on each day is recorded in *storage_cp_probability*.
+        storage_cp_probability: float32 numpy array;
+            at position d, P(r_t = t-d-1 | y_{1:t}) for the time point
+            t = d+1+cp_probability_lag, i.e. the probability of a CP at day
+            d (0-based) after seeing cp_probability_lag more observations.
+            The last days hold the estimate with the largest lag available.
+            Note that the lag must be at least 1: in the recursion of
+            'update_joint_log_probabilities', P(r_t = 0 | y_{1:t}) is always
+            the hazard.
+        ZERO_STREAK_CHUNK: int;
+            the maximum number of zero observations that 'next_zero_streak'
+            processes with one closed-form update. Longer streaks are split.
 
     """
 
-    def __init__(self, data, model_universe, model_prior, cp_model, S1, S2, T, threshold=None):
+    ZERO_STREAK_CHUNK = 256
+
+    def __init__(self, data, model_universe, model_prior, cp_model, S1, S2, T, threshold=None,
+                 max_run_length=None, retention="threshold", max_particles=None,
+                 random_state=None, mode="full", cp_probability_lag=None):
         """construct the Detector with the multi-dimensional numpy array
         *data*. E.g., if you have a SxS spatial lattice with T time points,
         then *data* will be SxSxT. The argument *model_universe* will provide
@@ -69,6 +118,14 @@ class Detector:
         that the i-th model occurs in a segment. Lastly, *cp_model* is an
         object of class CpModel that stores all properties about the CP prior,
         i.e. the probability of one occuring at every time point.
+        If *max_run_length* is given, the run-lengths r >= max_run_length
+        of each model are merged into one absorbing slot.
+        With *retention* = 'sor', each model keeps at most *max_particles*
+        run-lengths, resampled with a generator seeded by *random_state*.
+        With *mode* = 'cps_only', no predictions or run-length distributions
+        are computed and stored.
+        If *cp_probability_lag* is given, the CP probability of each day is
+        recorded, see *storage_cp_probability*.
         """
 
         """store the inputs into object"""
@@ -79,31 +136,67 @@ class Detector:
         self.Q = model_universe.shape[0]  # Q: number of models in the model universe
         self.T, self.S1, self.S2 = T, S1, S2
         self.threshold = threshold
+        if max_run_length is not None and max_run_length < 1:
+            raise ValueError("max_run_length must be at least 1.")
+        self.max_run_length = max_run_length
+        if retention not in ("threshold", "sor"):
+            raise ValueError("retention must be 'threshold' or 'sor'.")
+        if retention == "sor" and (max_particles is None or max_particles < 2):
+            raise ValueError("SOR needs max_particles of at least 2.")
+        self.retention = retention
+        self.max_particles = max_particles
+        self.rng = np.random.default_rng(random_state)
+        if mode not in ("full", "cps_only"):
+            raise ValueError("mode must be 'full' or 'cps_only'.")
+        self.mode = mode
+        if cp_probability_lag is not None and cp_probability_lag < 1:
+            raise ValueError("cp_probability_lag must be at least 1.")
+        self.cp_probability_lag = cp_probability_lag
 
 
         """create internal data structures for most recent computed objects"""
         self.evidence = -np.inf
-        self.MAP = None
+        self.t = 0
         self.y_pred_mean = np.zeros(shape=(self.S1, self.S2))
         self.y_pred_var  = np.zeros(shape = (self.S1*self.S2, self.S1*self.S2))
 
 
-        """create internal data structures for all computed objects"""
+        """create internal data structures for all computed objects. The
+        predictions and run-length distributions are only stored if the
+        mode is 'full'"""
         self.model_and_run_length_log_distr = (-np.inf *
                                             np.ones(shape = (self.Q, self.T+1)))
-        self.storage_run_length_distr = np.zeros(shape=(self.T+1, self.T+1))
-        self.storage_mean = np.zeros(shape = (self.T, self.S1, self.S2))
-        self.storage_var = np.zeros(shape = (self.T, self.S1*self.S2,
-                                             self.S1*self.S2))
+        if self.mode == "full":
+            self.storage_run_length_distr = np.zeros(shape=(self.T+1, self.T+1))
+            self.storage_mean = np.zeros(shape = (self.T, self.S1, self.S2))
+            self.storage_var = np.zeros(shape = (self.T, self.S1*self.S2,
+                                                 self.S1*self.S2))
+        else:
+            self.storage_run_length_distr = None
+            self.storage_mean, self.storage_var = None, None
         self.storage_log_evidence = -np.inf * np.ones(shape = self.T)
-        self.log_MAP_storage = np.zeros(self.T)
-        self.MAP_segmentation = [np.array([[],[]])]
+        self.storage_folded_log_mass = -np.inf * np.ones(shape = self.T)
+        """The MAP recursion only stores one log density, back-pointer and
+        model index per time point. *log_MAP_storage* holds the P_t^MAP of
+        Fearnhead & Liu (2007) for t=-1,0,1,...,T in its first
+        *log_MAP_length* entries"""
+        self.log_MAP_storage = np.zeros(self.T + 2)
+        self.log_MAP_length = 0
+        self.MAP_back_pointers = np.zeros(self.T + 1, dtype=int)
+        self.MAP_models = np.zeros(self.T + 1, dtype=int)
+        self.MAP_first_cp = 0
         self.segment_log_densities = np.zeros(shape = (self.Q, self.T) )
+        if self.cp_probability_lag is not None:
+            self.storage_cp_probability = np.zeros(self.T, dtype=np.float32)
+        else:
+            self.storage_cp_probability = None
 
 
-    def run(self, start=None, stop=None):
+    def run(self, start=None, stop=None, compress_zeros=False):
         """Start running the Detector from *start* to *stop*, usually from
         the first to the last observation (i.e. default).
+        If *compress_zeros* is True, streaks of zero observations are
+        processed with 'next_zero_streak' instead of one step at a time.
         """
 
         """set start and stop if not supplied"""
@@ -113,8 +206,143 @@ class Detector:
             stop = self.T
 
         """run the detector"""
-        for t in range(start-1, stop-1):
-            self.next_run(self.data[t,], t+1)
+        if not compress_zeros:
+            for t in range(start-1, stop-1):
+                self.next_run(self.data[t,], t+1)
+            return
+
+        """run-length encode the zero observations: for each time point,
+        the next time point with a non-zero observation"""
+        nonzero_times = np.append(
+            np.flatnonzero(np.any(self.data != 0, axis=1)) + 1, self.T + 1)
+        t = start
+        while t < stop:
+            end = min(int(nonzero_times[np.searchsorted(nonzero_times, t)]),
+                      stop)
+            if end - t > 1:
+                self.next_zero_streak(t, end - t)
+                t = end
+            else:
+                self.next_run(self.data[t-1,], t)
+                t = t + 1
+
+
+    def supports_zero_streaks(self):
+        """Whether 'next_zero_streak' can use the closed-form multi-step
+        update, i.e. there is a single model that implements it, and no
+        run-lengths are trimmed, folded or resampled and no predictions are
+        stored in between"""
+        model = self.model_universe[0]
+        return (self.Q == 1 and self.mode == "cps_only" and
+                self.retention == "threshold" and
+                self.threshold in (None, 0, -1) and
+                self.max_run_length is None and
+                not model.auto_prior_update and
+                hasattr(model, "update_predictive_distributions_zero_streak"))
+
+
+    def next_zero_streak(self, t, k):
+        """Process *k* zero observations at the times t,t+1,...,t+k-1 with
+        the same result as k calls of 'next_run', up to floating point
+        rounding. If 'supports_zero_streaks', the joint log probabilities
+        and the predictive distributions are updated in closed form for all
+        k steps at once, and only the MAP recursion and the evidence are
+        stored per time point. Otherwise, 'next_run' is called k times"""
+        if not self.supports_zero_streaks():
+            for s in range(t, t+k):
+                self.next_run(np.zeros(self.S1*self.S2), s)
+            return
+
+        """The first observation initializes the models, and long streaks
+        are split so that the per-step rows stay small"""
+        if t == 1:
+            self.next_run(np.zeros(self.S1*self.S2), 1)
+            t, k = 2, k - 1
+        while k > self.ZERO_STREAK_CHUNK:
+            self.next_zero_streak(t, self.ZERO_STREAK_CHUNK)
+            t, k = t + self.ZERO_STREAK_CHUNK, k - self.ZERO_STREAK_CHUNK
+        if k == 0:
+            return
+
+        """STEP 1: Update the model over the whole streak. Keep the
+        run-lengths before the streak for the MAP recursion"""
+        model = self.model_universe[0]
+        run_lengths = np.copy(model.retained_run_lengths)
+        rows, evidences = model.update_joint_log_probabilities_zero_streak(
+            t, k, self.cp_model)
+        model.update_predictive_distributions_zero_streak(k)
+
+        """STEP 2: Store the evidence and apply the MAP recursion of
+        'MAP_estimate' at each time point of the streak. After j steps,
+        the run-lengths are 0,1,...,j-1 followed by those before the
+        streak, advanced by j. The latter start before the streak, so the
+        P^MAP they are combined with is known and their best candidates
+        are found for all steps at once"""
+        self.storage_log_evidence[t-1:t+k-1] = evidences
+        if self.cp_probability_lag is not None:
+            for j in range(1, k+1):
+                self.log_evidence = evidences[j-1]
+                self.store_cp_probabilities(t+j-1,
+                    [np.concatenate((np.arange(j), run_lengths + j))],
+                    [rows[j-1, k-j:]])
+        n = self.log_MAP_length
+        old_candidates = (rows[:, k:] +
+                          self.log_MAP_storage[n-2-run_lengths][np.newaxis, :])
+        old_best = np.argmax(old_candidates, axis=1)
+        old_best_candidates = old_candidates[np.arange(k), old_best]
+        for j in range(1, k+1):
+            s = t + j - 1
+            n = self.log_MAP_length
+            new_candidates = (rows[j-1, k-j:k] +
+                              self.log_MAP_storage[n-1-np.arange(j)])
+            r_new = np.argmax(new_candidates)
+            """On ties, the shorter run-length wins as in 'MAP_estimate'"""
+            if new_candidates[r_new] >= old_best_candidates[j-1]:
+                r_max, candidate = r_new, new_candidates[r_new]
+            else:
+                r_max = run_lengths[old_best[j-1]] + j
+                candidate = old_best_candidates[j-1]
+            self.log_MAP_storage[n] = candidate - evidences[j-1]
+            self.log_MAP_length = n + 1
+            self.MAP_back_pointers[s] = s-r_max-1
+            self.MAP_models[s] = 0
+        self.log_evidence = evidences[-1]
+        self.t = t + k - 1
+
+
+    def extend(self, data):
+        """Append the new observations *data* (of dimension T_new x S1 x S2)
+        to the data stream and grow all storage, so that 'next_run' can be
+        called for the time points T+1,...,T+T_new. Used to continue a
+        detector that was restored from a checkpoint"""
+        data = np.asarray(data).reshape(-1, self.S1*self.S2)
+        T_new = data.shape[0]
+        if T_new == 0:
+            return
+
+        def grow(array, length, fill, axes=(0,)):
+            """pad *array* along *axes* by *length* entries of *fill*"""
+            padding = [(0, 0)] * array.ndim
+            for axis in axes:
+                padding[axis] = (0, length)
+            return np.pad(array, padding, constant_values=fill)
+
+        self.data = np.concatenate((self.data, data), axis=0)
+        self.storage_log_evidence = grow(self.storage_log_evidence, T_new, -np.inf)
+        self.storage_folded_log_mass = grow(self.storage_folded_log_mass, T_new, -np.inf)
+        self.log_MAP_storage = grow(self.log_MAP_storage, T_new, 0)
+        self.MAP_back_pointers = grow(self.MAP_back_pointers, T_new, 0)
+        self.MAP_models = grow(self.MAP_models, T_new, 0)
+        self.segment_log_densities = grow(self.segment_log_densities, T_new, 0,
+                                          axes=(1,))
+        if self.storage_cp_probability is not None:
+            self.storage_cp_probability = grow(self.storage_cp_probability, T_new, 0)
+        if self.mode == "full":
+            self.storage_run_length_distr = grow(self.storage_run_length_distr,
+                                                 T_new, 0, axes=(0, 1))
+            self.storage_mean = grow(self.storage_mean, T_new, 0)
+            self.storage_var = grow(self.storage_var, T_new, 0)
+        self.T = self.T + T_new
 
 
     def next_run(self, y, t):
@@ -146,13 +374,16 @@ class Detector:
         run-length r and each model in the model universe q, store the
         result in *self.model_and_run_length_distr*"""
         self.trim_run_length_log_distributions(t)
-        self.update_model_and_run_length_log_distribution(t)
+        if self.mode == "full":
+            self.update_model_and_run_length_log_distribution(t)
 
         """STEP 4: Using the results from STEP 3, obtain a prediction for the
         next spatial lattice slice, which you preferably should either store,
-        output, or write to some location"""
+        output, or write to some location. If only the CPs are of interest,
+        skip the prediction and only store the evidence"""
         #NOTE: THIS QUANTITY SHOULD BE STORED/WRITTEN SOMEWHERE!
-        self.prediction_y(t)
+        if self.mode == "full":
+            self.prediction_y(t)
         self.storage(t)
 
         """STEP 5: Using the results from STEP 3, obtain a MAP for the
@@ -165,6 +396,7 @@ class Detector:
         """STEP 6: For each model in the model universe, update the priors to
         be the posterior expectation/variance"""
         self.update_priors(t)
+        self.t = t
 
 
     #IMPLEMENTED FOR ALL SUBCLASSES IF predictive_probabilities WORK IN SUBLCASS
@@ -350,10 +582,33 @@ class Detector:
     def storage(self, t):
         """helper function, just stores y_pred into storage_mean & storage_var
         so that we can always access the last computed quantity"""
-        self.storage_mean[t-1, :, :]  = self.y_pred_mean
-        self.storage_var[t-1, :, :] = self.y_pred_var
+        if self.mode == "full":
+            self.storage_mean[t-1, :, :]  = self.y_pred_mean
+            self.storage_var[t-1, :, :] = self.y_pred_var
 
         self.storage_log_evidence[t-1] = self.log_evidence
+        if self.cp_probability_lag is not None:
+            self.store_cp_probabilities(t,
+                [model.retained_run_lengths for model in self.model_universe],
+                [model.joint_log_probabilities for model in self.model_universe])
+
+
+    def store_cp_probabilities(self, t, run_lengths, joint_log_probabilities):
+        """Store P(r_t = r | y_{1:t}) for r=0,1,...,cp_probability_lag in
+        *storage_cp_probability* at the days t-r-1, given the lists of
+        *run_lengths* and *joint_log_probabilities* of the models"""
+        lag = self.cp_probability_lag
+        probabilities = np.zeros(lag + 1)
+        for retained, joint_log_probs in zip(run_lengths, joint_log_probabilities):
+            """If r=t-1 and r>t-1 are both retained, the latter is r=t"""
+            if ((retained.shape[0]>1) and (retained[-1] == retained[-2])):
+                retained = np.copy(retained)
+                retained[-1] = retained[-1] + 1
+            kept = retained <= lag
+            np.add.at(probabilities, retained[kept],
+                      np.exp(joint_log_probs[kept] - self.log_evidence))
+        r = np.arange(min(lag, t-1) + 1)
+        self.storage_cp_probability[t-1-r] = probabilities[r]
 
 
     def MAP_estimate(self, t):
@@ -406,8 +661,9 @@ class Detector:
             """For t>1, we have previous segmentations and the P_t^MAP of
             Fearnhead & Liu (2007) is stored in log-format in *log_MAP_storage,
             so we may apply the recursion as in the paper"""
-            candidates = (log_densities +
-                      np.flipud(self.log_MAP_storage[-r_max_-1:])[np.newaxis, :])
+            n = self.log_MAP_length
+            candidates = map_candidates(log_densities,
+                                        self.log_MAP_storage[n-r_max_-1:n])
         else:
             """For t=1, we have no previous segmentations and so
             the P_t^MAP quantity in Fearnhead & Liu is simply 1"""
@@ -427,24 +683,16 @@ class Detector:
 
             """STEP 4A.1: Update *log_MAP_storage* by appending the
             density associated with the new MAP estimate"""
-            self.log_MAP_storage = np.append(self.log_MAP_storage,
-                    candidates[q_max, r_max])
-
-            """STEP 4A.2: Create the (new) segment associated with the new MAP
-            estimate at time t. If we get r_max = 0, then we have a MAP
-            estimated CP at time t-1, hence add an additional -1."""
-            last_segment = np.array([[t-r_max-1, q_max]])
-
-            """STEP 4A.3: Update *MAP_segmentation*  and its last entry which is
-            stored as *MAP* accordingly. Here, notice that since we append to
-            the *MAP_segmentation*, we have to call the relevant entries from
-            the back, i.e. we access -r-1 in the array to get the MAP estimate
-            associated with t-r-1."""
-            self.MAP = np.concatenate((self.MAP_segmentation[-1-r_max],
-                                  last_segment.T),axis=1)
-            self.MAP_segmentation.append( (np.concatenate(
-                                         (self.MAP_segmentation[-1-r_max],
-                                         last_segment.T), axis=1)))
+            self.log_MAP_storage[self.log_MAP_length] = candidates[q_max, r_max]
+            self.log_MAP_length = self.log_MAP_length + 1
+
+            """STEP 4A.2: Store the back-pointer of the new MAP estimate at
+            time t. If we get r_max = 0, then we have a MAP estimated CP at
+            time t-1, hence add an additional -1. The MAP segmentation at
+            time t is the one at time t-r_max-1 followed by the segment
+            starting at this CP with model q_max"""
+            self.MAP_back_pointers[t] = t-r_max-1
+            self.MAP_models[t] = q_max
         else:
             """STEP 4B: Update the P_j^MAP quantities and the MAP estimate for
             CPs and model orders between the CPs if it is the first
@@ -456,23 +704,63 @@ class Detector:
             model associated with a CP at time point 1, i.e. r_max = 0 or
             r_max > 0 and q_max is the most likely model given a CP at t=1 or
             before t=1."""
-            self.log_MAP_storage = np.array([0, 0,candidates[q_max, r_max]])
+            self.log_MAP_storage[0:3] = [0, 0, candidates[q_max, r_max]]
+            self.log_MAP_length = 3
 
             """STEP 4B.2: If r_max=0 => t-r_max = 1; r_max=1 => t-r_max = 0,
             so if the output later contains -1 as a CP, that means that the
-            most likely CP occured before the first data point was observed"""
-            self.MAP = np.array([[t-r_max], [q_max]])
-            self.MAP_segmentation = [np.array([[],[]]), np.array([[],[]]),
-                                     np.array([[t-r_max],[q_max]])]
+            most likely CP occured before the first data point was observed.
+            The segmentation at t=1 has no predecessor"""
+            self.MAP_first_cp = t-r_max
+            self.MAP_back_pointers[t] = -1
+            self.MAP_models[t] = q_max
+
+
+    def MAP_traceback(self, t=None):
+        """Reconstruct the MAP segmentation at time *t* (by default the last
+        processed time point) by following the back-pointers. Returns a
+        2 x (number of CPs) array whose first row holds the CPs and whose
+        second row holds the model indices of the segments."""
+        if t is None:
+            t = self.t
+        return map_traceback(self.MAP_back_pointers, self.MAP_models,
+                             self.MAP_first_cp, t)
+
+
+    @property
+    def MAP(self):
+        """The MAP segmentation at the last processed time point"""
+        return self.MAP_traceback()
 
 
 
     def trim_run_length_log_distributions(self, t):
         """Trim the distributions within each model object by calling a trimmer on
-        all model objects in the model universe. Pass the threshold down"""
+        all model objects in the model universe. Pass the threshold down,
+        or resample the run-lengths if *retention* is 'sor'.
+        Afterwards, fold the run-lengths beyond *max_run_length* and store
+        the folded probability mass"""
+        folded_log_masses = []
         for model in self.model_universe:
             #NOTE: Would be ideal to implement this on probability_model level!
-            model.trim_run_length_log_distrbution(t, self.threshold)
+            if self.retention == "sor":
+                model.resample_run_length_log_distribution(
+                    t, self.max_particles, self.rng)
+            else:
+                model.trim_run_length_log_distrbution(t, self.threshold)
+            log_MAP_weights = None
+            if self.max_run_length is not None and t > 1:
+                """The MAP candidate of a run-length r adds log P^MAP of
+                the time point before the run started, see 'MAP_estimate'"""
+                n = self.log_MAP_length
+                log_MAP_weights = self.log_MAP_storage[
+                    n - 1 - model.retained_run_lengths]
+            folded_log_masses.append(
+                model.fold_run_length_log_distribution(
+                    t, self.max_run_length, log_MAP_weights))
+        if self.max_run_length is not None:
+            self.storage_folded_log_mass[t-1] = (
+                scipy.special.logsumexp(folded_log_masses) - self.log_evidence)
 
 
     #DEBUG: Relocate to probability_model
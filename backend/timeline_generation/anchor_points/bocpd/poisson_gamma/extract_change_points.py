@@ -1,3 +1,5 @@
+import os
+import warnings
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
@@ -9,7 +11,11 @@ from scipy.special import logsumexp
 # Imported code from Yannis' scripts
 from .cp_probability_model import CpModel
 from .detector import Detector
+from .batched_detector import BatchedPGDetector
+from .mixture_detector import MixturePGDetector
+from .checkpoint import CheckpointError, save_detector_state, load_detector_state
 from .poisson_gamma_model import PGModel
+from ...postprocessing import postprocess_anchor_points
 from tqdm import tqdm
 
 
@@ -17,18 +23,62 @@ def poisson_bocpd(data,
                   prior_hazard=100, 
                   prior_alpha=1, 
                   prior_beta=1,
-                 visualize=False):
+                 visualize=False,
+                  max_run_length=None,
+                  max_particles=None,
+                  random_state=None,
+                  mode='full',
+                  compress_zeros=False):
     """
     
     Inputs:
     =======
     Data is a list of equally spaced points with each time-step
+    max_run_length bounds the run-lengths kept by the detector (None keeps all of them)
+    max_particles keeps at most that many run-lengths using stratified optimal resampling (None keeps all of them)
+    random_state seeds the resampling
+    mode='cps_only' skips the predictions and run-length distributions stored by the detector (O(T) instead of O(T^2) memory)
+    compress_zeros processes each streak of zero counts with one closed-form update (see Detector.next_zero_streak).
+        The result equals the step-by-step run up to floating point rounding.
     
     Outputs:
     =======
     Change-points, that are the indexes of the equally spaced points.
     """
     
+    detector = run_poisson_bocpd_detector(data,
+                                          prior_hazard=prior_hazard,
+                                          prior_alpha=prior_alpha,
+                                          prior_beta=prior_beta,
+                                          max_run_length=max_run_length,
+                                          max_particles=max_particles,
+                                          random_state=random_state,
+                                          mode=mode,
+                                          compress_zeros=compress_zeros)
+
+    return map_change_points(detector)
+
+
+def run_poisson_bocpd_detector(data,
+                               prior_hazard=100,
+                               prior_alpha=1,
+                               prior_beta=1,
+                               max_run_length=None,
+                               max_particles=None,
+                               random_state=None,
+                               mode='full',
+                               compress_zeros=False,
+                               cp_probability_lag=None):
+    """
+    Builds the Poisson-Gamma Detector for the (T x S1) array *data* and runs it over all time-steps.
+    With cp_probability_lag, the detector also records the CP probability of each day in the same pass
+    (see Detector.storage_cp_probability).
+    
+    Outputs:
+    =======
+    The Detector object after the last time-step.
+    """
+    
     data = np.array(data)
     firstdateindex = 0      
             
@@ -36,6 +86,7 @@ def poisson_bocpd(data,
     s2 = 1
     prior_means = 0 * np.ones(s1 * s2)
     pruning_threshold = None
+    retention = 'threshold' if max_particles is None else 'sor'
     
     # Create hazard model object
     cp_model = CpModel(prior_hazard)
@@ -44,6 +95,11 @@ def poisson_bocpd(data,
     prior_alpha = prior_alpha * np.ones(s1 * s2)
     prior_beta = prior_beta * np.ones(s1 * s2)
     
+    # With a bounded run-length, the buffers only need to hold the window
+    capacity = T + 1
+    if max_run_length is not None:
+        capacity = min(capacity, 2 * (max_run_length + 2))
+    
     # Create model object(s)
     pg_model = PGModel(
         prior_alpha,
@@ -52,6 +108,7 @@ def poisson_bocpd(data,
         s1,
         s2,
         auto_prior_update=False,
+        capacity=capacity,
     )
     
     # Create Detector object
@@ -62,14 +119,39 @@ def poisson_bocpd(data,
                         s1,
                         s2,
                         T,
-                        threshold=pruning_threshold)
+                        threshold=pruning_threshold,
+                        max_run_length=max_run_length,
+                        retention=retention,
+                        max_particles=max_particles,
+                        random_state=random_state,
+                        mode=mode,
+                        cp_probability_lag=cp_probability_lag)
     
     # Run detection algorithm
-    for t in range(0, T):
-        detector.next_run(data[t, :], t + 1)
+    if compress_zeros:
+        detector.run(start=1, stop=T + 1, compress_zeros=True)
+    else:
+        for t in range(0, T):
+            detector.next_run(data[t, :], t + 1)
+
+    return detector
+
+
+def map_change_points(detector):
+    """
+    Returns the change-points of the MAP segmentation of a Detector that has been run.
+    """
+    
+    return cps_from_MAP_segmentation(detector.MAP_traceback())
+
 
+def cps_from_MAP_segmentation(MAP_segmentation):
+    """
+    Returns the change-points of a MAP segmentation (first row: CPs, second row: models).
+    """
+    
     # Return MAP segmentation of CPS
-    cps = detector.MAP_segmentation[-1][0]
+    cps = MAP_segmentation[0]
     
     # Discard first CP, since it's initialized and arbitrary
     if len(cps) > 1:
@@ -81,6 +163,146 @@ def poisson_bocpd(data,
     return cps
 
 
+def cps_from_cp_probabilities(cp_probabilities, cutoff):
+    """
+    Returns the change-points at which the per-day CP probabilities (see Detector.storage_cp_probability) exceed
+    *cutoff*. A CP spreads its probability over neighbouring days, so each run of consecutive days above the cut-off
+    gives one change-point, at its most probable day. The first day is discarded, like the initial CP of the MAP
+    segmentation.
+    """
+    
+    probabilities = np.asarray(cp_probabilities, dtype=float)
+    above = probabilities >= cutoff
+    if len(above) > 0:
+        above[0] = False
+    
+    # Boundaries of the runs of days above the cut-off
+    edges = np.diff(np.concatenate(([0], above.astype(np.int8), [0])))
+    starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    
+    return np.array([start + np.argmax(probabilities[start:stop]) for start, stop in zip(starts, stops)], dtype=int)
+
+
+def batched_poisson_bocpd(data,
+                          lengths,
+                          prior_hazard=100,
+                          prior_alpha=1,
+                          prior_beta=1):
+    """
+    Runs the Poisson-Gamma BOCPD on N series at once.
+    
+    Inputs:
+    =======
+    data is an N x T array, where row i holds the lengths[i] equally spaced points of series i, padded arbitrarily
+    
+    Outputs:
+    =======
+    List with the change-points of each series, exactly as returned by poisson_bocpd for that series.
+    """
+    
+    detector = BatchedPGDetector(data, lengths, CpModel(prior_hazard), prior_alpha, prior_beta)
+    detector.run()
+    
+    return [cps_from_MAP_segmentation(detector.MAP_traceback(i)) for i in range(len(lengths))]
+
+
+def poisson_bocpd_mixture(data,
+                          prior_hazard=100,
+                          prior_alphas=(1,),
+                          prior_betas=(1,),
+                          model_prior=None):
+    """
+    Runs the Poisson-Gamma BOCPD with a mixture of Gamma priors, i.e. a model universe with one model per
+    (prior_alphas[q], prior_betas[q]), e.g. a quiet-poster and a heavy-poster regime.
+    
+    Inputs:
+    =======
+    data is a list/array of equally spaced points (T, or T x S for S series with common change-points)
+    model_prior is the prior probability of each model, uniform by default
+    
+    Outputs:
+    =======
+    Change-points, as returned by poisson_bocpd, and the index of the model of each segment after them.
+    """
+    
+    detector = MixturePGDetector(data, CpModel(prior_hazard), prior_alphas, prior_betas, model_prior=model_prior)
+    detector.run()
+    MAP_segmentation = detector.MAP_traceback()
+    cps = cps_from_MAP_segmentation(MAP_segmentation)
+    models = MAP_segmentation[1][MAP_segmentation.shape[1] - len(cps):].astype(int)
+    
+    return cps, models
+
+
+def poisson_bocpd_hazard_sweep(data,
+                               prior_hazards,
+                               prior_alpha=1,
+                               prior_beta=1):
+    """
+    Runs the Poisson-Gamma BOCPD for several hazard values in a single pass. The predictive probabilities
+    only depend on the data and alpha/beta, so they are computed once and shared by all hazards.
+    
+    Inputs:
+    =======
+    data is a list of equally spaced points (T or T x 1), prior_hazards a list of hazard values
+    
+    Outputs:
+    =======
+    List with the change-points for each hazard, exactly as returned by poisson_bocpd with that hazard,
+    and the array of final log evidences for each hazard.
+    """
+    
+    data = np.reshape(np.array(data), (1, -1))
+    detector = BatchedPGDetector(data, [data.shape[1]],
+                                 [CpModel(prior_hazard) for prior_hazard in prior_hazards],
+                                 prior_alpha, prior_beta)
+    detector.run()
+    
+    all_cps = [cps_from_MAP_segmentation(detector.MAP_traceback(0, h)) for h in range(detector.H)]
+    
+    return all_cps, detector.final_log_evidence(0)
+
+
+def max_run_length_diagnostic(data,
+                              max_run_length,
+                              prior_hazard=100,
+                              prior_alpha=1,
+                              prior_beta=1):
+    """
+    Compares a run with bounded maximum run-length against the exact run on the same data.
+    
+    Outputs:
+    =======
+    Dictionary with the change-points of both runs and the approximation errors:
+        'exact_cps', 'bounded_cps': change-points of the exact and the bounded run
+        'cps_match': whether both runs give the same change-points
+        'max_log_evidence_error': largest absolute difference of the log evidence over time
+        'max_run_length_tv_distance': largest total variation distance between the run-length distributions
+        'max_folded_mass': largest run-length probability mass folded in a single time-step
+    """
+    
+    exact = run_poisson_bocpd_detector(data, prior_hazard, prior_alpha, prior_beta)
+    bounded = run_poisson_bocpd_detector(data, prior_hazard, prior_alpha, prior_beta,
+                                         max_run_length=max_run_length)
+    
+    exact_cps = map_change_points(exact)
+    bounded_cps = map_change_points(bounded)
+    
+    # Total variation distance between the run-length distributions at each time-step
+    tv_distance = 0.5 * np.sum(np.abs(exact.storage_run_length_distr -
+                                      bounded.storage_run_length_distr), axis=1)
+    
+    return {
+        'exact_cps': exact_cps,
+        'bounded_cps': bounded_cps,
+        'cps_match': np.array_equal(exact_cps, bounded_cps),
+        'max_log_evidence_error': np.max(np.abs(exact.storage_log_evidence -
+                                                bounded.storage_log_evidence)),
+        'max_run_length_tv_distance': np.max(tv_distance),
+        'max_folded_mass': np.max(np.exp(bounded.storage_folded_log_mass)),
+    }
+
+
 
 
 def return_cps_from_poisson_gamma_bocpd_with_user_id(user_id, 
@@ -104,7 +326,8 @@ def return_cps_from_poisson_gamma_bocpd_with_user_id(user_id,
     cps = poisson_bocpd(poisson_input_data, 
                       prior_hazard=hazard,  # Higher -> more CPs.
                       prior_alpha=alpha, 
-                      prior_beta=beta)
+                      prior_beta=beta,
+                      mode='cps_only')
     
     if output_type == 'days':
         return list(cps.astype(int))
@@ -116,70 +339,199 @@ def return_cps_from_poisson_gamma_bocpd_with_user_id(user_id,
         
         
 def preprocess_user_feature_data(user_feature_data):
+    # A data frame holds several features, which become the columns of the lattice
+    if isinstance(user_feature_data, pd.DataFrame):
+        return user_feature_data.to_numpy(dtype=float)
     preprocessed_input_data = np.reshape(list(user_feature_data), (-1,1))
 
     return preprocessed_input_data
     
     
-def postprocess_anchor_points(user_feature_data, anchor_points, style='default'):
+def return_cps_from_bocpd_poisson_gamma_user_feature_data(user_feature_data, prior_hazard, prior_alpha, prior_beta, post_process='dates',
+                                                          mode='cps_only', compress_zeros=True):
+    """
+    Extracts the change-points of a user's feature series with the Poisson-Gamma BOCPD model.
+    If user_feature_data is a data frame of several features, they are modelled as independent series with
+    common change-points, and prior_alpha/prior_beta can be given per feature (one value per column).
+    Only the change-points are returned, so the detector runs in 'cps_only' mode by default.
+    Daily series are mostly zeros, so the streaks of zero days are compressed by default.
+    """
+    # Pre-processing
+    input_data = preprocess_user_feature_data(user_feature_data)
+    
+    # Extract change-points
+    cps = poisson_bocpd(input_data,
+                  prior_hazard=prior_hazard, 
+                  prior_alpha=prior_alpha, 
+                  prior_beta=prior_beta,
+                  visualize=False,
+                  mode=mode,
+                  compress_zeros=compress_zeros)
     
-    # Remove duplicate anchor points
-    anchor_points = list(set(anchor_points))
+    # Post-processing
+    cps = postprocess_anchor_points(user_feature_data, cps, style=post_process)
+        
+    return cps
+
+
+def return_cps_and_cp_probabilities_from_bocpd_poisson_gamma_user_feature_data(user_feature_data, prior_hazard, prior_alpha,
+                                                                             prior_beta, cp_probability_lag=7,
+                                                                             post_process='dates'):
+    """
+    Same as return_cps_from_bocpd_poisson_gamma_user_feature_data, but the same pass of the detector also records the
+    probability that a new segment starts on each day, given the *cp_probability_lag* following days.
+    The probabilities can be turned into change-points at any cut-off with cps_from_cp_probabilities, without
+    running the detector again.
     
-    # Check if any anchor points exist
-    if len(anchor_points) == 0:
-        return anchor_points  # Return empty list of anchor points
+    Outputs:
+    ========
+    The post-processed MAP change-points, and the CP probabilities as a float32 series with the index of
+    user_feature_data.
+    """
+    # Pre-processing
+    input_data = preprocess_user_feature_data(user_feature_data)
     
-    # Continue postprocessing, if points exist
-    else:
-        # Sort in ascending order
-        anchor_points.sort()
+    # Extract change-points and CP probabilities
+    detector = run_poisson_bocpd_detector(input_data,
+                                          prior_hazard=prior_hazard,
+                                          prior_alpha=prior_alpha,
+                                          prior_beta=prior_beta,
+                                          mode='cps_only',
+                                          compress_zeros=True,
+                                          cp_probability_lag=cp_probability_lag)
+    cps = map_change_points(detector)
+    cp_probabilities = pd.Series(detector.storage_cp_probability, index=user_feature_data.index)
+    
+    # Post-processing
+    cps = postprocess_anchor_points(user_feature_data, cps, style=post_process)
+    
+    return cps, cp_probabilities
 
-        if style == 'default':
-            return anchor_points
-        
-        # Check type of data
-        data_type = type(anchor_points[0])
-        
-        # Convert datapoints into datetimes.
-        if style == 'dates':
-            return convert_days_since_to_datetimes(user_feature_data, anchor_points)
 
-            
-            
-def convert_np_dt_to_dt(dt64):
-    return pd.to_datetime(dt64).date()
-    
-def convert_days_since_to_datetimes(user_feature_data, anchor_points):
-    # Convert days to datetimes.
-    dt_points = pd.Series(user_feature_data.index)[anchor_points].values
-    dt_points = list(dt_points)
-
-    # Convert NumPy DateTime object to a datetime Date object.
-    converted_dts = []
-    for np_dt in dt_points:
-        converted = convert_np_dt_to_dt(np_dt)
-        converted_dts.append(converted)
-
-    # Update with dates
-    return converted_dts
-        
+def return_cps_from_bocpd_poisson_gamma_checkpoint(user_feature_data, checkpoint_path, prior_hazard, prior_alpha, prior_beta,
+                                                   post_process='dates', save_path=None):
+    """
+    Incremental version of return_cps_from_bocpd_poisson_gamma_user_feature_data for a feature series that grows over
+    time. The detector state is kept in the checkpoint file at *checkpoint_path* (see checkpoint.py). If it was saved
+    for the same priors and its observations are a prefix of *user_feature_data*, the detector is only run over the
+    new days. Otherwise (no checkpoint, unreadable checkpoint, different priors or changed history) it is run over
+    the whole series, with a RuntimeWarning if the checkpoint could not be loaded (see checkpoint.CheckpointError).
+    The updated state is then saved to *save_path*, by default the checkpoint itself.
     
-def return_cps_from_bocpd_poisson_gamma_user_feature_data(user_feature_data, prior_hazard, prior_alpha, prior_beta, post_process='dates'):
+    Outputs:
+    ========
+    The post-processed change-points, as return_cps_from_bocpd_poisson_gamma_user_feature_data.
     """
+    # Pre-processing
+    input_data = preprocess_user_feature_data(user_feature_data)
+    metadata = {
+        'prior_hazard': float(prior_hazard),
+        'prior_alpha': np.asarray(prior_alpha, dtype=float).tolist(),
+        'prior_beta': np.asarray(prior_beta, dtype=float).tolist(),
+        'first_day': str(user_feature_data.index[0]) if len(user_feature_data) > 0 else None,
+    }
+    
+    # Resume from the checkpoint, if it is compatible with the data
+    detector = None
+    if os.path.exists(checkpoint_path):
+        try:
+            detector, stored_metadata = load_detector_state(checkpoint_path)
+        except CheckpointError as e:
+            # e.g. a truncated file, which is replaced below
+            warnings.warn(f"Ignoring detector checkpoint: {e}", RuntimeWarning)
+        else:
+            t = detector.t
+            if (stored_metadata != metadata or t > len(input_data) or
+                    not np.array_equal(detector.data[:t], input_data[:t])):
+                detector = None
     
+    # Extract change-points
+    if detector is None:
+        detector = run_poisson_bocpd_detector(input_data,
+                                              prior_hazard=prior_hazard,
+                                              prior_alpha=prior_alpha,
+                                              prior_beta=prior_beta,
+                                              mode='cps_only',
+                                              compress_zeros=True)
+    else:
+        t = detector.t
+        detector.extend(input_data[t:])
+        detector.run(start=t + 1, stop=len(input_data) + 1, compress_zeros=True)
+    save_detector_state(detector, checkpoint_path if save_path is None else save_path, metadata=metadata)
+    cps = map_change_points(detector)
+    
+    # Post-processing
+    cps = postprocess_anchor_points(user_feature_data, cps, style=post_process)
+    
+    return cps
+
+
+def return_cps_from_bocpd_poisson_gamma_mixture(user_feature_data, prior_hazard, prior_alphas, prior_betas, post_process='dates'):
+    """
+    Extracts the change-points of a user's feature series (or data frame of features) with a mixture of
+    Poisson-Gamma priors, see poisson_bocpd_mixture. Each entry of prior_alphas/prior_betas is one model,
+    and may be a list with one value per feature.
     """
     # Pre-processing
     input_data = preprocess_user_feature_data(user_feature_data)
     
     # Extract change-points
-    cps = poisson_bocpd(input_data,
-                  prior_hazard=prior_hazard, 
-                  prior_alpha=prior_alpha, 
-                  prior_beta=prior_beta,
-                  visualize=False)
+    cps, _ = poisson_bocpd_mixture(input_data,
+                                   prior_hazard=prior_hazard,
+                                   prior_alphas=prior_alphas,
+                                   prior_betas=prior_betas)
     
     # Post-processing
     cps = postprocess_anchor_points(user_feature_data, cps, style=post_process)
         
-    return cps
\ No newline at end of file
+    return cps
+
+
+def return_cps_from_bocpd_poisson_gamma_hazard_sweep(user_feature_data, prior_hazards, prior_alpha, prior_beta, post_process='dates'):
+    """
+    Extracts the change-points of a user's feature series for several hazard values in one pass.
+    
+    Outputs:
+    ========
+    Dictionary mapping each hazard value to its post-processed change-points.
+    """
+    # Pre-processing
+    input_data = preprocess_user_feature_data(user_feature_data)
+    
+    # Extract change-points
+    all_cps, _ = poisson_bocpd_hazard_sweep(input_data,
+                                            prior_hazards,
+                                            prior_alpha=prior_alpha,
+                                            prior_beta=prior_beta)
+    
+    # Post-processing
+    return {prior_hazard: postprocess_anchor_points(user_feature_data, cps, style=post_process)
+            for prior_hazard, cps in zip(prior_hazards, all_cps)}
+
+
+def return_cps_from_bocpd_poisson_gamma_multi_user_feature_data(users_feature_data, prior_hazard, prior_alpha, prior_beta, post_process='dates'):
+    """
+    Batched version of return_cps_from_bocpd_poisson_gamma_user_feature_data for a dictionary of users' feature data
+    (e.g. {user_id: posts per day Series}). All users are run through one BatchedPGDetector.
+    
+    Outputs:
+    ========
+    Dictionary with the post-processed change-points of each user.
+    """
+    user_ids = list(users_feature_data.keys())
+    
+    # Pad the series into one array
+    lengths = np.array([len(users_feature_data[user_id]) for user_id in user_ids], dtype=int)
+    data = np.zeros(shape=(len(user_ids), max(lengths, default=0)))
+    for i, user_id in enumerate(user_ids):
+        data[i, :lengths[i]] = preprocess_user_feature_data(users_feature_data[user_id])[:, 0]
+    
+    # Extract change-points
+    all_cps = batched_poisson_bocpd(data, lengths,
+                                    prior_hazard=prior_hazard,
+                                    prior_alpha=prior_alpha,
+                                    prior_beta=prior_beta)
+    
+    # Post-processing
+    return {user_id: postprocess_anchor_points(users_feature_data[user_id], cps, style=post_process)
+            for user_id, cps in zip(user_ids, all_cps)}
@@ -0,0 +1,112 @@
+"""
+Grid and random search over the hyperparameters (alpha, beta, hazard) of the Poisson-Gamma BOCPD model.
+
+Each configuration is scored by the final log evidence of the detector, log p(y_{1:T} | alpha, beta, hazard).
+Configurations sharing the same (alpha, beta) prior share their predictive probabilities, so each prior is
+evaluated by one worker with a single hazard sweep (see poisson_bocpd_hazard_sweep). The priors are fanned out
+over a ProcessPoolExecutor, and the daily series is put in shared memory once instead of being pickled for
+every task.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .extract_change_points import poisson_bocpd_hazard_sweep
+
+
+def grid_search_poisson_bocpd(data,
+                              alphas,
+                              betas,
+                              hazards,
+                              n_random=None,
+                              max_workers=None,
+                              random_state=None):
+    """
+    Inputs:
+    =======
+    data = List/array of equally spaced counts (T or T x 1).
+    alphas, betas, hazards = Lists of candidate values, spanning the grid of configurations.
+    n_random = Int. If given, only this many configurations are sampled at random from the grid (random search).
+    max_workers = Int. Number of worker processes, defaults to the number of cores. With 1, runs in this process.
+    random_state = Seed for the random search.
+
+    Outputs:
+    ========
+    Dictionary with:
+        'best': dict with the 'alpha', 'beta', 'hazard' of the highest log evidence, its 'log_evidence' and 'cps'
+        'log_evidence': array of shape (len(alphas), len(betas), len(hazards)), the evidence surface.
+                        Configurations that were not evaluated (random search) are NaN.
+    """
+    data = np.ascontiguousarray(np.reshape(np.array(data, dtype=float), -1))
+    alphas, betas, hazards = list(alphas), list(betas), list(hazards)
+
+    # Select the configurations to evaluate, as a boolean mask over the grid
+    shape = (len(alphas), len(betas), len(hazards))
+    selected = np.ones(shape, dtype=bool)
+    if n_random is not None and n_random < selected.size:
+        rng = np.random.default_rng(random_state)
+        selected = np.zeros(selected.size, dtype=bool)
+        selected[rng.choice(selected.size, size=n_random, replace=False)] = True
+        selected = selected.reshape(shape)
+
+    # One task per (alpha, beta) prior, sweeping all of its selected hazards
+    tasks = []
+    for a in range(len(alphas)):
+        for b in range(len(betas)):
+            hazard_indices = np.flatnonzero(selected[a, b])
+            if len(hazard_indices) > 0:
+                tasks.append((a, b, hazard_indices))
+
+    log_evidence = np.full(shape, np.nan)
+    all_cps = {}
+
+    if max_workers == 1:
+        results = [poisson_bocpd_hazard_sweep(data, [hazards[h] for h in hazard_indices],
+                                              prior_alpha=alphas[a], prior_beta=betas[b])
+                   for a, b, hazard_indices in tasks]
+    else:
+        # Put the series in shared memory, so that the workers only receive its name
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        try:
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+            with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+                futures = [executor.submit(_evaluate_prior, shm.name, data.shape, data.dtype.str,
+                                           alphas[a], betas[b], [hazards[h] for h in hazard_indices])
+                           for a, b, hazard_indices in tasks]
+                results = [future.result() for future in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # Collect the evidence surface
+    for (a, b, hazard_indices), (cps, evidences) in zip(tasks, results):
+        log_evidence[a, b, hazard_indices] = evidences
+        for h, c in zip(hazard_indices, cps):
+            all_cps[(a, b, h)] = c
+
+    a, b, h = np.unravel_index(np.nanargmax(log_evidence), shape)
+    best = {
+        'alpha': alphas[a],
+        'beta': betas[b],
+        'hazard': hazards[h],
+        'log_evidence': log_evidence[a, b, h],
+        'cps': all_cps[(a, b, h)],
+    }
+
+    return {'best': best, 'log_evidence': log_evidence}
+
+
+def _evaluate_prior(shm_name, shape, dtype, alpha, beta, hazards):
+    """
+    Worker: attaches to the shared series and runs the hazard sweep for one (alpha, beta) prior.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.array(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    finally:
+        shm.close()
+
+    return poisson_bocpd_hazard_sweep(data, hazards, prior_alpha=alpha, prior_beta=beta)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Implements the MixturePGDetector, which runs the Poisson-Gamma
+BOCPD of the Detector class with a model universe of Q PGModels that only
+differ in their Gamma priors (e.g. a 'quiet poster' and a 'heavy poster'
+regime). Instead of looping over the model objects at every time step, the
+run-length recursions of all Q models are stacked as the rows of arrays and
+advanced together with vectorized numpy operations.
+
+Without pruning, all models retain the same run-lengths, and their posterior
+means only depend on the data and the run-length, not on the prior. The means
+are therefore stored and updated once and shared by all models.
+
+The steps of the recursion are those of run_length_recursion.py and
+poisson_gamma_model.py, shared with the Detector and the BatchedPGDetector,
+so the mixture detector performs the same floating point operations as the
+Detector with Q PGModels (no pruning, prior mean 0, no automatic prior
+updates, mode 'cps_only'), and the MAP segmentation, including the model
+index of each segment, is exactly the same.
+"""
+
+import numpy as np
+import scipy
+from scipy.special import gammaln
+
+from .poisson_gamma_model import (nbinom_log_pmf, nbinom_log_prob_tables,
+                                  update_posterior_means)
+from .run_length_recursion import (initial_log_probabilities,
+                                   grow_joint_log_probabilities,
+                                   map_candidates, map_traceback)
+
+
+class MixturePGDetector:
+    """Poisson-Gamma BOCPD with a model universe of Q Gamma priors.
+
+    The run-length indexed quantities are stored in preallocated arrays with
+    T+1 columns, filled from the right (the newest run-length r=0 is added at
+    the front), as in the BatchedPGDetector.
+
+    Attributes:
+        data: float numpy array;
+            the T x S count series, i.e. S independent series with common
+            change points (S=1 for a univariate series)
+        cp_model: CpModel object;
+            the CP model shared by all models
+        prior_alphas, prior_betas: float numpy arrays; Q x S
+            the Gamma prior of each model and series
+        log_model_prior: float numpy array;
+            the log prior probability of each model
+        means: float numpy array; (T+1) x S
+            at time t, the rows [T-t:] hold the posterior means for
+            r=0,1,...,t, shared by all models
+        joint_log_probabilities: float numpy array; Q x (T+1)
+            at time t, the entries [:, T-t:] hold the joint log
+            probabilities (y_{1:t}, r_t| q) for r=0,1,...,t
+        model_log_evidence: float numpy array; Q
+            the log evidence of each model at the current time point
+        storage_log_evidence: float numpy array; T
+            the log evidence at each time point
+        MAP_back_pointers, MAP_models: int numpy arrays; T+1
+            the back-pointers and segment models of the MAP recursion, see
+            Detector
+    """
+
+    def __init__(self, data, cp_model, prior_alphas, prior_betas,
+                 model_prior=None):
+        """Construct the mixture detector for the count series *data* (of
+        length T, or T x S) with one model per entry of *prior_alphas* and
+        *prior_betas*. An entry may be a scalar or a vector of length S. The
+        *model_prior* defaults to the uniform distribution over the models"""
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        self.data = data
+        self.T, self.S = data.shape
+        self.Q = len(prior_alphas)
+        self.cp_model = cp_model
+        self.prior_alphas = np.broadcast_to(np.asarray(
+            prior_alphas, dtype=float).reshape(self.Q, -1), (self.Q, self.S))
+        self.prior_betas = np.broadcast_to(np.asarray(
+            prior_betas, dtype=float).reshape(self.Q, -1), (self.Q, self.S))
+        if model_prior is None:
+            model_prior = np.ones(self.Q) / self.Q
+        self.log_model_prior = np.log(np.asarray(model_prior, dtype=float))
+        self.t = 0
+
+        """STEP 1: Allocate the run-length indexed quantities once"""
+        self.means = np.zeros(shape=(self.T + 1, self.S))
+        self.joint_log_probabilities = -np.inf * np.ones(
+            shape=(self.Q, self.T + 1))
+        self.retained_run_lengths = np.arange(self.T + 1)
+        self.model_log_evidence = -np.inf * np.ones(self.Q)
+        self.log_evidence = -np.inf
+        self.log_hazard, self.log_one_minus_hazard = (
+            cp_model.log_hazard_vector(1, 2))
+
+        """STEP 2: The negative binomial log(p), log(1-p) of each model for
+        each factor r+1, exactly as in PGModel.log_probability_tables"""
+        factors = np.arange(self.T + 2)
+        self.log_prob_table, self.log_one_minus_prob_table = (
+            nbinom_log_prob_tables(self.prior_betas[:, np.newaxis, :],
+                                   factors[np.newaxis, :, np.newaxis]))
+
+        """STEP 3: Storage for the evidence and the MAP recursion"""
+        self.storage_log_evidence = -np.inf * np.ones(self.T)
+        self.log_MAP_storage = np.zeros(self.T + 2)
+        self.MAP_back_pointers = np.zeros(self.T + 1, dtype=int)
+        self.MAP_models = np.zeros(self.T + 1, dtype=int)
+        self.MAP_first_cp = 0
+
+
+    def run(self):
+        """Run the detector over all time points"""
+        for t in range(self.t + 1, self.T + 1):
+            self.next_run(t)
+
+
+    def next_run(self, t):
+        """Process the observation at time *t* with all models"""
+        y = self.data[t-1]
+        if t == 1:
+            self.initialization(y)
+        else:
+            self.update_joint_log_probabilities(y, t)
+            self.update_predictive_distributions(y, t)
+        self.log_evidence = scipy.special.logsumexp(self.model_log_evidence)
+        self.storage_log_evidence[t-1] = self.log_evidence
+        self.MAP_estimate(t)
+        self.t = t
+
+
+    def initialization(self, y):
+        """Same as PGModel.initialization for each model, with a CP at t=0
+        with probability one"""
+        size = self.prior_alphas + 0.0
+        self.model_log_evidence = (self.log_model_prior +
+            np.sum(nbinom_log_pmf(y, size, self.log_prob_table[:, 0, :],
+                                  self.log_one_minus_prob_table[:, 0, :],
+                                  gammaln(y + 1)), axis=1))
+
+        log_cp, log_no_cp = initial_log_probabilities(self.cp_model)
+        self.joint_log_probabilities[:, -2] = self.model_log_evidence + log_cp
+        self.joint_log_probabilities[:, -1] = (self.model_log_evidence +
+                                               log_no_cp)
+        self.means[-2:] = y
+
+
+    def update_joint_log_probabilities(self, y, t):
+        """Same as ProbabilityModel.update_joint_log_probabilities for each
+        model. At time t, the run-lengths r=0,...,t-1 of the previous time
+        point are in the columns T-t+1,...,T"""
+        start = self.T - t + 1
+        factors = self.retained_run_lengths[:t] + 1
+
+        """STEP 1: Predictive log probabilities of all models for all
+        run-lengths"""
+        size = (self.prior_alphas[:, np.newaxis, :] +
+                factors[np.newaxis, :, np.newaxis] *
+                self.means[np.newaxis, start:, :])
+        predictive_log_probs = np.sum(nbinom_log_pmf(
+            y, size, self.log_prob_table[:, factors, :],
+            self.log_one_minus_prob_table[:, factors, :], gammaln(y + 1)),
+            axis=2)
+
+        """STEP 2-3: Growth and CP probabilities"""
+        self.joint_log_probabilities[:, start-1] = grow_joint_log_probabilities(
+            self.joint_log_probabilities[:, start:], predictive_log_probs,
+            self.log_hazard, self.log_one_minus_hazard)
+
+        """STEP 4: Evidence of each model"""
+        self.model_log_evidence = scipy.special.logsumexp(
+            self.joint_log_probabilities[:, start-1:], axis=1)
+
+
+    def update_predictive_distributions(self, y, t):
+        """Same as PGModel.update_predictive_distributions, done once for
+        all models"""
+        start = self.T - t + 1
+        update_posterior_means(self.means[start:],
+                               self.retained_run_lengths[:t, np.newaxis], y)
+        self.means[start-1] = y
+
+
+    def MAP_estimate(self, t):
+        """Same as Detector.MAP_estimate. After the first time point, the
+        retained run-lengths are r=0,1,...,t for all models, so the column
+        of the maximizing candidate is its run-length"""
+        start = self.T - t
+        log_densities = (self.joint_log_probabilities[:, start:] -
+                         self.model_log_evidence[:, np.newaxis])
+        if t > 1:
+            candidates = map_candidates(log_densities,
+                                        self.log_MAP_storage[:t+1])
+        else:
+            candidates = log_densities
+        q_max, r_max = np.unravel_index(np.argmax(candidates),
+                                        candidates.shape)
+        if t > 1:
+            self.log_MAP_storage[t+1] = candidates[q_max, r_max]
+            self.MAP_back_pointers[t] = t - r_max - 1
+        else:
+            """At t=1, the candidate r=0 is always the larger one by
+            construction of the initialization"""
+            self.log_MAP_storage[0:3] = [0, 0, candidates[q_max, r_max]]
+            self.MAP_first_cp = t - r_max
+            self.MAP_back_pointers[t] = -1
+        self.MAP_models[t] = q_max
+
+
+    def MAP_traceback(self, t=None):
+        """Reconstruct the MAP segmentation at time *t* (by default the last
+        processed time point), in the same format as Detector.MAP_traceback,
+        i.e. with the model index of each segment in the second row"""
+        if t is None:
+            t = self.t
+        return map_traceback(self.MAP_back_pointers, self.MAP_models,
+                             self.MAP_first_cp, t)
@@ -10,10 +10,45 @@ uncorrelated & independent, yet have common change points.
 """
 
 import numpy as np
-from scipy import stats
+from scipy.special import gammaln, log1p
 import scipy
 from .probability_model import ProbabilityModel
 from .cp_probability_model import CpModel
+from .run_length_buffer import RunLengthBuffer
+from .run_length_recursion import initial_log_probabilities
+
+
+def nbinom_log_pmf(y, size, log_prob, log_one_minus_prob, log_y_factorial):
+    """Closed-form log pmf of the negative binomial distribution with
+    *size* and success probability prob, i.e. the formula used by
+    scipy.stats.nbinom.logpmf, but without the argument checking and
+    broadcasting overhead of scipy's distribution objects. It is given
+    log(prob), log(1-prob) and the log(y!) of the observation *y*, so that
+    these can be precomputed/cached by the caller.
+
+    NOTE: log(1-prob) should be computed with scipy.special.log1p, which
+    is what scipy.stats.nbinom.logpmf uses."""
+    return (gammaln(size + y) - log_y_factorial - gammaln(size) +
+            size * log_prob + y * log_one_minus_prob)
+
+
+def nbinom_log_prob_tables(prior_beta, factors):
+    """Returns log(p) and log(1-p) of the negative binomial predictive for
+    the *factors* r+1 of the run-lengths r, where p = 1 - 1/(beta + r + 2).
+    *prior_beta* and *factors* are broadcast against each other"""
+    prob = 1 - (1 / (prior_beta + factors + 1))
+    return np.log(prob), log1p(-prob)
+
+
+def update_posterior_means(means, run_lengths, y):
+    """Updates the posterior *means* of the *run_lengths* with the new
+    observation *y* in place, i.e. the mean of the last r+1 observations
+    becomes the mean of the last r+2. *run_lengths* and *y* are broadcast
+    against *means*"""
+    fac1 = 1.0/(run_lengths+2)
+    fac2 = run_lengths+1
+    means *= fac1*fac2
+    means += fac1*y
 
 
 class PGModel(ProbabilityModel):
@@ -36,6 +71,10 @@ class PGModel(ProbabilityModel):
             Indicates whether the prior_mean and prior_var should be updated
             to the posterior expectation and posterior variance at each time
             step. Default is False.
+        capacity: int;
+            number of run-lengths for which memory is allocated up front,
+            i.e. T+1 for T observations. If None, the run-length buffers
+            start small and grow geometrically. Default is None.
 
     Internal Attributes:
         means: float numpy array; dimension S1xS2x(t+1) at time t
@@ -46,18 +85,25 @@ class PGModel(ProbabilityModel):
             lattice again. (I.e., has two dimensions)
             This object stores at position r the posterior means corresponding
             to the run length of r=0,1,...,t at each time t.
+            It is a view into *means_buffer*.
         joint_log_probabilities: float numpy array; dimension t+1 at time t
             stores the joint log probabilities (y_{1:t}, r_t| q) for this
             model q and all potential run lengths r_t = 0,1,...t-1
         model_log_evidence: float;
             stores in a scalar the evidence for this model, i.e. the joint
             probability (y_{1:t}| q) for this model q.
+        log_prob_table, log_one_minus_prob_table: float numpy arrays;
+            log(p) and log(1-p) of the negative binomial predictive for
+            each factor r+1, where p = 1 - 1/(beta + r + 2). These only
+            depend on the prior and the run-length, so they are computed
+            once and grown when longer run-lengths occur.
     """
 
 
     def __init__(self, prior_alpha, prior_beta, prior_mean,
                  S1, S2,
-                 auto_prior_update=False):
+                 auto_prior_update=False,
+                 capacity=None):
         """Construct a naive PG probability model, providing a prior
         as ...
 
@@ -83,12 +129,35 @@ class PGModel(ProbabilityModel):
         self.prior_mean = prior_mean.reshape(S1,S2)
         self.auto_prior_update = auto_prior_update
 
-        """initialize all the quantities that we compute through time"""
+        """initialize all the quantities that we compute through time. Those
+        indexed by run-length are stored in preallocated buffers"""
+        super().__init__(capacity)
+        self.means_buffer = RunLengthBuffer(capacity)
+        self.retained_run_lengths_buffer = RunLengthBuffer(capacity, dtype=int)
         self.means = None
         self.S1, self.S2 = S1, S2
         self.joint_log_probabilities = None
         self.model_log_evidence = -np.inf
         self.retained_run_lengths = None
+        self.log_prob_table = None
+        self.log_one_minus_prob_table = None
+
+
+    @property
+    def means(self):
+        return self.means_buffer.view()
+
+    @means.setter
+    def means(self, values):
+        self.means_buffer.assign(values)
+
+    @property
+    def retained_run_lengths(self):
+        return self.retained_run_lengths_buffer.view()
+
+    @retained_run_lengths.setter
+    def retained_run_lengths(self, values):
+        self.retained_run_lengths_buffer.assign(values)
 
 
     def initialization(self, y, cp_model, model_prior):
@@ -98,7 +167,7 @@ class PGModel(ProbabilityModel):
         object containing the PGModel object.
         """
         y = y.reshape(self.S1, self.S2)
-        prob = 1 - (1 / (self.prior_beta + 1))
+        log_prob, log_one_minus_prob = self.log_probability_tables(0)
         size = self.prior_alpha + self.prior_mean
 
         """Evaluate the negative binomial pmf corresponding to the observations, and
@@ -107,7 +176,9 @@ class PGModel(ProbabilityModel):
         ProbabilityModel object only when the joint probabilities
         are updated"""
         self.model_log_evidence = (np.log(model_prior) +
-                                    np.sum(stats.nbinom.logpmf(y, size, prob)))
+                                    np.sum(nbinom_log_pmf(y, size,
+                                        log_prob[0], log_one_minus_prob[0],
+                                        gammaln(y + 1))))
                                    # np.sum(stats.nbinom.logpmf(y, self.prior_alpha, (self.prior_beta)/(self.prior_beta+1))))
         """STEP 2: get the hazard/probability of CP using *cp_model* as passed
         to the probability model from the containing Detector object. Obtain
@@ -116,20 +187,13 @@ class PGModel(ProbabilityModel):
         since the hazard function (i.e., the conditional probability of
         r_t = r| r_{t-1} = r' can be used from here on"""
 
-        """Ensure that we do not get np.log(0)=np.inf by perturbation"""
-        if cp_model.pmf_0(1) == 0:
-            epsilon = 0.005
-        else:
-            epsilon = 0
-
         """get log-probs for r_1=0 or r_1>0. Typically, we assume that the
         first observation corresponds to a CP (i.e. P(r_1 = 0) = 1),
         but this need not be the case in general."""
         # DRM^E(1, 0, q) ← m(q) · D(1, q)
-        r_equal_0 = (self.model_log_evidence +
-                     np.log(cp_model.pmf_0(0) + epsilon))
-        r_larger_0 = (self.model_log_evidence +
-                     np.log(cp_model.pmf_0(1)+ epsilon))
+        log_cp, log_no_cp = initial_log_probabilities(cp_model)
+        r_equal_0 = self.model_log_evidence + log_cp
+        r_larger_0 = self.model_log_evidence + log_no_cp
         self.joint_log_probabilities = np.array([r_equal_0, r_larger_0])
         self.retained_run_lengths = np.array([0,0])
 
@@ -159,16 +223,35 @@ class PGModel(ProbabilityModel):
         # print('self.retained_run_lengths',self.retained_run_lengths)
         # print('self.retained_run_lengths.shape',self.retained_run_lengths.shape)
 
-        prob = 1 - (1 / (self.prior_beta + factors[:,np.newaxis,np.newaxis] + 1))
+        log_prob, log_one_minus_prob = self.log_probability_tables(
+            np.max(factors))
         size = self.prior_alpha + (factors[:,np.newaxis,np.newaxis]) * self.means#[t-1,:,:]
 
         """evaluate *y* using *prob* as prob and *size* as size.
         Compute predictive probability  using negative binomial pmf,
-        assuming independence of all locations/series.
+        assuming independence of all locations/series. log(y!) is computed
+        once for the observation rather than once per run-length.
         This will return a vector of size t+1 corresponding to the predictive
         distributions under r=0,1,...,t-1, >t-1"""
 
-        return np.sum(stats.nbinom.logpmf(y, size, prob), axis=(1,2))
+        return np.sum(nbinom_log_pmf(y, size, log_prob[factors],
+                                     log_one_minus_prob[factors],
+                                     gammaln(y + 1)), axis=(1,2))
+
+    def log_probability_tables(self, max_factor):
+        """Returns *log_prob_table* and *log_one_minus_prob_table*, making
+        sure that they cover the factors 0,1,...,max_factor. If they do
+        not, they are recomputed for (at least) twice as many factors"""
+        if (self.log_prob_table is None or
+                self.log_prob_table.shape[0] <= max_factor):
+            size = max_factor + 1
+            if self.log_prob_table is not None:
+                size = max(size, 2 * self.log_prob_table.shape[0])
+            factors = np.arange(size)
+            self.log_prob_table, self.log_one_minus_prob_table = (
+                nbinom_log_prob_tables(self.prior_beta,
+                                       factors[:,np.newaxis,np.newaxis]))
+        return self.log_prob_table, self.log_one_minus_prob_table
 
     # def evaluate_log_prior_predictive(self, y, t):
     #     """Returns the prior log density of the predictive distribution
@@ -203,11 +286,6 @@ class PGModel(ProbabilityModel):
         """STEP 0: Get the new observation into the right shape"""
         y = y.reshape(self.S1, self.S2)
 
-        """STEP 0.1: global helper quantity for mean computation"""
-        # fac = self.retained_run_lengths
-        fac1 = 1.0/(self.retained_run_lengths+2)
-        fac2 = self.retained_run_lengths+1
-
         """STEP 1: MEAN
         The sufficient statistics for the means are updated.
         Note that this requires the knowledge of the true posterior
@@ -216,14 +294,53 @@ class PGModel(ProbabilityModel):
         """STEP 1.1: update the means from t-r to t to the means from t-r to
         t+1 and add the t+1 th observation as the mean for r=0"""
 
-        self.means = (self.means * (fac1*fac2)[:,np.newaxis, np.newaxis] + fac1[:,np.newaxis, np.newaxis]*y) # for r \neq 0
-        self.means = np.insert(self.means, 0, y, axis=0) # for r = 0
+        update_posterior_means(self.means, # for r \neq 0
+            self.retained_run_lengths[:,np.newaxis, np.newaxis], y)
+        self.means_buffer.prepend(y) # for r = 0
 
 
         """STEP 4: Update retained_run_lengths in two steps: First by advancing
         the run lengths, second by adding the 0-run-length from this run."""
-        self.retained_run_lengths = self.retained_run_lengths + 1
-        self.retained_run_lengths = np.insert(self.retained_run_lengths, 0, 0)
+        retained_run_lengths = self.retained_run_lengths
+        retained_run_lengths += 1
+        self.retained_run_lengths_buffer.prepend(0)
+
+    def zero_streak_log_predictive(self, steps, new_segment=False):
+        """Returns the log probability of observing *steps*[j] zero lattices
+        in a row under the predictive posteriors of all retained run-lengths,
+        as a len(steps) x (number of run-lengths) array. If *new_segment* is
+        True, it is instead computed for a single run-length r=0 whose
+        observation was a zero lattice.
+
+        A zero observation leaves the sum S = (r+1)*means of the run-length
+        r unchanged, so the one-step predictive log probabilities
+        (alpha + S)*log((beta+r+1)/(beta+r+2)) telescope over j steps to
+        (alpha + S)*log((beta+r+1)/(beta+r+1+j))"""
+        steps = np.asarray(steps)[:,np.newaxis,np.newaxis,np.newaxis]
+        if new_segment:
+            run_lengths = np.zeros(1, dtype=int)
+            sums = np.zeros((1, self.S1, self.S2))
+        else:
+            run_lengths = self.retained_run_lengths
+            sums = (run_lengths + 1)[:,np.newaxis,np.newaxis] * self.means
+        shifted_beta = (self.prior_beta +
+                        (run_lengths + 1)[:,np.newaxis,np.newaxis])
+        return np.sum((self.prior_alpha + sums) *
+                      (np.log(shifted_beta) - np.log(shifted_beta + steps)),
+                      axis=(2,3))
+
+    def update_predictive_distributions_zero_streak(self, k):
+        """Same as *k* calls of 'update_predictive_distributions' with a
+        zero lattice. The means of the retained run-lengths are scaled by
+        (r+1)/(r+1+k) and the k new run-lengths r=0,...,k-1 have mean 0"""
+        means = self.means
+        means *= ((self.retained_run_lengths + 1) /
+                  (self.retained_run_lengths + 1 + k))[:,np.newaxis, np.newaxis]
+        self.means_buffer.prepend_block(np.zeros((k, self.S1, self.S2)))
+
+        retained_run_lengths = self.retained_run_lengths
+        retained_run_lengths += k
+        self.retained_run_lengths_buffer.prepend_block(np.arange(k))
 
     def get_posterior_expectation(self, t, r_list=None):
         """get the predicted value/expectation from the current posteriors
@@ -298,16 +415,23 @@ class PGModel(ProbabilityModel):
         """Computes the log-density of *y* under the prior. Unused."""
         y = y.reshape(self.S1, self.S2)
         factors = self.retained_run_lengths
-        prob = 1 - (1/ (self.prior_beta + 1))
+        log_prob, log_one_minus_prob = self.log_probability_tables(0)
         size = self.prior_alpha + self.prior_mean
 
-        return (np.sum(stats.nbinom.logpmf(y, size, prob)))
+        return np.sum(nbinom_log_pmf(y, size, log_prob[0],
+                                     log_one_minus_prob[0], gammaln(y + 1)))
 
 
     def trimmer(self, kept_run_lengths):
         """Trim the relevant quantities for the PG model"""
-        self.joint_log_probabilities = (
-                    self.joint_log_probabilities[kept_run_lengths])
-        self.means = self.means[kept_run_lengths,:,:]
-        self.retained_run_lengths = (self.retained_run_lengths[kept_run_lengths])
+        self.joint_log_probabilities_buffer.keep(kept_run_lengths)
+        self.means_buffer.keep(kept_run_lengths)
+        self.retained_run_lengths_buffer.keep(kept_run_lengths)
         self.model_log_evidence = scipy.special.logsumexp(self.joint_log_probabilities)
+
+
+    def truncater(self, max_length):
+        """Only keep the first *max_length* run-lengths for the PG model"""
+        self.joint_log_probabilities_buffer.truncate(max_length)
+        self.means_buffer.truncate(max_length)
+        self.retained_run_lengths_buffer.truncate(max_length)
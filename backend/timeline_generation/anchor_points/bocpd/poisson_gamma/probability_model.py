@@ -16,6 +16,8 @@ model where we treat each spatial location as independent from all others
 #from abc import ABCMeta, abstractmethod
 import numpy as np
 import scipy #.special #import logsumexp
+from .run_length_buffer import RunLengthBuffer
+from .run_length_recursion import grow_joint_log_probabilities
 
 class ProbabilityModel:
     #__metaclass__ = ABCMeta
@@ -33,11 +35,29 @@ class ProbabilityModel:
         cp_probabilities
         run_length_distribution
         update_predictive_distributions
-    """
 
+    Storage:
+        All quantities indexed by run length are kept in RunLengthBuffer
+        objects, which are allocated once (or grown geometrically) and
+        updated in place. The attribute *joint_log_probabilities* is a view
+        into *joint_log_probabilities_buffer*; assigning to it copies the
+        assigned values into the buffer.
+    """
 
+    def __init__(self, capacity=None):
+        """Allocate the buffer of the joint log probabilities, with room
+        for *capacity* run-lengths (or growing geometrically if None).
+        Subclasses call this before assigning any run-length quantities"""
+        self.capacity = capacity
+        self.joint_log_probabilities_buffer = RunLengthBuffer(capacity)
 
+    @property
+    def joint_log_probabilities(self):
+        return self.joint_log_probabilities_buffer.view()
 
+    @joint_log_probabilities.setter
+    def joint_log_probabilities(self, values):
+        self.joint_log_probabilities_buffer.assign(values)
 
     #SHOULD BE IMPLEMENTED IN EACH SUBCLASS
     def evaluate_predictive_log_distribution(self, y,r):
@@ -66,10 +86,13 @@ class ProbabilityModel:
         in the detector for this particular model.
 
         NOTE: *joint_probabilities* will have size t at the
-        beginning and size t+1 at the end of this function call.
+        beginning and size t+1 at the end of this function call. The growth
+        probabilities are computed in place and the CP probability is
+        prepended to the buffer, so no array of size t is copied.
 
-        NOTE: Desirable to also implement SOR/SCR of Fearnhead & Liu (2007)
-        in order for this to scale in constant time!
+        NOTE: For constant time updates, the Detector can bound the number
+        of run-lengths with the SOR of Fearnhead & Liu (2007), see
+        'resample_run_length_log_distribution'.
         """
 
 
@@ -86,22 +109,19 @@ class ProbabilityModel:
         of them, namely for r=1,2,...,t-1, > t-1, with the last probability
         always being 0 unless we have boundary conditions allowing for
         non-zero probability that we are already in the middle of a segment
-        at the first observation."""
-        helper_log_probabilities = (self.joint_log_probabilities +
-                                   predictive_log_probs)
+        at the first observation.
 
-        """STEP 3: Get CP & growth probabilties at time t by summing
+        STEP 3: Get CP & growth probabilties at time t by summing
         at each spatial location over all time points and multiplying by
         the hazard rate"""
         #DEBUG: We need to use chopping of run-lengths here, too
-        CP_log_prob = scipy.special.logsumexp(helper_log_probabilities +
-                                          np.log(cp_model.hazard_vector(1, t)))
-        self.joint_log_probabilities = (helper_log_probabilities +
-            np.log(1-cp_model.hazard_vector(1, t)))
+        log_hazard, log_one_minus_hazard = cp_model.log_hazard_vector(1, t)
+        CP_log_prob = grow_joint_log_probabilities(
+            self.joint_log_probabilities, predictive_log_probs,
+            log_hazard, log_one_minus_hazard)
 
         """Put together steps 2-3"""
-        self.joint_log_probabilities = np.insert(self.joint_log_probabilities,
-                                                0, CP_log_prob)
+        self.joint_log_probabilities_buffer.prepend(CP_log_prob)
 
         """STEP 4: Lastly, we always want to get the new evidence for this
         particular model in the model universe, which is the sum of CP and
@@ -109,6 +129,68 @@ class ProbabilityModel:
         self.model_log_evidence = scipy.special.logsumexp(
                 self.joint_log_probabilities )
 
+    #CALLS zero_streak_log_predictive(steps, new_segment), which needs to be
+    #       implemented in each subclass of probability_model
+    def update_joint_log_probabilities_zero_streak(self, t, k, cp_model):
+        """Same as *k* calls of 'update_joint_log_probabilities' for zero
+        observations at times t,t+1,...,t+k-1, using the closed-form
+        multi-step predictive probabilities of the subclass.
+
+        Returns the joint log probabilities at each of the k time points as
+        the rows of a k x (k+n) array, where n is the number of run-lengths
+        before the streak. Row j-1 holds those after j steps in its last n+j
+        entries (in the order of *joint_log_probabilities*, i.e. the j new
+        run-lengths first) and is -inf before. Also returns the k model
+        evidences. Afterwards, *joint_log_probabilities* is the last row,
+        and 'update_predictive_distributions_zero_streak' has to be called
+        to update the predictive distributions accordingly.
+        """
+        steps = np.arange(1, k+1)
+        log_hazard, log_one_minus_hazard = cp_model.log_hazard_vector(1, t)
+
+        """STEP 1: Growth of the run-lengths retained before the streak, for
+        all steps at once"""
+        old_log_probabilities = (self.joint_log_probabilities +
+            self.zero_streak_log_predictive(steps) +
+            steps[:,np.newaxis] * log_one_minus_hazard)
+        old_log_mass = scipy.special.logsumexp(old_log_probabilities, axis=1)
+
+        """STEP 2: The CP probability at step j is the hazard times the mass
+        that grows at step j, which includes the run-lengths started at the
+        earlier steps of the streak. Their growth after d steps only depends
+        on d"""
+        new_growth = (self.zero_streak_log_predictive(np.arange(k),
+                                                      new_segment=True)[:,0] +
+                      np.arange(k) * log_one_minus_hazard)
+        rows = -np.inf * np.ones(shape=(k, k + old_log_probabilities.shape[1]))
+        rows[:, k:] = old_log_probabilities
+        CP_log_probs = np.zeros(k)
+        evidences = np.zeros(k)
+        for j in steps:
+            row = rows[j-1]
+            growth_log_mass = old_log_mass[j-1]
+            if j > 1:
+                """run-lengths 1,...,j-1, started at steps j-1,...,1"""
+                new_log_probabilities = row[k-j+1:k]
+                new_log_probabilities[:] = (CP_log_probs[j-2::-1] +
+                                            new_growth[1:j])
+                """logsumexp without the overhead of scipy's checks, since
+                it is evaluated at each step"""
+                log_max = np.max(new_log_probabilities)
+                growth_log_mass = np.logaddexp(growth_log_mass, log_max +
+                    np.log(np.sum(np.exp(new_log_probabilities - log_max))))
+            CP_log_probs[j-1] = (growth_log_mass + log_hazard -
+                                 log_one_minus_hazard)
+            row[k-j] = CP_log_probs[j-1]
+            evidences[j-1] = np.logaddexp(growth_log_mass, CP_log_probs[j-1])
+
+        """STEP 3: Store the joint log probabilities after the streak"""
+        joint_log_probabilities = self.joint_log_probabilities
+        joint_log_probabilities[:] = old_log_probabilities[-1]
+        self.joint_log_probabilities_buffer.prepend_block(rows[-1, :k])
+        self.model_log_evidence = evidences[-1]
+        return rows, evidences
+
     #SHOULD BE IMPLEMENTED IN EACH SUBCLASS FOR t>1!
     def update_predictive_distributions(self, y, t, r_evaluations):
         """update the distributions giving rise to the predictive probabilities
@@ -157,3 +239,128 @@ class ProbabilityModel:
             """STEP 3: Drop the quantities associate with dropped run-lengths"""
             if deletions:
                 self.trimmer(kept_run_lengths)
+
+
+    #CALLS truncater(max_length), which needs to be implemented in each
+    #       subclass of probability_model
+    def fold_run_length_log_distribution(self, t, max_run_length,
+                                         log_MAP_weights=None):
+        """Bound the number of retained run-lengths of this model, so that
+        the per-step cost does not grow with t. The run-lengths
+        r=0,1,...,max_run_length-1 are kept as they are, while all older
+        ones are merged into one absorbing slot for r >= *max_run_length*.
+        The slot gets their total probability mass, but keeps the
+        sufficient statistics and the (true) run-length of one member, so
+        that its predictive and its MAP back-pointer stay those of an
+        actual segment. The member is the one maximizing the joint log
+        probability plus *log_MAP_weights* (one per retained run-length),
+        i.e. the most probable one if no weights are given. Returns the
+        joint log probability mass of the other members, which is -inf if
+        nothing was folded"""
+
+        """If no maximum run-length is given, don't do anything"""
+        if max_run_length is None:
+            return -np.inf
+
+        """STEP 1: Check if there are run-lengths beyond the window"""
+        window = max_run_length + 1
+        joint_log_probabilities = self.joint_log_probabilities
+        if joint_log_probabilities.shape[0] <= window:
+            return -np.inf
+
+        """STEP 2: Choose the member of the absorbing slot and get the mass
+        of the slot. The model evidence does not change, since no mass is
+        dropped"""
+        absorbed = joint_log_probabilities[window-1:]
+        scores = absorbed
+        if log_MAP_weights is not None:
+            scores = absorbed + log_MAP_weights[window-1:]
+        member = np.argmax(scores)
+        absorbed_log_mass = scipy.special.logsumexp(absorbed)
+        folded_log_mass = scipy.special.logsumexp(np.delete(absorbed, member))
+        model_log_evidence = self.model_log_evidence
+
+        """STEP 3: Drop the quantities associated with the other members"""
+        if member == 0:
+            self.truncater(window)
+        else:
+            kept_run_lengths = np.zeros(joint_log_probabilities.shape[0],
+                                        dtype=bool)
+            kept_run_lengths[:window] = True
+            kept_run_lengths[window-1] = False
+            kept_run_lengths[window-1+member] = True
+            self.trimmer(kept_run_lengths)
+        self.joint_log_probabilities[window-1] = absorbed_log_mass
+        self.model_log_evidence = model_log_evidence
+        return folded_log_mass
+
+
+    #CALLS trimmer(kept_run_lengths), which needs to be implemented in each
+    #       subclass of probability_model
+    def resample_run_length_log_distribution(self, t, max_particles, rng):
+        """Keep at most *max_particles* run-lengths of this model using the
+        stratified optimal resampling (SOR) of Fearnhead & Liu (2007).
+        Run-lengths with probability at least c are kept as they are, where
+        c solves sum_r min(1, p(r)/c) = max_particles. The others are
+        resampled by stratified sampling with the random generator *rng*
+        and the survivors get probability c."""
+
+        """If no maximum number of particles is given or the support is
+        small enough, don't do anything"""
+        if max_particles is None:
+            return
+        joint_log_probabilities = self.joint_log_probabilities
+        if joint_log_probabilities.shape[0] <= max_particles:
+            return
+
+        """STEP 1: Get the run-length distribution and the threshold c"""
+        log_evidence = self.model_log_evidence
+        weights = np.exp(joint_log_probabilities - log_evidence)
+        c = sor_threshold(weights, max_particles)
+
+        """STEP 2: Keep all run-lengths with probability at least c. If no
+        threshold exists (the remaining mass is 0), keep the largest ones"""
+        if c is None:
+            kept_run_lengths = np.zeros(weights.shape[0], dtype=bool)
+            kept_run_lengths[np.argsort(-weights, kind="stable")
+                             [:max_particles]] = True
+            self.trimmer(kept_run_lengths)
+            return
+        kept_run_lengths = weights >= c
+
+        """STEP 3: Stratified resampling of the others. Put a grid with
+        spacing c and random offset u on their cumulative probabilities,
+        and keep each run-length whose interval contains a grid point.
+        Since all of them have probability < c, no interval contains
+        more than one grid point"""
+        small = np.flatnonzero(~kept_run_lengths)
+        cumulative = np.cumsum(weights[small])
+        u = rng.uniform(0, c)
+        grid_points_below = np.maximum(np.floor((cumulative - u) / c) + 1, 0)
+        survivors = small[np.diff(grid_points_below, prepend=0) > 0]
+        kept_run_lengths[survivors] = True
+        joint_log_probabilities[survivors] = np.log(c) + log_evidence
+
+        """STEP 4: Drop the other run-lengths and renormalize so that the
+        model evidence is not changed by the resampling"""
+        self.trimmer(kept_run_lengths)
+        joint_log_probabilities = self.joint_log_probabilities
+        joint_log_probabilities += log_evidence - self.model_log_evidence
+        self.model_log_evidence = log_evidence
+
+
+def sor_threshold(weights, max_particles):
+    """Returns the threshold c of the stratified optimal resampling of
+    Fearnhead & Liu (2007), i.e. the c solving
+    sum_i min(1, weights[i]/c) = max_particles, or None if there is none.
+
+    With the weights sorted in decreasing order, c = (sum_{i>=k} w_i)/(M-k)
+    for the smallest k such that w_k < c, where M = *max_particles*"""
+    sorted_weights = np.sort(weights)[::-1]
+    tail_sums = np.cumsum(sorted_weights[::-1])[::-1][:max_particles]
+    k = np.arange(max_particles)
+    candidates = tail_sums / (max_particles - k)
+    below = np.flatnonzero(sorted_weights[:max_particles] < candidates)
+    if below.shape[0] == 0:
+        return None
+    return candidates[below[0]]
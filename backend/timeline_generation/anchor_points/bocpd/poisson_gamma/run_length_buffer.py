@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Description: Implements class RunLengthBuffer, the array-backed storage used
+by the ProbabilityModel objects for all quantities that are indexed by run
+length (joint log probabilities, sufficient statistics, retained run-lengths).
+Since a new run-length r=0 is added at the front of these arrays at every
+time step, the buffer keeps its entries right-aligned in a larger array and
+grows towards the front, so that adding an entry does not copy the others.
+"""
+
+import numpy as np
+
+
+class RunLengthBuffer:
+    """Stores a numpy array whose first axis is indexed by run length in a
+    preallocated block of memory.
+
+    The stored entries live in *data[start:stop]* and are exposed as a view
+    via 'view', so that in-place modifications of the view modify the buffer.
+    Adding an entry for r=0 with 'prepend' only decrements *start*. If there
+    is no space left at the front, the entries are either shifted back to the
+    end of the block (if it is at most half full) or the block is grown
+    geometrically.
+
+    Attributes:
+        capacity: int;
+            the number of entries the buffer can hold before growing. If
+            None, it is chosen when the first values are assigned.
+        dtype: numpy dtype;
+            the dtype of the stored entries. Default is float.
+        data: numpy array;
+            the block of memory, of dimension capacity x (trailing shape)
+        start, stop: int;
+            the stored entries are data[start:stop]
+    """
+
+    GROWTH_FACTOR = 2
+    MIN_CAPACITY = 16
+
+    def __init__(self, capacity=None, dtype=float):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.data = None
+        self.start, self.stop = 0, 0
+
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+    def view(self):
+        """Return the stored entries as a view into the buffer, or None if
+        nothing has been assigned yet"""
+        if self.data is None:
+            return None
+        return self.data[self.start:self.stop]
+
+
+    def assign(self, values):
+        """Replace the stored entries by *values*. If *values* is None, the
+        buffer is emptied"""
+        if values is None:
+            self.data = None
+            self.start, self.stop = 0, 0
+            return
+        values = np.asarray(values, dtype=self.dtype)
+        n = values.shape[0]
+        """Reuse the block if it is large enough for *values*"""
+        if (self.data is None or self.data.shape[1:] != values.shape[1:] or
+                self.data.shape[0] < n):
+            capacity = max(n, self.capacity or 0, self.MIN_CAPACITY)
+            self.data = np.empty((capacity,) + values.shape[1:],
+                                 dtype=self.dtype)
+        self.stop = self.data.shape[0]
+        self.start = self.stop - n
+        self.data[self.start:self.stop] = values
+
+
+    def prepend(self, value):
+        """Add *value* as the new first entry (i.e., run-length r=0)"""
+        if self.start == 0:
+            self._make_room()
+        self.start = self.start - 1
+        self.data[self.start] = value
+
+
+    def prepend_block(self, values):
+        """Add the entries *values* in front of the stored ones, i.e.
+        values[0] becomes the new first entry"""
+        values = np.asarray(values, dtype=self.dtype)
+        m = values.shape[0]
+        if self.start < m:
+            self._make_room(m)
+        self.start = self.start - m
+        self.data[self.start:self.start + m] = values
+
+
+    def truncate(self, n):
+        """Only keep the first *n* entries"""
+        self.stop = self.start + min(n, len(self))
+
+
+    def keep(self, kept):
+        """Only keep the entries selected by the boolean/index array *kept*,
+        compacting them to the end of the block"""
+        kept_values = self.view()[kept]
+        n = kept_values.shape[0]
+        self.stop = self.data.shape[0]
+        self.start = self.stop - n
+        self.data[self.start:self.stop] = kept_values
+
+
+    def _make_room(self, m=1):
+        """Create space for *m* entries at the front of the block. If the
+        block is at most half full, shifting the entries to its end is
+        enough (amortized constant cost per 'prepend'), otherwise grow it
+        geometrically"""
+        n = len(self)
+        capacity = self.data.shape[0]
+        if 2 * n <= capacity and n + m <= capacity:
+            self.data[capacity - n:capacity] = self.data[self.start:self.stop]
+        else:
+            capacity = max(self.GROWTH_FACTOR * capacity, self.MIN_CAPACITY,
+                           n + m)
+            new_data = np.empty((capacity,) + self.data.shape[1:],
+                                dtype=self.dtype)
+            new_data[capacity - n:] = self.data[self.start:self.stop]
+            self.data = new_data
+        self.stop = capacity
+        self.start = capacity - n
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Description: The steps of the run-length recursion and the MAP recursion of
+Fearnhead & Liu (2007) that do not depend on how the run-length indexed
+quantities are stored. They are shared by the Detector (with one
+ProbabilityModel object per model), the MixturePGDetector (the models of a
+mixture stacked as rows) and the BatchedPGDetector (a batch of series and CP
+models stacked along the leading axes), so that all of them perform exactly
+the same floating point operations.
+
+The run-lengths are always along the last axis, in the order of
+*joint_log_probabilities*, i.e. the newest run-length r=0 first.
+"""
+
+import numpy as np
+import scipy
+
+
+def initial_log_probabilities(cp_model):
+    """Returns log P(r_1 = 0) and log P(r_1 > 0) under *cp_model*, to be
+    added to the log evidence of the first observation. If a CP at t=0 is
+    certain, both are perturbed to avoid log(0)"""
+    if cp_model.pmf_0(1) == 0:
+        epsilon = 0.005
+    else:
+        epsilon = 0
+    return (np.log(cp_model.pmf_0(0) + epsilon),
+            np.log(cp_model.pmf_0(1) + epsilon))
+
+
+def grow_joint_log_probabilities(joint_log_probabilities, predictive_log_probs,
+                                 log_hazard, log_one_minus_hazard):
+    """Turns the joint log probabilities (y_{1:t-1}, r_{t-1}) into the growth
+    probabilities (y_{1:t}, r_t = r_{t-1}+1) in place, given the predictive
+    log probabilities of y_t, and returns the CP log probability
+    (y_{1:t}, r_t = 0), summed over the last axis. The hazard terms broadcast
+    against the leading axes, e.g. one per CP model"""
+    joint_log_probabilities += predictive_log_probs
+    CP_log_prob = scipy.special.logsumexp(joint_log_probabilities + log_hazard,
+                                          axis=-1)
+    joint_log_probabilities += log_one_minus_hazard
+    return CP_log_prob
+
+
+def map_candidates(log_densities, log_MAP_storage):
+    """Returns the log densities of the MAP candidates of Fearnhead & Liu
+    (2007): the candidate with run-length r is the MAP segmentation up to
+    t-r-1 followed by a segment of length r+1. *log_MAP_storage* holds the
+    log P^MAP of the r_max+1 earlier time points in chronological order,
+    i.e. reversed with respect to the run-lengths"""
+    return log_densities + np.flip(log_MAP_storage, axis=-1)
+
+
+def map_traceback(back_pointers, models, first_cp, t):
+    """Reconstruct the MAP segmentation at time *t* by following the
+    *back_pointers* (see Detector.MAP_estimate). Returns a 2 x (number of
+    CPs) array whose first row holds the CPs and whose second row holds the
+    model indices of the segments"""
+    cps, segment_models = [], []
+    while t > 1:
+        cps.append(back_pointers[t])
+        segment_models.append(models[t])
+        t = back_pointers[t]
+    if t == 1:
+        cps.append(first_cp)
+        segment_models.append(models[1])
+    return np.array([cps[::-1], segment_models[::-1]],
+                    dtype=float).reshape(2, -1)
@@ -0,0 +1,81 @@
+"""
+Poisson CUSUM screening of daily count series.
+
+A linear-time test for changes of the posting rate, used to find the windows of a series that are worth running the
+(much more expensive) BOCPD on. The rate under the null hypothesis is the mean count of the series, and the
+two-sided CUSUM of Page (1954) is run for an increase to rate_ratio times and a decrease to 1/rate_ratio times that
+rate. Every excursion of a CUSUM statistic away from 0 that exceeds the threshold is a candidate window.
+"""
+
+import numpy as np
+
+
+def poisson_cusum_statistics(counts, rate_ratio=2.0, baseline=None):
+    """
+    Inputs:
+    =======
+    counts = List/array of daily counts (T), or T x S for several features, which are summed per day.
+    rate_ratio = Float > 1. The rate change the CUSUMs are tuned to, in both directions.
+    baseline = Float. The rate under the null hypothesis, defaults to the mean count.
+
+    Outputs:
+    ========
+    2 x T array with the upper (rate increase) and lower (rate decrease) CUSUM statistics of each day.
+    Both are 0 if the baseline rate is 0.
+    """
+    counts = np.asarray(counts, dtype=float)
+    if counts.ndim > 1:
+        counts = counts.sum(axis=1)
+    if baseline is None:
+        baseline = counts.mean() if len(counts) > 0 else 0.0
+    if baseline <= 0:
+        return np.zeros((2, len(counts)))
+
+    # Log-likelihood ratio of each day for the rate baseline*ratio against baseline
+    statistics = []
+    for ratio in (rate_ratio, 1.0 / rate_ratio):
+        increments = counts * np.log(ratio) - baseline * (ratio - 1)
+        # Page's CUSUM S_t = max(0, S_{t-1} + increment_t) is the random walk minus its running minimum
+        walk = np.cumsum(increments)
+        statistics.append(walk - np.minimum(np.minimum.accumulate(walk), 0))
+
+    return np.array(statistics)
+
+
+def poisson_cusum_windows(counts, rate_ratio=2.0, threshold=5.0, margin=30, baseline=None):
+    """
+    Inputs:
+    =======
+    counts, rate_ratio, baseline = See poisson_cusum_statistics.
+    threshold = Float. A CUSUM excursion is flagged if it exceeds this log-likelihood ratio.
+    margin = Int. Number of days added before and after each flagged excursion.
+
+    Outputs:
+    ========
+    Sorted list of non-overlapping (start, stop) windows of days, i.e. the flagged excursions with their margins,
+    merged where they overlap. Empty if nothing was flagged.
+    """
+    statistics = poisson_cusum_statistics(counts, rate_ratio=rate_ratio, baseline=baseline)
+    T = statistics.shape[1]
+
+    windows = []
+    for statistic in statistics:
+        # Days belonging to the same excursion share the number of zeros of the statistic up to them
+        excursion_ids = np.cumsum(statistic <= 0)
+        flagged_ids = np.unique(excursion_ids[statistic > threshold])
+        if len(flagged_ids) == 0:
+            continue
+        starts = np.searchsorted(excursion_ids, flagged_ids, side='left')
+        stops = np.searchsorted(excursion_ids, flagged_ids, side='right')
+        windows.extend(zip(np.maximum(starts - margin, 0).tolist(), np.minimum(stops + margin, T).tolist()))
+
+    # Merge overlapping windows
+    windows.sort()
+    merged = []
+    for start, stop in windows:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
@@ -0,0 +1,43 @@
+"""
+Post-processing of detected anchor points, shared by all detection methods.
+
+The anchor points are kept as numpy arrays throughout: days since the start of the series (the positions in the
+daily series), or datetime64[D] dates. They are only converted to strings at the JSON boundary, with to_date_strings.
+"""
+
+import numpy as np
+
+
+def postprocess_anchor_points(user_feature_data, anchor_points=None, style='default'):
+    """
+    Inputs:
+    =======
+    user_feature_data = Pandas series/data frame of the daily series the anchor points were detected on, with the
+                        days as (datetime) index.
+    anchor_points = Array-like of anchor points, as positions in user_feature_data, or as dates/timestamps.
+    style = String. 'default' keeps the anchor points as they are, 'dates' converts positions to the days of
+            user_feature_data and timestamps to their days.
+
+    Outputs:
+    ========
+    The sorted, de-duplicated anchor points as a numpy array, of datetime64[D] dates with style 'dates'.
+    """
+    if anchor_points is None:
+        anchor_points = []
+    anchor_points = np.asarray(anchor_points)
+
+    if style != 'dates':
+        return np.unique(anchor_points)
+
+    # Positions in the daily series
+    if anchor_points.dtype.kind in 'iuf':
+        days = np.asarray(user_feature_data.index.values, dtype='datetime64[D]')
+        return days[np.unique(anchor_points).astype(int)]
+
+    # Dates or timestamps, truncated to their days
+    return np.unique(np.asarray(anchor_points, dtype='datetime64[D]'))
+
+
+def to_date_strings(dates) -> list:
+    """Returns the datetime64[D] dates (or any array-like of dates) as a list of 'YYYY-MM-DD' strings."""
+    return np.datetime_as_string(np.asarray(dates, dtype='datetime64[D]'), unit='D').tolist()
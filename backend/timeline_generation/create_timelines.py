@@ -1,20 +1,24 @@
-import datetime
+import numpy as np
 
 def assert_span_for_single_point(anchor_point, span_radius=7):
     
-    left = anchor_point - datetime.timedelta(span_radius)
-    right = anchor_point + datetime.timedelta(span_radius)
+    anchor_point = np.datetime64(anchor_point, 'D')
+    left = anchor_point - np.timedelta64(span_radius, 'D')
+    right = anchor_point + np.timedelta64(span_radius, 'D')
     span = [left, right]
     
     return span
 
 
 def return_anchor_points_for_user(multiple_anchor_points, span_radius=7):
-    multiple_spans = []
-    for ap in multiple_anchor_points:
-        multiple_spans.append(assert_span_for_single_point(ap, span_radius))
-        
-    return multiple_spans
+    """
+    Returns the spans of span_radius days around the anchor points (dates), as an n x 2 datetime64[D] array of
+    (start, end) rows.
+    """
+    anchor_points = np.asarray(multiple_anchor_points, dtype='datetime64[D]').reshape(-1)
+    radius = np.timedelta64(span_radius, 'D')
+    
+    return np.stack([anchor_points - radius, anchor_points + radius], axis=1)
 
 
 def create_timelines_from_anchor_points(anchor_points, span_radius=7, merge_overlapping=True):
@@ -40,21 +44,21 @@ def create_timelines_from_anchor_points(anchor_points, span_radius=7, merge_over
 
 def merge_overlapping_spans(temp_tuple):
     """
-    Merges overlapping spans in a list.
+    Merges overlapping spans, given as (start, end) rows, and returns the merged spans as an n x 2 array sorted
+    by their start. Spans overlap if one starts at most on the day the other ends.
     """
+    spans = np.asarray(temp_tuple)
     
     # No need to merge anything, if there is less than or equal to 1 span.
-    if len(temp_tuple) <= 1:
-        return temp_tuple
-    else:
-        temp_tuple.sort(key=lambda interval: interval[0])
-        merged = [temp_tuple[0]]
-        for current in temp_tuple:
-            previous = merged[-1]
-            if current[0] <= previous[1]:
-                previous[1] = max(previous[1], current[1])
-            else:
-                merged.append(current)
-
-            
-    return merged
\ No newline at end of file
+    if len(spans) <= 1:
+        return spans
+    
+    spans = spans[np.argsort(spans[:, 0], kind='stable')]
+    
+    # A span starts a new merged span if it starts after all earlier spans have ended
+    ends = np.maximum.accumulate(spans[:, 1])
+    new = np.concatenate(([True], spans[1:, 0] > ends[:-1]))
+    firsts = np.flatnonzero(new)
+    lasts = np.concatenate((firsts[1:], [len(spans)])) - 1
+    
+    return np.stack([spans[firsts, 0], ends[lasts]], axis=1)
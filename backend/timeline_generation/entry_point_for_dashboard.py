@@ -1,21 +1,46 @@
 import pickle 
+import numpy as np
 import pandas as pd
 import json
-from .generate_anchor_points import return_anchor_points_for_method
+from .generate_anchor_points import (return_anchor_points_for_method, return_anchor_points_split_at_gaps,
+                                     return_anchor_points_and_cp_probabilities, return_anchor_points_from_cp_probabilities)
 from .create_timelines import return_anchor_points_for_user, merge_overlapping_spans
+from .ingest_posts import as_post_columns
+from .anchor_point_cache import AnchorPointCache, anchor_point_cache_key
+
+# Daily count features that can be used for anchor point detection, and the post fields they need
+DAILY_FEATURES = {
+    'posts': [],                    # number of posts
+    'comments': ['num_comments'],   # number of comments received by the posts
+    'words': ['title'],             # number of words in the titles and texts of the posts
+    'subreddits': ['subreddit'],    # number of distinct subreddits posted in
+}
+
+# Anchor points detected by create_timeline_for_dashboard, see anchor_point_cache.py
+ANCHOR_POINT_CACHE = AnchorPointCache()
 
 def create_timeline_for_dashboard(unpickled_posts: dict, 
                                   method:str='bocpd', 
                                   alpha:float=0.01, 
                                   beta:float=0.1, 
                                   hazard:float=1000, 
-                                  span_radius:int=7) -> dict:
+                                  span_radius:int=7,
+                                  checkpoint_path:str | None = None,
+                                  checkpoint_save_path:str | None = None,
+                                  previous_timelines:dict | None = None,
+                                  max_gap_days:int | None = None,
+                                  max_workers:int | None = None,
+                                  features:list | None = None,
+                                  feature_priors:dict | None = None,
+                                  distribution:str='pg',
+                                  prefilter:str | None = None,
+                                  anchor_point_cache:AnchorPointCache | None = ANCHOR_POINT_CACHE) -> dict:
     
     '''
     INPUTS:
     unpickled_posts: dict
-        Dictionary of posts for a user from the Reddit dataset which is saved as a pickle file on the server.
-        Expects the file to have been unpickled before passing to this function.
+        Posts for a user from the Reddit dataset which is saved as a pickle file on the server, either as the
+        unpickled list of post dicts or as the columns of ingest_posts.ingest_posts.
     method: str
         Method to use for generating anchor points. Currently only 'bocpd' is implemented.
     alpha: float
@@ -26,6 +51,38 @@ def create_timeline_for_dashboard(unpickled_posts: dict,
         Hazard parameter for the Poisson-Gamma BOCPD model.
     span_radius: int
         Number of days to extend before and after each anchor point to create timelines.
+    checkpoint_path: str
+        Optional path of the BOCPD detector checkpoint of this user. If the user's earlier posts were already
+        processed with the same parameters, only the days since then are run through the detector.
+    checkpoint_save_path: str
+        Optional path the updated checkpoint is saved to, by default checkpoint_path.
+    previous_timelines: dict
+        Optional earlier timeline_dict of this user. Timelines that come out unchanged (same posts) are taken over
+        from it with everything stored on them (e.g. summaries), and its timelines that are not of interest
+        (e.g. created when summarising a selection of posts) are kept.
+    max_gap_days: int
+        Optional. If given, the daily series is split at inactivity gaps longer than this many days, and the
+        active segments are run through the model separately, in parallel with up to max_workers processes.
+        The first day of each segment (after the first) is an anchor point as well.
+        Cannot be combined with checkpoint_path, since the checkpoint holds the state for the whole series.
+    features: list
+        Optional list of daily count features (see DAILY_FEATURES) to detect the anchor points on, defaults to ['posts'].
+        Several features are run as one detection, treating them as independent series with common change points.
+    feature_priors: dict
+        Optional priors per feature, in the format {feature: {"alpha": float, "beta": float}}.
+        Features without an entry use alpha and beta.
+    distribution: str
+        'pg' (default) for the Poisson-Gamma model, or 'pg_mixture' for a mixture of Poisson-Gamma models, in which
+        case alpha and beta are lists with the prior of each model (and feature_priors is not used).
+    prefilter: str
+        Optional screening stage, e.g. 'cusum', so that the model only runs on the windows where the posting rate
+        changes (see generate_anchor_points.return_anchor_points_prefiltered). Cannot be combined with
+        checkpoint_path or max_gap_days.
+    anchor_point_cache: AnchorPointCache
+        Cache of the detected anchor points, by default shared by all calls. If the same daily series was run with
+        the same parameters before, the anchor points are taken from it and only the timelines are rebuilt, e.g.
+        when only span_radius changed. None always runs the detection, as does passing checkpoint_path, since the
+        checkpoint has to be updated (the detection is then incremental).
     ==========================================================================
     OUTPUTS:
     timeline_dict: dict
@@ -35,37 +92,303 @@ def create_timeline_for_dashboard(unpickled_posts: dict,
             "posts": list of post ids in the timeline
     '''
 
-    # Convert to pandas DataFrame
-    posts = pd.DataFrame(unpickled_posts)
+    unpickled_posts = as_post_columns(unpickled_posts)
+    detection = return_anchor_point_detection(unpickled_posts, method=method, alpha=alpha, beta=beta, hazard=hazard,
+                                              checkpoint_path=checkpoint_path, checkpoint_save_path=checkpoint_save_path,
+                                              max_gap_days=max_gap_days, max_workers=max_workers, features=features, feature_priors=feature_priors,
+                                              distribution=distribution, prefilter=prefilter)
+
+    # With a checkpoint, the detection always runs, so that the checkpoint is brought up to date
+    cache_key = None
+    anchor_points = None
+    if anchor_point_cache is not None and checkpoint_path is None:
+        cache_key = anchor_point_detection_cache_key(detection)
+        anchor_points = anchor_point_cache.get(cache_key)
+
+    if anchor_points is None:
+        anchor_points = detect_anchor_points(**detection)
+        if cache_key is not None:
+            anchor_point_cache.put(cache_key, anchor_points)
+
+    return create_timeline_from_anchor_points(unpickled_posts, anchor_points, span_radius=span_radius,
+                                              previous_timelines=previous_timelines)
+
+
+def return_anchor_point_detection(unpickled_posts,
+                                  method:str='bocpd',
+                                  alpha:float=0.01,
+                                  beta:float=0.1,
+                                  hazard:float=1000,
+                                  checkpoint_path:str | None = None,
+                                  max_gap_days:int | None = None,
+                                  max_workers:int | None = None,
+                                  features:list | None = None,
+                                  feature_priors:dict | None = None,
+                                  distribution:str='pg',
+                                  prefilter:str | None = None,
+                                  checkpoint_save_path:str | None = None) -> dict:
+    '''
+    Returns the keyword arguments of detect_anchor_points for the inputs of create_timeline_for_dashboard.
+    "posts" is the compact daily series with only the feature columns, so that the detection can be sent to
+    another process (e.g. a ProcessPoolExecutor) without the posts themselves.
+    '''
+    if features is None:
+        features = ['posts']
+    posts = return_daily_posts(unpickled_posts, features=features)
+
+    feature, alpha, beta = return_feature_and_priors(features, feature_priors, alpha, beta, distribution)
+
+    return {
+        "posts": posts[list(features)],
+        "method": method,
+        "distribution": distribution,
+        "alpha": alpha,
+        "beta": beta,
+        "hazard": hazard,
+        "feature": feature,
+        "checkpoint_path": checkpoint_path,
+        "checkpoint_save_path": checkpoint_save_path,
+        "max_gap_days": max_gap_days,
+        "max_workers": max_workers,
+        "prefilter": prefilter,
+    }
+
+
+def anchor_point_detection_cache_key(detection: dict) -> tuple:
+    '''
+    Returns the anchor point cache key of the detection of return_anchor_point_detection. Where the checkpoint is
+    kept and how many workers are used do not change the anchor points, so they are not part of the key.
+    '''
+    parameters = {name: value for name, value in detection.items()
+                  if name not in ("posts", "checkpoint_path", "checkpoint_save_path", "max_workers")}
+
+    return anchor_point_cache_key(detection["posts"], **parameters)
+
+
+def create_timeline_from_anchor_points(unpickled_posts, anchor_points, span_radius:int=7,
+                                       previous_timelines:dict | None = None) -> dict:
+    '''
+    Turns the anchor points (dates) into the timeline_dict of create_timeline_for_dashboard, with spans of
+    span_radius days around them, merged where they overlap.
+    '''
+    timelines = return_anchor_points_for_user(anchor_points, span_radius=span_radius)
+
+    timelines = merge_overlapping_spans(timelines)
+
+    post_days, post_ids = return_posts_by_day(unpickled_posts)
+
+    return match_timelines_to_posts(post_days, post_ids, timelines, previous_timelines=previous_timelines)
+
+
+def detect_anchor_points(posts: pd.DataFrame, method:str, distribution:str, alpha, beta, hazard:float, feature,
+                         checkpoint_path:str | None = None, max_gap_days:int | None = None, max_workers:int | None = None,
+                         prefilter:str | None = None, checkpoint_save_path:str | None = None) -> np.ndarray:
+    '''
+    Runs the anchor point detection of create_timeline_for_dashboard on the daily posts data frame and returns the
+    anchor points as dates. The arguments are those of return_anchor_point_detection.
+    '''
+    if max_gap_days is None:
+        return return_anchor_points_for_method(method, distribution=distribution, user_data=posts, alpha=alpha, beta=beta,
+                                               hazard=hazard, feature=feature, checkpoint_path=checkpoint_path,
+                                               prefilter=prefilter, checkpoint_save_path=checkpoint_save_path)
+    if checkpoint_path is not None:
+        raise ValueError("checkpoint_path cannot be combined with max_gap_days.")
+    if prefilter is not None:
+        raise ValueError("prefilter cannot be combined with max_gap_days.")
+    return return_anchor_points_split_at_gaps(method, max_gap_days, distribution=distribution, user_data=posts, alpha=alpha, beta=beta,
+                                              hazard=hazard, feature=feature, max_workers=max_workers)
+
+
+def return_cp_probabilities_for_dashboard(unpickled_posts: dict,
+                                          method:str='bocpd',
+                                          alpha:float=0.01,
+                                          beta:float=0.1,
+                                          hazard:float=1000,
+                                          features:list | None = None,
+                                          feature_priors:dict | None = None,
+                                          cp_probability_lag:int=7) -> pd.Series:
+    '''
+    Returns the probability of a change point on each day of the user's posting history, computed with the
+    Poisson-Gamma BOCPD model given the cp_probability_lag following days. The series has the days as index and
+    can be plotted, or turned into timelines at any probability cut-off with create_timeline_from_cp_probabilities
+    without running the model again. The other inputs are as in create_timeline_for_dashboard.
+    '''
+    detection = return_cp_probability_detection(unpickled_posts, method=method, alpha=alpha, beta=beta, hazard=hazard,
+                                                features=features, feature_priors=feature_priors,
+                                                cp_probability_lag=cp_probability_lag)
+
+    return detect_cp_probabilities(**detection)
+
+
+def return_cp_probability_detection(unpickled_posts,
+                                    method:str='bocpd',
+                                    alpha:float=0.01,
+                                    beta:float=0.1,
+                                    hazard:float=1000,
+                                    features:list | None = None,
+                                    feature_priors:dict | None = None,
+                                    cp_probability_lag:int=7) -> dict:
+    '''
+    Returns the keyword arguments of detect_cp_probabilities for the inputs of return_cp_probabilities_for_dashboard,
+    with the compact daily series as "posts", as return_anchor_point_detection.
+    '''
+    if features is None:
+        features = ['posts']
+    posts = return_daily_posts(as_post_columns(unpickled_posts), features=features)
+    feature, alpha, beta = return_feature_and_priors(features, feature_priors, alpha, beta)
+
+    return {
+        "posts": posts[list(features)],
+        "method": method,
+        "alpha": alpha,
+        "beta": beta,
+        "hazard": hazard,
+        "feature": feature,
+        "cp_probability_lag": cp_probability_lag,
+    }
+
+
+def detect_cp_probabilities(posts: pd.DataFrame, method:str, alpha, beta, hazard:float, feature,
+                            cp_probability_lag:int=7) -> pd.Series:
+    '''
+    Runs the model of return_cp_probabilities_for_dashboard on the daily posts data frame and returns the per-day
+    change point probabilities. The arguments are those of return_cp_probability_detection.
+    '''
+    _, cp_probabilities = return_anchor_points_and_cp_probabilities(method, user_data=posts, alpha=alpha, beta=beta,
+                                                                    hazard=hazard, feature=feature,
+                                                                    cp_probability_lag=cp_probability_lag)
+
+    return cp_probabilities
+
+
+def create_timeline_from_cp_probabilities(unpickled_posts: dict,
+                                          cp_probabilities: pd.Series,
+                                          cutoff:float=0.5,
+                                          span_radius:int=7,
+                                          previous_timelines:dict | None = None) -> dict:
+    '''
+    Same as create_timeline_for_dashboard, with the anchor points taken from the per-day change point
+    probabilities of return_cp_probabilities_for_dashboard at the given cutoff instead of running the model.
+    '''
+    anchor_points = return_anchor_points_from_cp_probabilities(cp_probabilities, cutoff=cutoff)
+
+    return create_timeline_from_anchor_points(unpickled_posts, anchor_points, span_radius=span_radius,
+                                              previous_timelines=previous_timelines)
+
+
+def return_feature_and_priors(features: list, feature_priors: dict | None, alpha, beta, distribution:str='pg'):
+    '''
+    Returns the feature (column name, or list of column names) and the alpha and beta to run the model with.
+    A single feature is run as before, several as one lattice with a prior per feature from feature_priors
+    (see create_timeline_for_dashboard).
+    '''
+    feature = features[0] if len(features) == 1 else list(features)
+    if feature_priors and distribution == 'pg_mixture':
+        raise ValueError("feature_priors cannot be combined with the 'pg_mixture' distribution.")
+    if feature_priors:
+        alphas = [feature_priors.get(f, {}).get("alpha", alpha) for f in features]
+        betas = [feature_priors.get(f, {}).get("beta", beta) for f in features]
+        alpha, beta = (alphas[0], betas[0]) if len(features) == 1 else (alphas, betas)
+
+    return feature, alpha, beta
+
+
+def return_daily_posts(unpickled_posts, features:list=('posts',)) -> pd.DataFrame:
+    '''
+    Returns a data frame whose index is the days from the first to the last post of the user, with
+    one column per daily count feature in features (see DAILY_FEATURES), e.g. "posts" the number of
+    posts per day. The "posts" column is always included. unpickled_posts is a list of post dicts or
+    the columns of ingest_posts.
+    '''
+    # Convert to pandas DataFrame, with only the ingested fields
+    posts = pd.DataFrame(as_post_columns(unpickled_posts))
+
+    for feature in features:
+        if feature not in DAILY_FEATURES:
+            raise ValueError(f"Unknown feature {feature}, expected one of {list(DAILY_FEATURES)}.")
+        missing = [field for field in DAILY_FEATURES[feature] if field not in posts.columns]
+        if missing:
+            raise ValueError(f"Feature {feature} needs the post fields {missing}.")
+
+    # Per-post counts, which are summed per day
+    posts['posts'] = 1
+    aggregations = {'posts': 'sum'}
+    if 'words' in features:
+        text = posts['title'].fillna('')
+        if 'selftext' in posts.columns:
+            text = text + ' ' + posts['selftext'].fillna('')
+        posts['words'] = text.str.split().str.len()
+        aggregations['words'] = 'sum'
+    if 'comments' in features:
+        posts['comments'] = posts['num_comments'].fillna(0)
+        aggregations['comments'] = 'sum'
+    if 'subreddits' in features:
+        posts['subreddits'] = posts['subreddit']
+        aggregations['subreddits'] = 'nunique'
 
     # Calculate number of posts per day and put data frame into shape
     # where index is datetime and column is number of posts
     posts['created_utc'] = pd.to_datetime(posts['created_utc'], unit='s')
     posts.set_index('created_utc', inplace=True)
-    posts = posts.resample('D').agg({'id':list})
-    posts['posts'] = posts['id'].apply(len)
+    posts = posts.resample('D').agg(aggregations)
 
-    anchor_points = return_anchor_points_for_method(method, user_data=posts, alpha=alpha, beta=beta, hazard=hazard, feature='posts')
+    return posts
 
-    timelines = return_anchor_points_for_user(anchor_points, span_radius=span_radius)
 
-    timelines = merge_overlapping_spans(timelines)
+def return_posts_by_day(unpickled_posts) -> tuple:
+    '''
+    Returns the day of each post as a sorted datetime64[D] array, and the post ids in the same order as an
+    object array. The posts are sorted by their full creation time before it is truncated to the day, so that
+    the posts of a day are in chronological order (as in the resampled daily posts). Posts created at the
+    same time keep their order in unpickled_posts.
+    '''
+    post_columns = as_post_columns(unpickled_posts)
+    post_ids = post_columns["id"]
+    created = pd.to_datetime(post_columns["created_utc"], unit='s').values
+    order = np.argsort(created, kind='stable')
+
+    return created[order].astype('datetime64[D]'), post_ids[order]
+
+
+def match_timelines_to_posts(post_days: np.ndarray, post_ids: np.ndarray, timelines: list,
+                             previous_timelines: dict | None = None) -> dict:
+    '''
+    Matches the (start, end) spans in timelines (both days included) to the posts, given as the sorted days and
+    ids of return_posts_by_day, and returns the timeline_dict used by the frontend.
+    See create_timeline_for_dashboard for previous_timelines.
+    '''
+    if previous_timelines is None:
+        previous_timelines = {}
+
+    # Index ranges of the posts in all spans at once
+    spans = np.array(timelines, dtype='datetime64[D]').reshape(-1, 2)
+    firsts = np.searchsorted(post_days, spans[:, 0], side='left')
+    lasts = np.searchsorted(post_days, spans[:, 1], side='right')
 
     # Matching timelines to posts
     # Dict to hold timeline posts in the format to be used by frontend
     timeline_dict = {}
-    for timeline in timelines:
+    for timeline, first, last in zip(timelines, firsts, lasts):
         start, end = timeline
-        # extract post ids in the date range (start, end), flatten the list of ids to one list and remove NaNs
-        matched_posts = posts.loc[start:end]["id"].explode().dropna().tolist()
+        matched_posts = post_ids[first:last].tolist()
         if len(matched_posts) == 0:
             print("Empty timeline for range", start, end)
             continue  # Skip empty timelines
         # create key in the format "start_id-end_id"
         timeline_key = f"{matched_posts[0]}-{matched_posts[-1]}"
+        previous = previous_timelines.get(timeline_key)
+        if previous is not None and previous["posts"] == matched_posts:
+            # Unchanged timeline, keep its summaries
+            timeline_dict[timeline_key] = {**previous, "timeline_of_interest": True}
+            continue
         timeline_dict[timeline_key] = {
             "timeline_of_interest": True,
             "posts": matched_posts
         }
 
+    # Keep the timelines that were not generated from anchor points
+    for timeline_key, timeline in previous_timelines.items():
+        if not timeline.get("timeline_of_interest", False) and timeline_key not in timeline_dict:
+            timeline_dict[timeline_key] = timeline
+
     return timeline_dict
\ No newline at end of file
@@ -1,10 +1,17 @@
 # import sys
 # sys.path.append("../../") # Go to base utils path
-from datetime import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 
-from .anchor_points.bocpd.poisson_gamma.extract_change_points import return_cps_from_bocpd_poisson_gamma_user_feature_data
+from .anchor_points.bocpd.poisson_gamma.extract_change_points import (return_cps_from_bocpd_poisson_gamma_user_feature_data,
+                                                                     return_cps_from_bocpd_poisson_gamma_checkpoint,
+                                                                     return_cps_from_bocpd_poisson_gamma_mixture,
+                                                                     return_cps_and_cp_probabilities_from_bocpd_poisson_gamma_user_feature_data,
+                                                                     cps_from_cp_probabilities)
+from .anchor_points.cusum.poisson_cusum import poisson_cusum_windows
+from .anchor_points.postprocessing import postprocess_anchor_points
 
 def return_anchor_points_for_method(method:str, 
                                     distribution:str='pg',
@@ -13,26 +20,46 @@ def return_anchor_points_for_method(method:str,
                                     beta:float=0.1, 
                                     hazard:float=1000, 
                                     process_into:str='dates', 
-                                    feature:str='posts'):
+                                    feature:str | list='posts',
+                                    checkpoint_path:str | None = None,
+                                    prefilter:str | None = None,
+                                    prefilter_margin:int=30,
+                                    checkpoint_save_path:str | None = None):
     """
     Inputs:
     =======
     method = String. The specified model to use, currently only 'bocpd' is implemented.
-    distribution = String. The specified distribution and priors to use for the BOCPD model
+    distribution = String. The specified distribution and priors to use for the BOCPD model. 'pg' is the Poisson-Gamma model,
+                   'pg_mixture' a mixture of Poisson-Gamma models with the priors given by the lists alpha and beta
+                   (e.g. a quiet-poster and a heavy-poster regime).
     user_feature_data = Pandas dataframe for the user, consisting of all their features. The index should be datetime and each column a feature (e.g. number of posts per day)
-    alpha = Float. Alpha parameter for the Poisson-Gamma BOCPD model.
-    beta = Float. Beta parameter for the Poisson-Gamma BOCPD model.
+    alpha = Float. Alpha parameter for the Poisson-Gamma BOCPD model. With several features, a list with one value per feature.
+    beta = Float. Beta parameter for the Poisson-Gamma BOCPD model. With several features, a list with one value per feature.
     hazard = Float. Hazard parameter for the Poisson-Gamma BOCPD model.
-    process_into = String. How to process the anchor points, either into 'dates' (days) or 'default' (timestamps).
+    process_into = String. How to process the anchor points, either into 'dates' (days) or 'default' (positions in the series).
     feature = String. The feature/column in the user_feature_data dataframe to use for anchor point detection.
+              A list of features is run as one detection with common change-points.
+    checkpoint_path = String. If given, the BOCPD detector state is resumed from and saved to this file, so that
+                      only the days added since the last call are processed.
+    checkpoint_save_path = String. If given, the updated detector state is saved to this file instead of checkpoint_path,
+                           e.g. to keep it apart until the results are confirmed.
+    prefilter = String. If 'cusum', the series is first screened with a Poisson CUSUM, and the model is only run on the
+                flagged windows (with prefilter_margin days on either side), see return_anchor_points_prefiltered.
     
     
     Outputs:
     ========
-    An ordered, de-duplicated list of datetimes indicating the anchor points. Can specify to process it as date (days), 
-    or keep as accurate timestamps.
+    An ordered, de-duplicated numpy array of the anchor points, as datetime64[D] dates with process_into='dates',
+    or as positions in the daily series (days since its start) with 'default'.
     """
-    # Extract just the relevant feature, as a Series
+    if prefilter is not None:
+        if checkpoint_path is not None:
+            raise ValueError("checkpoint_path cannot be combined with a prefilter.")
+        return return_anchor_points_prefiltered(method, prefilter=prefilter, margin=prefilter_margin, distribution=distribution,
+                                                user_data=user_data, alpha=alpha, beta=beta, hazard=hazard,
+                                                process_into=process_into, feature=feature)
+    
+    # Extract just the relevant feature, as a Series (or a data frame of the features)
     user_feature_data = user_data[feature]
     
     anchor_points = None
@@ -49,11 +76,31 @@ def return_anchor_points_for_method(method:str,
             prior_beta = beta
         
             # Extract change-points using the Poisson-Gamma model
-            anchor_points = return_cps_from_bocpd_poisson_gamma_user_feature_data(user_feature_data,
-                                                                  prior_hazard=prior_hazard,
-                                                                  prior_alpha=prior_alpha,
-                                                                  prior_beta=prior_beta,
-                                                                  post_process=process_into)
+            if checkpoint_path is None:
+                anchor_points = return_cps_from_bocpd_poisson_gamma_user_feature_data(user_feature_data,
+                                                                      prior_hazard=prior_hazard,
+                                                                      prior_alpha=prior_alpha,
+                                                                      prior_beta=prior_beta,
+                                                                      post_process=process_into)
+            else:
+                anchor_points = return_cps_from_bocpd_poisson_gamma_checkpoint(user_feature_data,
+                                                                   checkpoint_path,
+                                                                   prior_hazard=prior_hazard,
+                                                                   prior_alpha=prior_alpha,
+                                                                   prior_beta=prior_beta,
+                                                                   post_process=process_into,
+                                                                   save_path=checkpoint_save_path)
+        
+        elif distribution == 'pg_mixture':  # Mixture of Poisson-Gamma models, one per (alpha, beta)
+            print("Using Poisson-Gamma mixture BOCPD model")
+            if checkpoint_path is not None:
+                raise ValueError("Checkpoints are only supported for the 'pg' distribution.")
+            
+            anchor_points = return_cps_from_bocpd_poisson_gamma_mixture(user_feature_data,
+                                                                        prior_hazard=hazard,
+                                                                        prior_alphas=alpha,
+                                                                        prior_betas=beta,
+                                                                        post_process=process_into)
     # Post-processing
     anchor_points = postprocess_anchor_points(user_feature_data, anchor_points, style=process_into)
             
@@ -61,62 +108,232 @@ def return_anchor_points_for_method(method:str,
     return anchor_points
 
 
-def postprocess_anchor_points(user_feature_data, anchor_points=None, style='default'):
-    # Check if any anchor points exist, and return empty list of anchor points
-    if anchor_points == None:
-        anchor_points = []
-    if len(anchor_points) == 0:
-        return anchor_points
+def return_anchor_points_and_cp_probabilities(method:str,
+                                             distribution:str='pg',
+                                             user_data:pd.DataFrame | None = None,
+                                             alpha:float=0.01,
+                                             beta:float=0.1,
+                                             hazard:float=1000,
+                                             process_into:str='dates',
+                                             feature:str | list='posts',
+                                             cp_probability_lag:int=7):
+    """
+    Inputs:
+    =======
+    As return_anchor_points_for_method, and:
+    cp_probability_lag = Int. Number of days after a day that are taken into account for its CP probability.
+    
+    Outputs:
+    ========
+    The anchor points of the MAP segmentation as return_anchor_points_for_method, and the per-day CP probabilities
+    as a series with the dates of user_data as index, computed in the same pass of the model.
+    The anchor points for any probability cut-off are then given by return_anchor_points_from_cp_probabilities.
+    """
+    if method != 'bocpd' or distribution != 'pg':
+        raise ValueError("CP probabilities are only supported for the 'bocpd' method with the 'pg' distribution.")
+    user_feature_data = user_data[feature]
     
-    # Continue postprocessing, if points exist
+    anchor_points, cp_probabilities = return_cps_and_cp_probabilities_from_bocpd_poisson_gamma_user_feature_data(
+        user_feature_data, prior_hazard=hazard, prior_alpha=alpha, prior_beta=beta,
+        cp_probability_lag=cp_probability_lag, post_process=process_into)
+    
+    # The anchor points are already post-processed
+    return anchor_points, cp_probabilities
+
+
+def return_anchor_points_from_cp_probabilities(cp_probabilities:pd.Series,
+                                               cutoff:float=0.5,
+                                               process_into:str='dates'):
+    """
+    Inputs:
+    =======
+    cp_probabilities = Pandas series of the per-day CP probabilities, see return_anchor_points_and_cp_probabilities.
+    cutoff = Float. Each run of consecutive days with a CP probability of at least cutoff gives one anchor point,
+             at its most probable day.
+    process_into = String. As in return_anchor_points_for_method.
+    
+    Outputs:
+    ========
+    As return_anchor_points_for_method, without running the model again.
+    """
+    anchor_points = cps_from_cp_probabilities(cp_probabilities, cutoff)
+    
+    return postprocess_anchor_points(cp_probabilities, anchor_points, style=process_into)
+
+
+def return_anchor_points_split_at_gaps(method:str,
+                                       max_gap_days:int,
+                                       distribution:str='pg',
+                                       user_data:pd.DataFrame | None = None,
+                                       alpha:float=0.01,
+                                       beta:float=0.1,
+                                       hazard:float=1000,
+                                       process_into:str='dates',
+                                       feature:str | list='posts',
+                                       max_workers:int | None = None):
+    """
+    Inputs:
+    =======
+    As return_anchor_points_for_method, and:
+    max_gap_days = Int. The series is split at runs of more than this many days without activity (zero counts).
+    max_workers = Int. Number of worker processes for the segments, defaults to the number of cores.
+                  With 1, the segments are processed in this process.
+    
+    Outputs:
+    ========
+    As return_anchor_points_for_method. The anchor points of each active segment are detected separately
+    (so the inactivity gaps are not run through the model), and the first day of each segment after
+    the first one is an anchor point as well.
+    """
+    user_feature_data = user_data[feature]
+    segments = split_at_inactivity_gaps(user_feature_data, max_gap_days)
+    
+    # Only send the feature columns of each segment to the workers
+    segment_columns = feature if isinstance(feature, list) else [feature]
+    tasks = [(method, distribution, user_data[segment_columns].iloc[start:stop], alpha, beta, hazard, feature)
+             for start, stop in segments]
+    if max_workers == 1 or len(tasks) <= 1:
+        results = [_return_anchor_days_for_segment(*task) for task in tasks]
     else:
-        # Remove duplicate anchor points
-        anchor_points = list(set(anchor_points))
-        
-        # Sort in ascending order
-        anchor_points.sort()
+        with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(tasks))) as executor:
+            results = list(executor.map(_return_anchor_days_for_segment, *zip(*tasks)))
+    
+    # Stitch the anchor points (days since the start of each segment) together, with the segment starts
+    anchor_points = np.concatenate([np.array([start for start, _ in segments[1:]], dtype=int)] +
+                                   [start + np.asarray(segment_anchor_points, dtype=int)
+                                    for (start, _), segment_anchor_points in zip(segments, results)])
+    
+    return postprocess_anchor_points(user_feature_data, anchor_points, style=process_into)
 
-        if style == 'default':
-            return anchor_points
-        
-        # Check type of data
-        data_type = type(anchor_points[0])
-        
-        if style == 'dates':
-            if data_type == int or data_type == float:
-                return convert_days_since_to_datetimes(user_feature_data, anchor_points)
-            elif data_type == pd.Timestamp:
-                anchor_points = convert_timestamp_to_datetime(anchor_points)
-                return anchor_points
-            else:
-                return anchor_points
-            
-            
-            
-def convert_np_dt_to_dt(dt64):
-    ts = (dt64 - np.datetime64('1970-01-01T00:00:00Z')) / np.timedelta64(1, 's')
+
+def return_anchor_points_prefiltered(method:str,
+                                     prefilter:str='cusum',
+                                     margin:int=30,
+                                     distribution:str='pg',
+                                     user_data:pd.DataFrame | None = None,
+                                     alpha:float=0.01,
+                                     beta:float=0.1,
+                                     hazard:float=1000,
+                                     process_into:str='dates',
+                                     feature:str | list='posts'):
+    """
+    Inputs:
+    =======
+    As return_anchor_points_for_method, and:
+    prefilter = String. The screening stage, currently only 'cusum' (a two-sided Poisson CUSUM, see poisson_cusum.py).
+    margin = Int. Number of days added before and after each flagged window.
+    
+    Outputs:
+    ========
+    As return_anchor_points_for_method, where the model is only run on the windows flagged by the screening.
+    Users with a flat posting rate are not run through the model at all. See prefilter_recall_report for how
+    many of the anchor points of the full run are kept.
+    """
+    if prefilter != 'cusum':
+        raise ValueError(f"Unknown prefilter {prefilter}.")
+    user_feature_data = user_data[feature]
+    windows = poisson_cusum_windows(user_feature_data, margin=margin)
     
+    # Run the model on each window, with the anchor points as days since its start
+    anchor_points = [np.array([], dtype=int)]
+    segment_columns = feature if isinstance(feature, list) else [feature]
+    for start, stop in windows:
+        window_anchor_points = _return_anchor_days_for_segment(method, distribution, user_data[segment_columns].iloc[start:stop],
+                                                               alpha, beta, hazard, feature)
+        anchor_points.append(start + np.asarray(window_anchor_points, dtype=int))
+    anchor_points = np.concatenate(anchor_points)
     
-    return datetime.utcfromtimestamp(ts).date()
+    return postprocess_anchor_points(user_feature_data, anchor_points, style=process_into)
 
-def convert_days_since_to_datetimes(user_feature_data, anchor_points):
-    # Convert days to datetimes.
-    dt_points = pd.Series(user_feature_data.index)[anchor_points].values
-    dt_points = list(dt_points)
 
-    # Convert NumPy DateTime object to a datetime Date object.
-    converted_dts = []
-    for np_dt in dt_points:
-        converted = convert_np_dt_to_dt(np_dt)
-        converted_dts.append(converted)
+def prefilter_recall_report(users_data:dict,
+                            method:str='bocpd',
+                            prefilter:str='cusum',
+                            margin:int=30,
+                            tolerance_days:int=3,
+                            distribution:str='pg',
+                            alpha:float=0.01,
+                            beta:float=0.1,
+                            hazard:float=1000,
+                            feature:str | list='posts'):
+    """
+    Checks the prefiltered detection against the full run, e.g. before using it on a batch of users.
+    
+    Inputs:
+    =======
+    users_data = Dictionary of user id to the user's data frame, as user_data in return_anchor_points_for_method.
+    tolerance_days = Int. An anchor point of the full run is recalled if the prefiltered run has one at most
+                     this many days away.
+    The other inputs are as in return_anchor_points_prefiltered.
+    
+    Outputs:
+    ========
+    Dictionary with:
+        'recall': fraction of the anchor points of the full runs (over all users) that are recalled, 1 if there are none
+        'screened_fraction': fraction of the days (over all users) that the model was run on after the screening
+        'users': for each user, a dict with its 'recall', 'screened_fraction', 'full' and 'prefiltered' anchor points
+    """
+    users = {}
+    recalled_total, full_total, screened_days, total_days = 0, 0, 0, 0
+    for user_id, user_data in users_data.items():
+        full = return_anchor_points_for_method(method, distribution=distribution, user_data=user_data, alpha=alpha,
+                                               beta=beta, hazard=hazard, process_into='default', feature=feature)
+        prefiltered = return_anchor_points_prefiltered(method, prefilter=prefilter, margin=margin, distribution=distribution,
+                                                       user_data=user_data, alpha=alpha, beta=beta, hazard=hazard,
+                                                       process_into='default', feature=feature)
+        recalled = 0
+        if len(full) > 0 and len(prefiltered) > 0:
+            distances = np.abs(full[:, np.newaxis] - prefiltered[np.newaxis, :])
+            recalled = int(np.count_nonzero(distances.min(axis=1) <= tolerance_days))
+        windows = poisson_cusum_windows(user_data[feature], margin=margin)
+        screened = sum(stop - start for start, stop in windows)
+        
+        users[user_id] = {
+            'recall': recalled / len(full) if len(full) > 0 else 1.0,
+            'screened_fraction': screened / len(user_data) if len(user_data) > 0 else 0.0,
+            'full': full,
+            'prefiltered': prefiltered,
+        }
+        recalled_total += recalled
+        full_total += len(full)
+        screened_days += screened
+        total_days += len(user_data)
+    
+    return {
+        'recall': recalled_total / full_total if full_total > 0 else 1.0,
+        'screened_fraction': screened_days / total_days if total_days > 0 else 0.0,
+        'users': users,
+    }
 
-    # Update with dates
-    return converted_dts
 
-def convert_timestamp_to_datetime(anchor_points):
-    processed = []
-    for p in anchor_points:
-        processed.append(p.to_pydatetime().date())
+def split_at_inactivity_gaps(user_feature_data, max_gap_days:int):
+    """
+    Returns the (start, stop) positions of the active segments of a daily count series, i.e. the series is split
+    at every run of more than max_gap_days zero counts, which is dropped. Each segment starts and ends on a day
+    with a non-zero count. A series without any activity is a single segment.
+    For a data frame of several features, a day is active if any of its counts is non-zero.
+    """
+    counts = np.asarray(user_feature_data)
+    active = counts > 0
+    if active.ndim > 1:
+        active = np.any(active, axis=1)
+    active_days = np.flatnonzero(active)
+    if len(active_days) == 0:
+        return [(0, len(counts))]
+    
+    # Number of inactive days between consecutive active days
+    gaps = np.diff(active_days) - 1
+    breaks = np.flatnonzero(gaps > max_gap_days)
+    starts = np.concatenate(([active_days[0]], active_days[breaks + 1]))
+    stops = np.concatenate((active_days[breaks] + 1, [active_days[-1] + 1]))
     
-    return processed
-    
\ No newline at end of file
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _return_anchor_days_for_segment(method, distribution, segment_data, alpha, beta, hazard, feature):
+    """
+    Worker: anchor points of one segment, as days since its start.
+    """
+    return return_anchor_points_for_method(method, distribution=distribution, user_data=segment_data,
+                                           alpha=alpha, beta=beta, hazard=hazard,
+                                           process_into='default', feature=feature)
@@ -0,0 +1,91 @@
+"""
+Columnar ingest of uploaded user data.
+
+The uploaded pickles hold one dict per Reddit post with dozens of fields, of which the dashboard only uses a few.
+ingest_posts pulls those out in a single pass into one array per field, which is all that is kept of the upload:
+the posts JSON and the daily series for timeline generation are both built from these columns.
+"""
+
+import numpy as np
+
+
+# Fields that are always extracted, with the value used if a post does not have the field
+POST_FIELDS = {
+    'id': None,
+    'created_utc': None,
+    'title': '',
+    'selftext': '',
+}
+
+# Fields that are only extracted if some post has them (for the daily features, see DAILY_FEATURES)
+OPTIONAL_POST_FIELDS = {
+    'num_comments': np.nan,
+    'subreddit': None,
+}
+
+
+def ingest_posts(unpickled_posts) -> dict:
+    """
+    Inputs:
+    =======
+    unpickled_posts = List of post dicts, as in the uploaded pickle files. Every post needs an 'id' and a 'created_utc'.
+
+    Outputs:
+    ========
+    Dictionary of field name to a numpy array with the value of each post, in the order of unpickled_posts.
+    'created_utc' is numeric (int64 if all timestamps are integers, otherwise float64), 'num_comments' float64 and
+    the text fields are object arrays. The optional fields are only included if at least one post has them.
+    """
+    columns = {field: [] for field in POST_FIELDS}
+    optional_columns = {field: [] for field in OPTIONAL_POST_FIELDS}
+    for post in unpickled_posts:
+        columns['id'].append(post['id'])
+        columns['created_utc'].append(post['created_utc'])
+        columns['title'].append(post.get('title', ''))
+        columns['selftext'].append(post.get('selftext', ''))
+        for field, default in OPTIONAL_POST_FIELDS.items():
+            optional_columns[field].append(post.get(field, default))
+
+    post_columns = {
+        'id': np.array(columns['id'], dtype=object),
+        'created_utc': np.array(columns['created_utc']),
+        'title': np.array(columns['title'], dtype=object),
+        'selftext': np.array(columns['selftext'], dtype=object),
+    }
+    if post_columns['created_utc'].dtype.kind not in 'iuf':
+        post_columns['created_utc'] = post_columns['created_utc'].astype(float)
+
+    for field, default in OPTIONAL_POST_FIELDS.items():
+        if any(value is not default for value in optional_columns[field]):
+            dtype = float if field == 'num_comments' else object
+            post_columns[field] = np.array(optional_columns[field], dtype=dtype)
+
+    return post_columns
+
+
+def as_post_columns(posts) -> dict:
+    """
+    Returns the columns of ingest_posts for posts, which is either a list of post dicts or already the columns.
+    """
+    if isinstance(posts, dict):
+        return posts
+    return ingest_posts(posts)
+
+
+def return_posts_json(post_columns: dict) -> dict:
+    """
+    Returns the posts in the format of the posts JSON used by the frontend, i.e. a dict of post id to its
+    "title", "body", "created_utc" and "label".
+    """
+    return {
+        post_id: {
+            "title": title,
+            "body": body,
+            "created_utc": created_utc,
+            "label": ["0"]
+        }
+        for post_id, title, body, created_utc in zip(post_columns['id'].tolist(),
+                                                     post_columns['title'].tolist(),
+                                                     post_columns['selftext'].tolist(),
+                                                     post_columns['created_utc'].tolist())
+    }
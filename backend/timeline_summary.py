@@ -1,7 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import glob
 import json
 import os
+import threading
 import torch
-from typing import List
+from typing import Callable, List, Optional
+from transformers import TextStreamer
 
 from adsolve_utils.models.summary_generation_with_autoclass import LLMGenerator
 from adsolve_utils.models.prompts.load_prompt import load_prompt
@@ -21,22 +26,104 @@ def prepare_generation_parameters() -> dict[tuple[tuple[str], tuple[int], tuple[
 
     return gen_paras
 
-# Little class to handle switching between models
+# Streamer of one generation call, passing on the decoded text as it is generated
+class _StepStreamer(TextStreamer):
+    def __init__(self, tokenizer, on_text: Callable[[int, str], None], step: int):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+        self.step = step
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(self.step, text)
+
+# Wraps the generation pipeline of a summariser, so that every call to it (each stage of the
+# prompts, e.g. the post-level summaries and then the timeline-level summary) is streamed as
+# one step. Streamers only support one input at a time, so batches are generated one by one.
+class _StreamingPipe():
+    def __init__(self, pipe, on_text: Callable[[int, str], None]):
+        self.pipe = pipe
+        self.on_text = on_text
+        self.step = 0
+
+    def __call__(self, inputs, *args, **kwargs):
+        is_batch = isinstance(inputs, list) and len(inputs) > 1 and not isinstance(inputs[0], dict)
+        if is_batch:
+            return [self(single_input, *args, **kwargs) for single_input in inputs]
+        streamer = _StepStreamer(self.pipe.tokenizer, self.on_text, self.step)
+        self.step += 1
+        return self.pipe(inputs, *args, streamer=streamer, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+# Memory used by the weights of a loaded summariser, in bytes (0 if unknown)
+def summariser_footprint(summariser) -> int:
+    model = getattr(getattr(summariser, "pipe", None), "model", None)
+    try:
+        return int(model.get_memory_footprint())
+    except Exception:
+        return 0
+
+# Memory of a model before it is loaded, estimated from the size of its weight files in the Hugging Face cache
+# (0 if they are not found, e.g. before the first download)
+def estimate_footprint(cache_dir: str, model_name: str) -> int:
+    snapshots = os.path.join(cache_dir, f"models--{model_name.replace('/', '--')}", "snapshots", "*")
+    for pattern in ("*.safetensors", "*.bin"):
+        # the latest snapshot, the files are symlinks to the blobs
+        files = sorted(glob.glob(os.path.join(snapshots, pattern)), key=os.path.getmtime)
+        if files:
+            snapshot = os.path.dirname(files[-1])
+            return sum(os.path.getsize(f) for f in glob.glob(os.path.join(snapshot, pattern)))
+    return 0
+
+# Little class to handle switching between models.
+# Several models are kept loaded as long as their footprints fit in memory_budget_bytes, evicting the least
+# recently used ones beyond that. Without a budget, only one model is kept loaded. Models are loaded and
+# unloaded in a background thread, so a model can be loaded ahead of its first summary with prefetch.
 class ModelHandler():
-    def __init__(self, cache_dir: str):
+    def __init__(self, cache_dir: str, memory_budget_bytes: Optional[int] = None):
         self.model_name = None
         self.summariser = None
         self.gen_paras = prepare_generation_parameters()
         self.cache_dir = cache_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        # Resident summarisers, least recently used first, with their footprints. The footprints are
+        # remembered after unloading, to make room before loading a model again
+        self.summarisers = OrderedDict()
+        self.footprints = {}
+        self.hits = 0
+        self.misses = 0
+        # Futures of the models being loaded in the background
+        self.loading = {}
+        # The model running a summary, which is never evicted
+        self.in_use = None
+        self.lock = threading.RLock()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
     
-    # unload model to prevent memory leaks
-    def unload_summariser(self):
-        if self.summariser is None:
-            print("No summariser loaded, nothing to unload.")
-            return
-        print(f"Unloading model: {self.model_name}.")
+    # unload model to prevent memory leaks. Without a model_name, all models are unloaded
+    def unload_summariser(self, model_name: Optional[str] = None):
+        with self.lock:
+            model_names = list(self.summarisers) if model_name is None else [model_name]
+            if not any(name in self.summarisers for name in model_names):
+                print("No summariser loaded, nothing to unload.")
+                return
+            for name in model_names:
+                summariser = self.summarisers.pop(name, None)
+                if summariser is None:
+                    continue
+                if self.model_name == name:
+                    self.summariser = None
+                    self.model_name = None
+                self._unload(name, summariser)
+        # free up cache
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _unload(self, model_name: str, summariser):
+        print(f"Unloading model: {model_name}.")
         try:
-            pipe = getattr(self.summariser, "pipe", None)
+            pipe = getattr(summariser, "pipe", None)
             model = getattr(pipe, "model", None)
             if model is not None:
                 try:
@@ -46,35 +133,129 @@ class ModelHandler():
         except Exception:
             print("Could not unload summariser!")
         
-        print(f"Unloaded model: {self.model_name}.")
-        self.summariser = None
-        self.model_name = None
-        # free up cache
-        if torch.cuda.is_available():
+        print(f"Unloaded model: {model_name}.")
+
+    # Evict the least recently used models (other than keep) until needed_bytes more fit in the budget.
+    # Without a budget, all other models are evicted
+    def _evict_for(self, needed_bytes: int, keep: Optional[str] = None) -> list:
+        evicted = []
+        with self.lock:
+            for name in list(self.summarisers):
+                if name == keep or name == self.in_use:
+                    continue
+                if self.memory_budget_bytes is not None and \
+                        self.used_bytes() + needed_bytes <= self.memory_budget_bytes:
+                    break
+                evicted.append((name, self.summarisers.pop(name)))
+                if self.model_name == name:
+                    self.summariser = None
+                    self.model_name = None
+        return evicted
+
+    def _release(self, evicted: list):
+        for name, summariser in evicted:
+            self._unload(name, summariser)
+        if evicted and torch.cuda.is_available():
             torch.cuda.empty_cache()
-    
 
-    
+    def _load(self, model_name: str):
+        try:
+            # make room for the model first, with its footprint from an earlier load or estimated from its weights.
+            # If it cannot be estimated, the model may need the whole budget
+            needed_bytes = self.footprints.get(model_name) or estimate_footprint(self.cache_dir, model_name)
+            if not needed_bytes:
+                needed_bytes = self.memory_budget_bytes or 0
+            self._release(self._evict_for(needed_bytes))
+            summariser = LLMGenerator(model_name=model_name, cache_dir=self.cache_dir)
+        except Exception:
+            # so that a failed load is not reported as loading, and is tried again next time
+            with self.lock:
+                self.loading.pop(model_name, None)
+            raise
+        with self.lock:
+            self.footprints[model_name] = summariser_footprint(summariser)
+            self.summarisers[model_name] = summariser
+            self.loading.pop(model_name, None)
+            evicted = self._evict_for(0, keep=model_name)
+        print(f"Loaded model: {model_name}")
+        # unload the evicted models after the new one is handed out
+        if evicted:
+            self.loader.submit(self._release, evicted)
+        return summariser
+
+    # Start loading a model in the background, returns a future that resolves to the summariser
+    def prefetch(self, model_name: str) -> Future:
+        with self.lock:
+            if model_name in self.summarisers:
+                future = Future()
+                future.set_result(self.summarisers[model_name])
+                return future
+            if model_name not in self.loading:
+                self.loading[model_name] = self.loader.submit(self._load, model_name)
+            return self.loading[model_name]
+
     def load_summariser(self, model_name):
-        # always make sure to unload summariser before loading new summariser
-        self.unload_summariser()
-        self.model_name = model_name
-        self.summariser = LLMGenerator(model_name=model_name, cache_dir=self.cache_dir)
-        print(f"Loaded model: {self.model_name}")
+        with self.lock:
+            summariser = self.summarisers.get(model_name)
+            if summariser is not None:
+                self.hits += 1
+                self.summarisers.move_to_end(model_name)
+            else:
+                self.misses += 1
+        if summariser is None:
+            summariser = self.prefetch(model_name).result()
+        with self.lock:
+            self.model_name = model_name
+            self.summariser = summariser
+        return summariser
+
+    # Memory used by the resident models, in bytes
+    def used_bytes(self) -> int:
+        with self.lock:
+            return sum(self.footprints.get(name, 0) for name in self.summarisers)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "resident": [{"model_name": name, "footprint_bytes": self.footprints.get(name, 0)}
+                             for name in reversed(self.summarisers)],
+                "loading": list(self.loading),
+                "used_bytes": self.used_bytes(),
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
     
-    def run_summary(self, model_name: str, posts:List[str]) -> str:
-        if self.summariser is None or self.model_name != model_name:
-            self.load_summariser(model_name)
+    # on_text(step, text) is optionally called with the text of each generation step as it is
+    # generated (see _StreamingPipe), the complete summary is returned at the end either way
+    def run_summary(self, model_name: str, posts:List[str],
+                    on_text: Optional[Callable[[int, str], None]] = None) -> str:
+        with self.lock:
+            self.in_use = model_name
+        try:
+            summariser = self.load_summariser(model_name)
+        except Exception:
+            with self.lock:
+                self.in_use = None
+            raise
 
         prompts, max_tokens, temperatures = self.gen_paras[model_name]
 
-        # create summary
-        summary = self.summariser.run_summary(
-                prompt=prompts,
-                text=posts,
-                max_tokens=max_tokens,
-                temperatures=temperatures
-            )
+        pipe = summariser.pipe
+        if on_text is not None:
+            summariser.pipe = _StreamingPipe(pipe, on_text)
+        try:
+            # create summary
+            summary = summariser.run_summary(
+                    prompt=prompts,
+                    text=posts,
+                    max_tokens=max_tokens,
+                    temperatures=temperatures
+                )
+        finally:
+            summariser.pipe = pipe
+            with self.lock:
+                self.in_use = None
         
         return summary
 
@@ -82,5 +263,6 @@ class ModelHandler():
         pass
     
     def cleanup(self):
+        self.loader.shutdown(wait=True, cancel_futures=True)
         self.unload_summariser()
-        print("Cleaned up ModelHandler.")
\ No newline at end of file
+        print("Cleaned up ModelHandler.")